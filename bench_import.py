@@ -0,0 +1,41 @@
+"""
+bench_import.py - import time benchmark guarding the CLI startup time
+"""
+import sys
+import time
+import subprocess
+import argparse
+import numpy as np
+
+HEAVY_MODULES = ('PyQt4', 'PyQt5', 'pyqtgraph', 'scipy', 'cfelpyutils', 'mpi4py', 'matplotlib')
+CHECK_CMD = "import sys, exfel.process; print(' '.join(sorted(set(mod.split('.')[0] for mod in sys.modules))))"
+
+def startup_time(n_runs):
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'exfel', '--help'],
+                       check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+def heavy_imports():
+    output = subprocess.run([sys.executable, '-c', CHECK_CMD], check=True,
+                            stdout=subprocess.PIPE).stdout.decode().split()
+    return [mod for mod in HEAVY_MODULES if mod in output]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark python -m exfel startup time')
+    parser.add_argument('--limit', type=float, default=1., help='Maximum startup time in seconds')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs')
+    args = parser.parse_args()
+
+    median = startup_time(args.runs)
+    print('Startup time: {:.3f}s (limit {:.3f}s)'.format(median, args.limit))
+    loaded = heavy_imports()
+    print('Heavy modules imported at startup: {}'.format(', '.join(loaded) or 'none'))
+    if median > args.limit or loaded:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os
+import time
+import numpy as np
+from exfel.utils.cache import BlockCache, cache_key, file_identity
+
+def chunk(seed, size=100):
+    rng = np.random.default_rng(seed)
+    return {'data': rng.random((size, 4)), 'pulseId': np.arange(size)}
+
+def test_round_trip(tmp_path):
+    cache = BlockCache(str(tmp_path / 'blocks'))
+    key = cache_key('read', 0, 100)
+    assert key not in cache and cache.get(key) is None
+    cache.put(key, chunk(0))
+    assert key in cache
+    cached = cache.get(key)
+    for name, value in chunk(0).items():
+        np.testing.assert_array_equal(cached[name], value)
+    cache.put(cache_key('empty'), {})
+    assert cache.get(cache_key('empty')) == {}
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+    assert cache.stats()['hit_rate'] == 2. / 3.
+    cache.clear()
+    assert cache.size == 0 and key not in cache
+
+def test_eviction(tmp_path):
+    cache = BlockCache(str(tmp_path / 'blocks'))
+    keys = [cache_key(idx) for idx in range(3)]
+    for idx, key in enumerate(keys):
+        cache.put(key, chunk(idx))
+        # make the modification times distinct on coarse clocks
+        os.utime(cache.path(key), ns=(idx * 10**9, idx * 10**9))
+    cache.get(keys[0])
+    # the least recently used block goes first
+    cache.max_bytes = cache.size - 1
+    cache.evict()
+    assert keys[0] in cache and keys[1] not in cache and keys[2] in cache
+
+def test_keys(tmp_path):
+    path = tmp_path / 'data.h5'
+    path.write_bytes(b'0' * 10)
+    identity = file_identity(str(path))
+    assert cache_key(identity, 0, 10) != cache_key(identity, 10, 20)
+    time.sleep(0.01)
+    path.write_bytes(b'1' * 11)
+    assert file_identity(str(path)) != identity
@@ -0,0 +1,108 @@
+import json
+import h5py
+import numpy as np
+import pytest
+from exfel.utils.checkpoint import (CheckpointWriter, TaskJournal, journal_path, DATA_GROUP,
+                                    FRAMES_KEYS)
+
+HEADER = {'source': ['raw.h5', 10, 1], 'limit': 20}
+SHAPE = (4, 6)
+DTYPES = (np.float32, np.uint64, np.uint64, np.float64, np.float64)
+
+def task_chunk(task, seed):
+    rng = np.random.default_rng(seed)
+    count = task[1] - task[0] - 2
+    return (rng.random((count,) + SHAPE).astype(np.float32),
+            np.arange(*task)[:count].astype(np.uint64),
+            np.zeros(count, dtype=np.uint64), rng.random(count), rng.random(count))
+
+def test_journal(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    journal = TaskJournal(path, HEADER)
+    assert not journal.resumed and journal.size == 0
+    journal.commit((0, 10), 0, 4)
+    journal.commit((20, 30), 4, 3)
+    # a record torn by a killed job is dropped
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"task": [10, ')
+    journal = TaskJournal(path, HEADER)
+    assert journal.resumed and journal.size == 7
+    assert journal.missing([(0, 10), (10, 20), (20, 30)]) == [(10, 20)]
+    with open(path) as journal_file:
+        assert all(json.loads(line) for line in journal_file)
+    # a journal of another job is discarded
+    assert not TaskJournal(path, dict(HEADER, limit=30)).resumed
+
+def test_resume(tmp_path):
+    out_path = str(tmp_path / 'out' / 'run.cxi')
+    tasks = [(0, 10), (10, 20), (20, 30)]
+    writer = CheckpointWriter(out_path, HEADER, SHAPE, DTYPES)
+    writer.append(tasks[0], task_chunk(tasks[0], 0))
+    # the frames of a task written but not journaled before the job was killed
+    writer.resize(writer.size + 5)
+    writer.close()
+    writer = CheckpointWriter(out_path, HEADER, SHAPE, DTYPES)
+    assert writer.resumed and writer.missing(tasks) == tasks[1:]
+    assert writer.out_file[DATA_GROUP][FRAMES_KEYS[0]].shape[0] == 8
+    for idx, task in enumerate(writer.missing(tasks), 1):
+        writer.append(task, task_chunk(task, idx))
+    writer.close()
+    chunks = [task_chunk(task, idx) for idx, task in enumerate(tasks)]
+    with h5py.File(out_path, 'r') as out_file:
+        for key, dtype, values in zip(FRAMES_KEYS, DTYPES, zip(*chunks)):
+            assert out_file[DATA_GROUP][key].dtype == dtype
+            np.testing.assert_array_equal(out_file[DATA_GROUP][key][()], np.concatenate(values))
+
+def test_unreadable_output(tmp_path):
+    out_path = str(tmp_path / 'run.cxi')
+    writer = CheckpointWriter(out_path, HEADER, SHAPE, DTYPES)
+    writer.append((0, 10), task_chunk((0, 10), 0))
+    writer.close()
+    with open(out_path, 'wb') as out_file:
+        out_file.write(b'broken')
+    writer = CheckpointWriter(out_path, HEADER, SHAPE, DTYPES)
+    assert not writer.resumed and writer.size == 0
+    assert writer.missing([(0, 10)]) == [(0, 10)]
+    writer.close()
+    assert journal_path(out_path) == str(tmp_path / 'run.journal')
+
+def test_declared_dtypes(tmp_path):
+    out_path = str(tmp_path / 'run.cxi')
+    dtypes = (np.uint16,) + DTYPES[1:]
+    chunks = [task_chunk(task, idx) for idx, task in enumerate([(0, 10), (10, 20)])]
+    chunks = [(np.rint(chunk[0] * 100).astype(np.uint16),) + chunk[1:] for chunk in chunks]
+    writer = CheckpointWriter(out_path, HEADER, SHAPE, dtypes)
+    writer.append((0, 10), chunks[0])
+    writer.close()
+    # the frames fit in uint8, the dtype is picked from the declared range
+    writer = CheckpointWriter(out_path, HEADER, SHAPE, dtypes)
+    writer.append((10, 20), chunks[1])
+    writer.close()
+    with h5py.File(out_path, 'r') as out_file:
+        dataset = out_file[DATA_GROUP][FRAMES_KEYS[0]]
+        assert dataset.dtype == np.uint16 and dataset.compression == 'gzip'
+        np.testing.assert_array_equal(dataset[()], np.concatenate([chunks[0][0], chunks[1][0]]))
+
+@pytest.mark.parametrize('raw_dtype,dtype', [(np.uint16, np.uint16), (np.int32, np.int32),
+                                             (np.float32, np.float32), ('>f8', '<f8')])
+def test_frame_dtypes(tmp_path, raw_dtype, dtype):
+    pytest.importorskip('mpi4py')
+    from exfel.utils import mpi_pool
+    frames = np.array([[0, 1, 2], [3, 4, 5.5]]).astype(raw_dtype)
+    with h5py.File(str(tmp_path / 'raw.h5'), 'w') as raw_file:
+        raw_file.create_dataset(mpi_pool.DATA_PATH, data=frames)
+        raw_file.create_dataset(mpi_pool.TRAIN_PATH, shape=(2,), dtype=np.uint64)
+        raw_file.create_dataset(mpi_pool.PULSE_PATH, shape=(2,), dtype=np.uint16)
+    dtypes = mpi_pool.frame_dtypes(str(tmp_path / 'raw.h5'))
+    out_path = str(tmp_path / 'run.cxi')
+    writer = CheckpointWriter(out_path, HEADER, (3,), dtypes)
+    writer.append((0, 2), (frames.astype(dtypes[0]), np.arange(2, dtype=np.uint64),
+                           np.arange(2, dtype=np.uint16), np.zeros(2), np.zeros(2)))
+    writer.close()
+    with h5py.File(out_path, 'r') as out_file:
+        data_group = out_file[DATA_GROUP]
+        # floating point frames are never stored as integers
+        assert data_group[FRAMES_KEYS[0]].dtype == np.dtype(dtype)
+        np.testing.assert_array_equal(data_group[FRAMES_KEYS[0]][()], frames)
+        assert (data_group[FRAMES_KEYS[1]].dtype, data_group[FRAMES_KEYS[2]].dtype) == \
+               (np.uint64, np.uint16)
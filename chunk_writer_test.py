@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.utils.chunk_writer import ChunkWriter, deflated, inflate_frames, read_frames
+from exfel.utils.precision import Precision, read_dataset
+
+def frames(size=37, shape=(13, 21), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1000, (size,) + shape).astype(np.float32)
+
+def test_round_trip(tmp_path):
+    data = frames()
+    # small blocks to split the frames among the workers, edge chunks are padded
+    writer = ChunkWriter(num_workers=2, block_bytes=data[0].nbytes * 3)
+    with h5py.File(str(tmp_path / 'chunks.h5'), 'w') as out_file:
+        writer.create_dataset(out_file, 'data', data)
+        writer.create_dataset(out_file, 'encoded', data, policy=Precision())
+        writer.create_dataset(out_file, 'empty', np.zeros((0, 4)))
+    with h5py.File(str(tmp_path / 'chunks.h5'), 'r') as out_file:
+        dataset = out_file['data']
+        assert dataset.compression == 'gzip' and deflated(dataset)
+        np.testing.assert_array_equal(dataset[()], data)
+        assert out_file['encoded'].dtype == np.uint16
+        np.testing.assert_array_equal(read_dataset(out_file['encoded']), data)
+        assert out_file['empty'].shape == (0, 4)
+
+@pytest.mark.parametrize('start,stop', [(0, 37), (5, 6), (3, 29), (30, 100), (10, 10)])
+def test_inflate(tmp_path, start, stop):
+    data = frames()
+    with h5py.File(str(tmp_path / 'chunks.h5'), 'w') as out_file:
+        out_file.create_dataset('data', data=data, chunks=(4, 5, 8), compression='gzip')
+        out_file.create_dataset('shuffled', data=data, chunks=(4, 5, 8), compression='gzip',
+                                shuffle=True)
+    with h5py.File(str(tmp_path / 'chunks.h5'), 'r') as out_file:
+        np.testing.assert_array_equal(inflate_frames(out_file['data'], start, stop),
+                                      data[start:stop])
+        assert not deflated(out_file['shuffled'])
+        np.testing.assert_array_equal(read_frames(out_file['shuffled'], start, stop),
+                                      data[start:stop])
+        np.testing.assert_array_equal(read_frames(out_file['data'], start, stop, (slice(2, 4),)),
+                                      data[start:stop, 2:4])
+
+def test_wrong_level():
+    with pytest.raises(ValueError):
+        ChunkWriter(level=10)
+
+def test_unallocated(tmp_path):
+    with h5py.File(str(tmp_path / 'chunks.h5'), 'w') as out_file:
+        dataset = out_file.create_dataset('data', shape=(5, 6), maxshape=(None, 6), chunks=(2, 4),
+                                          compression='gzip', fillvalue=7, dtype=np.int32)
+        dataset[:2] = 1
+        # resized, but the new chunks are never written
+        dataset.resize(9, axis=0)
+    with h5py.File(str(tmp_path / 'chunks.h5'), 'r') as out_file:
+        ref = np.full((9, 6), 7, dtype=np.int32)
+        ref[:2] = 1
+        np.testing.assert_array_equal(inflate_frames(out_file['data'], 0, 9), ref)
+        np.testing.assert_array_equal(read_frames(out_file['data'], 1, 6), ref[1:6])
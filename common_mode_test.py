@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from exfel.calib import common_mode, asic_tiles
+
+def asic_frames(size=3, shape=(8, 12), asic_shape=(4, 4), seed=0):
+    rng = np.random.default_rng(seed)
+    offsets = rng.normal(0, 10, (size, shape[0] // asic_shape[0], shape[1] // asic_shape[1]))
+    frames = rng.normal(0, 1, (size,) + shape)
+    frames += np.repeat(np.repeat(offsets, asic_shape[0], axis=1), asic_shape[1], axis=2)
+    return frames, offsets
+
+def test_common_mode_median():
+    frames, _ = asic_frames()
+    mask = np.random.default_rng(1).random(frames.shape[1:]) > 0.2
+    frames[0, 1, 1] = 1000.
+    ref = frames.copy()
+    baselines = common_mode(frames, mask, 'median', dark_limit=50, asic_shape=(4, 4))
+    assert baselines.shape == (3, 2, 3)
+    tiles, tile_mask = asic_tiles(ref, (4, 4)), asic_tiles(mask, (4, 4))
+    for idx in np.ndindex(baselines.shape):
+        values = tiles[idx][tile_mask[idx[1:]] & (np.abs(tiles[idx]) < 50)]
+        assert baselines[idx] == np.median(values)
+    diff = ref - frames
+    np.testing.assert_allclose(asic_tiles(diff, (4, 4)), np.broadcast_to(baselines[..., None],
+                                                                         tiles.shape))
+
+def test_common_mode_peak():
+    rng = np.random.default_rng(2)
+    frames = rng.normal(0, 1, (2, 64, 128)) + np.array([-7.3, 12.6])[:, None, None]
+    # photon hits are outside of dark_limit and don't move the baseline
+    frames[rng.random(frames.shape) < 0.1] += 60.
+    baselines = common_mode(frames, method='peak', dark_limit=30, asic_shape=(64, 64))
+    np.testing.assert_allclose(baselines, [[[-7.3, -7.3]], [[12.6, 12.6]]], atol=0.3)
+
+def test_common_mode_empty():
+    frames = np.full((1, 4, 8), 100.)
+    frames[0, :, 4:] = 2.
+    baselines = common_mode(frames, dark_limit=50, asic_shape=(4, 4))
+    np.testing.assert_array_equal(baselines, [[[0., 2.]]])
+    np.testing.assert_array_equal(frames[0, :, 4:], 0.)
+    with pytest.raises(ValueError):
+        common_mode(frames, method='mean')
@@ -0,0 +1,2 @@
+# calib_test.py is a manual script run on the beamline data, not a test module
+collect_ignore = ['calib_test.py']
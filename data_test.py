@@ -0,0 +1,163 @@
+import os
+import pickle
+import h5py
+import numpy as np
+import pytest
+from exfel.utils import utilities
+from exfel.data import (CheetahData, CheetahRun, SharedPool, cheetah_files, index_runs, DATA_PATH,
+                        PULSE_PATH, TRAIN_PATH)
+from exfel.sources import Source
+
+def cheetah_file(path, size=40, shape=(12, 10), pulses=4, seed=0, **kwargs):
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 100, (size,) + shape).astype(np.float32)
+    pulse_ids = np.tile(np.arange(pulses), size // pulses + 1)[:size]
+    train_ids = 1000 + np.arange(size) // pulses
+    with h5py.File(path, 'w') as out_file:
+        out_file.create_dataset(DATA_PATH, data=data, **kwargs)
+        out_file.create_dataset(PULSE_PATH, data=pulse_ids)
+        out_file.create_dataset(TRAIN_PATH, data=train_ids)
+    return data, train_ids, pulse_ids
+
+def test_memmap_contiguous(tmp_path):
+    data, train_ids, _ = cheetah_file(str(tmp_path / 'data.h5'))
+    cheetah_data = CheetahData(str(tmp_path / 'data.h5'))
+    assert isinstance(cheetah_data.data, np.memmap)
+    assert not cheetah_data.data.flags.writeable
+    np.testing.assert_array_equal(cheetah_data.data[5:17], data[5:17])
+    np.testing.assert_array_equal(cheetah_data.train_ids[:], train_ids)
+    # the views are reopened after unpickling
+    assert pickle.loads(pickle.dumps(cheetah_data))._views == {}
+
+@pytest.mark.parametrize('kwargs', [{'chunks': (4, 12, 10)}, {'compression': 'gzip'}])
+def test_memmap_chunked(tmp_path, kwargs):
+    data = cheetah_file(str(tmp_path / 'data.h5'), **kwargs)[0]
+    cheetah_data = CheetahData(str(tmp_path / 'data.h5'))
+    assert isinstance(cheetah_data.data, h5py.Dataset)
+    np.testing.assert_array_equal(cheetah_data.data[5:17], data[5:17])
+
+def test_memmap_disabled(tmp_path, monkeypatch):
+    cheetah_file(str(tmp_path / 'data.h5'))
+    monkeypatch.setattr(CheetahData, 'MMAP', False)
+    assert isinstance(CheetahData(str(tmp_path / 'data.h5')).data, h5py.Dataset)
+
+def shm_segments():
+    return set(name for name in os.listdir('/dev/shm') if name.startswith('psm_'))
+
+def test_shared_data(tmp_path):
+    data, train_ids, pulse_ids = cheetah_file(str(tmp_path / 'data.h5'))
+    cheetah_data = CheetahData(str(tmp_path / 'data.h5'))
+    segments = shm_segments()
+    shared = cheetah_data.get_shared_data()
+    np.testing.assert_array_equal(shared[CheetahData.DATA_KEY], data)
+    np.testing.assert_array_equal(shared[CheetahData.TRAIN_KEY], train_ids)
+    ordered = cheetah_data.get_shared_ordered_data(2)
+    np.testing.assert_array_equal(ordered[CheetahData.DATA_KEY], data[pulse_ids == 2])
+    assert shm_segments() == segments
+
+def test_shared_pool_release(tmp_path, monkeypatch):
+    cheetah_file(str(tmp_path / 'data.h5'))
+    cheetah_data = CheetahData(str(tmp_path / 'data.h5'))
+    segments = shm_segments()
+    def failing_submit(self, *args, **kwargs):
+        raise RuntimeError('submit failed')
+    monkeypatch.setattr(SharedPool, 'submit', failing_submit)
+    with pytest.raises(RuntimeError):
+        cheetah_data.get_shared_data()
+    assert shm_segments() == segments
+
+def test_shared_task_failure(tmp_path):
+    cheetah_file(str(tmp_path / 'data.h5'))
+    cheetah_data = CheetahData(str(tmp_path / 'data.h5'))
+    segments = shm_segments()
+    # the worker fails to read the frames past the end of the file
+    with pytest.raises(IndexError):
+        cheetah_data._get_shared([(0, 10, np.arange(5, 100, 10))])
+    assert shm_segments() == segments
+
+@pytest.mark.parametrize('normalize', [False, True])
+def test_normalized_data(tmp_path, monkeypatch, normalize):
+    # the frames are not detector slabs of the geometry, the ROIs index them directly
+    monkeypatch.setattr(utilities, 'load_geometry', lambda: {'panels': {'p0': {
+        'min_ss': 0, 'max_ss': 511, 'min_fs': 0, 'max_fs': 127}}})
+    data, train_ids, _ = cheetah_file(str(tmp_path / 'data.h5'))
+    data[:, 4:8, 3:6] += 50
+    with h5py.File(str(tmp_path / 'data.h5'), 'r+') as data_file:
+        data_file[DATA_PATH][...] = data
+    bg_roi, pupil_roi = (slice(0, 2), slice(None)), (slice(4, 8), slice(3, 6))
+    limit, pupil_limit = 140, 700
+    result = CheetahData(str(tmp_path / 'data.h5')).get_normalized_data(
+        limit, pupil_limit, normalize, bg_roi, pupil_roi)
+    bg = data[:, 0:2].mean(axis=(1, 2))
+    pupil = data[:, 4:8, 3:6].sum(axis=(1, 2)) - bg * 12
+    hits = (data.max(axis=(1, 2)) > limit) & (pupil > pupil_limit)
+    assert 0 < hits.sum() < hits.size
+    np.testing.assert_array_equal(result[CheetahData.TRAIN_KEY], train_ids[hits])
+    np.testing.assert_allclose(result[CheetahData.BG_KEY], bg[hits], rtol=1e-6)
+    np.testing.assert_allclose(result[CheetahData.PUPIL_KEY], pupil[hits], rtol=1e-6)
+    frames = data[hits]
+    if normalize:
+        frames = (frames - bg[hits, None, None]) / pupil[hits, None, None]
+    np.testing.assert_allclose(result[CheetahData.DATA_KEY], frames, rtol=1e-5)
+
+def test_normalized_zero(tmp_path, monkeypatch):
+    monkeypatch.setattr(utilities, 'load_geometry', lambda: {'panels': {'p0': {
+        'min_ss': 0, 'max_ss': 511, 'min_fs': 0, 'max_fs': 127}}})
+    data, _, _ = cheetah_file(str(tmp_path / 'data.h5'))
+    # a flat frame has no pupil intensity above the background
+    data[3] = 7.
+    with h5py.File(str(tmp_path / 'data.h5'), 'r+') as data_file:
+        data_file[DATA_PATH][...] = data
+    reader = CheetahData(str(tmp_path / 'data.h5'))
+    rois = (slice(0, 2), slice(None)), (slice(4, 8), slice(3, 6))
+    assert reader.get_normalized_data(-1, None, False, *rois)[reader.PUPIL_KEY].size == 40
+    result = reader.get_normalized_data(-1, None, True, *rois)
+    assert result[reader.PUPIL_KEY].size == 39 and np.isfinite(result[reader.DATA_KEY]).all()
+
+@pytest.mark.parametrize('kwargs', [{}, {'chunks': (3, 12, 10)}])
+def test_joined_data(tmp_path, kwargs):
+    data, train_ids, pulse_ids = cheetah_file(str(tmp_path / 'data.h5'), **kwargs)
+    energies = np.random.default_rng(3).uniform(1., 2., (10, 4))
+    energies[2, 1], energies[5, 0] = 0., np.nan
+    with h5py.File(str(tmp_path / 'xgm.h5'), 'w') as xgm_file:
+        xgm_file['train'], xgm_file['energy'] = np.arange(1000, 1010), energies
+    reader = CheetahData(str(tmp_path / 'data.h5'))
+    reader.join(Source('xgm', str(tmp_path / 'xgm.h5'), 'energy', 'train', pulse_step=1))
+    result = reader.get_joined_data(filters={'xgm': (None, 1.9)}, normalize='xgm')
+    values = energies[train_ids - 1000, pulse_ids]
+    with np.errstate(invalid='ignore'):
+        mask = (values <= 1.9) & (values != 0)
+    assert 0 < mask.sum() < mask.size - 2
+    np.testing.assert_array_equal(result[reader.TRAIN_KEY], train_ids[mask])
+    np.testing.assert_array_equal(result['xgm'], values[mask])
+    np.testing.assert_allclose(result[reader.DATA_KEY], data[mask] / values[mask, None, None],
+                               rtol=1e-6)
+
+def test_index_runs():
+    assert index_runs(np.array([], dtype=int)) == []
+    assert index_runs(np.array([2, 3, 4, 7, 9, 10])) == [(2, 5), (7, 8), (9, 11)]
+
+def test_cheetah_run(tmp_path):
+    run_dir = tmp_path / 'r0007-data'
+    run_dir.mkdir()
+    parts = [cheetah_file(str(run_dir / 'XFEL-r0007-c{:02d}.h5'.format(number)), size=size,
+                          seed=number) for number, size in ((10, 8), (2, 12), (0, 9))]
+    # matches the file mask, but has no file number
+    (run_dir / 'XFEL-r0007-cxi.h5').write_bytes(b'')
+    run_path = str(tmp_path / 'r{run:04d}-{tag}')
+    assert [os.path.basename(path) for path in cheetah_files(7, run_path=run_path)] == \
+        ['XFEL-r0007-c00.h5', 'XFEL-r0007-c02.h5', 'XFEL-r0007-c10.h5']
+    run = CheetahRun(7, run_path=run_path)
+    assert run.run_dir == str(run_dir) and run.file_path is None
+    data = np.concatenate([parts[idx][0] for idx in (2, 1, 0)])
+    assert run.size == data.shape[0]
+    # a chunk spanning a file boundary
+    np.testing.assert_array_equal(run.data_chunk(5, 15)[run.DATA_KEY], data[5:15])
+    np.testing.assert_array_equal(run.get_data()[run.DATA_KEY], data)
+    run.save(str(tmp_path / 'out.h5'))
+    with h5py.File(str(tmp_path / 'out.h5'), 'r') as out_file:
+        assert out_file['arguments/run_dir'][()].decode() == str(run_dir)
+        assert len(out_file['arguments/file_paths']) == 3
+        np.testing.assert_array_equal(out_file['data'][run.DATA_KEY][()], data)
+    with pytest.raises(ValueError):
+        cheetah_files(8, run_path=run_path)
@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.epix import epix_histogram, DATA_PATH, TRAIN_PATH, EPIX_FILENAME, OFFSET_PATH, MASK_PATH
+from exfel.utils import kernels
+
+RUN_NUMBER, EPIX_ID = 7, 2
+
+def epix_run(path, n_files=2, size=30, shape=(12, 9), seed=0):
+    rng = np.random.default_rng(seed)
+    offset = rng.normal(100, 3, shape)
+    mask = (rng.random(shape) > 0.1).astype(np.float64)
+    with h5py.File(str(path / 'dark.h5'), 'w') as dark_file:
+        dark_file[OFFSET_PATH], dark_file[MASK_PATH] = offset, mask
+    raw_list, train_list = [], []
+    for file_idx in range(n_files):
+        raw_data = rng.integers(90, 135, (size,) + shape).astype(np.uint16)
+        train_ids = 1000 + (file_idx * size + np.arange(size)) // 4
+        filename = EPIX_FILENAME.format(run_number=RUN_NUMBER, epix_id=EPIX_ID)
+        with h5py.File(str(path / '{:s}-S{:05d}.h5'.format(filename, file_idx)), 'w') as raw_file:
+            raw_file[DATA_PATH.format(epix_id=EPIX_ID)] = raw_data
+            raw_file[TRAIN_PATH.format(epix_id=EPIX_ID)] = train_ids
+        raw_list.append(raw_data)
+        train_list.append(train_ids)
+    data = (np.concatenate(raw_list) - offset) * mask
+    return data, np.concatenate(train_list)
+
+@pytest.fixture(params=['numpy', 'numba'])
+def backend(request, monkeypatch):
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+    monkeypatch.setenv(kernels.BACKEND_ENV, request.param)
+    return request.param
+
+@pytest.mark.parametrize('mode', ['total', 'pixel', 'train'])
+def test_epix_histogram(tmp_path, backend, mode):
+    data, train_ids = epix_run(tmp_path)
+    roi, bins = (0, 30), 60
+    result = epix_histogram(RUN_NUMBER, EPIX_ID, raw_path=str(tmp_path),
+                            dark_path=str(tmp_path / 'dark.h5'), roi=roi, bins=bins, mode=mode,
+                            chunk_size=7, num_workers=2)
+    edges = np.histogram_bin_edges([], bins, range=roi)
+    np.testing.assert_allclose(result['energies'], (edges[1:] + edges[:-1]) / 2)
+    if mode == 'total':
+        np.testing.assert_array_equal(result['hist'], np.histogram(data, bins, range=roi)[0])
+    elif mode == 'pixel':
+        assert result['hist'].dtype == np.int32
+        ref = np.apply_along_axis(lambda values: np.histogram(values, bins, range=roi)[0], 0, data)
+        np.testing.assert_array_equal(result['hist'], np.moveaxis(ref, 0, -1))
+    else:
+        np.testing.assert_array_equal(result['trainId'], np.unique(train_ids))
+        ref = [np.histogram(data[train_ids == train_id], bins, range=roi)[0]
+               for train_id in np.unique(train_ids)]
+        np.testing.assert_array_equal(result['hist'], ref)
+
+def test_wrong_mode(tmp_path):
+    with pytest.raises(ValueError):
+        epix_histogram(RUN_NUMBER, EPIX_ID, raw_path=str(tmp_path), mode='module')
@@ -3,6 +3,29 @@ xfl_dp - EXFEL data process repo
 
 Compatible with Python 3.X
 """
-from .data import CheetahData, RawData, RawModuleData, RawJoined, RawModuleJoined
-from .calib import CalibViewer, run_app, DarkAGIPD, AGIPDCalib
-from . import utils
+import importlib
+
+_SUBMODULES = {'CheetahData': 'data', 'RawData': 'data', 'RawModuleData': 'data',
+               'RawJoined': 'data', 'RawModuleJoined': 'data', 'CheetahRun': 'data',
+               'CalibViewer': 'viewer', 'run_app': 'viewer',
+               'DarkAGIPD': 'calib', 'AGIPDCalib': 'calib',
+               'AzimuthalIntegrator': 'integrate', 'SparseFrames': 'photons',
+               'Pipeline': 'pipeline', 'Source': 'sources',
+               'utils': None}
+
+__all__ = list(_SUBMODULES)
+
+def __getattr__(name):
+    # subsystems are imported on first use, so that the CLI and batch jobs
+    # don't pay for Qt, pyqtgraph and scipy imports they never use
+    if name not in _SUBMODULES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    if _SUBMODULES[name] is None:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        value = getattr(importlib.import_module('.' + _SUBMODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -23,6 +23,21 @@ class ConfigParser(object):
         self.hg_run = self.config.getint('dark', 'hg_run')
         self.mg_run = self.config.getint('dark', 'mg_run')
         self.lg_run = self.config.getint('dark', 'lg_run')
+        self.block_size = self.config.getint('process', 'block_size', fallback=1000)
+        self.prefetch_depth = self.config.getint('process', 'prefetch_depth', fallback=2)
+        self.prefetch_mem = self.config.getfloat('process', 'prefetch_mem', fallback=4096) * 2**20
+        self.prefetch_mode = self.config.get('process', 'prefetch_mode', fallback='thread')
+        self.pipeline_mode = self.config.get('process', 'pipeline_mode', fallback='serial')
+        self.read_workers = self.config.getint('process', 'read_workers', fallback=1)
+        self.calib_workers = self.config.getint('process', 'calib_workers', fallback=1)
+        self.queue_size = self.config.getint('process', 'queue_size', fallback=0) or None
+        self.tolerance = self.config.getfloat('process', 'tolerance', fallback=0.)
+        self.cache_dir = self.config.get('process', 'cache_dir', fallback='')
+        self.common_mode = self.config.get('process', 'common_mode', fallback='') or None
+        self.cache_size = self.config.getfloat('process', 'cache_size', fallback=50) * 2**30
+        self.compress_workers = self.config.getint('process', 'compress_workers', fallback=0)
+        self.reorder_mem = self.config.getfloat('process', 'reorder_mem', fallback=1024) * 2**20
+        self.calib_precision = self.config.getfloat('process', 'calib_precision', fallback=0.)
 
 class JobsParser(object):
     BATCH_CMD = 'sbatch'
@@ -55,7 +70,10 @@ class JobsParser(object):
 class Job(object):
     JOB_NAME = {'list': "list_r{run_number:04d}",
                 'pid': "pid_r{run_number:04d}_pid{pid:02d}_AGIPD{module_id:2d}",
-                'hg': "hg_r{run_number:04d}_pid{pid:02d}_AGIPD{module_id:2d}"}
+                'hg': "hg_r{run_number:04d}_pid{pid:02d}_AGIPD{module_id:2d}",
+                'photons': "ph_r{run_number:04d}_pid{pid:02d}_AGIPD{module_id:2d}",
+                'reduce': "red_r{run_number:04d}_AGIPD{module_id:2d}",
+                'reorder': "pm_r{run_number:04d}_AGIPD{module_id:2d}"}
 
     def __init__(self, jobs_parser, run_type, **kwparams):
         self.job_parser = jobs_parser
@@ -75,7 +93,7 @@ class Job(object):
     def shell_params(self):
         params = [PROJECT_ROOT, str(self.kwparams['run_number']), self.run_type]
         params += ['--config_file', self.job_parser.config.config_file]
-        if self.run_type in ['hg', 'pid']:
+        if self.run_type in ['hg', 'pid', 'photons']:
             try:
                 params += ['--chunk_number', self.kwparams['chunk_number']]
                 params += ['--module_id', self.kwparams['module_id']]
@@ -83,6 +101,13 @@ class Job(object):
             except KeyError as error:
                 error_text = 'Wrong script shell parameters:\n{}'.format(self.kwparams)
                 raise ValueError(error_text) from error
+        elif self.run_type in ['reduce', 'reorder']:
+            try:
+                params += ['--chunk_number', self.kwparams['chunk_number']]
+                params += ['--module_id', self.kwparams['module_id']]
+            except KeyError as error:
+                error_text = 'Wrong script shell parameters:\n{}'.format(self.kwparams)
+                raise ValueError(error_text) from error
         return params
 
     @property
@@ -105,7 +130,7 @@ def process_file(file_path):
 def main():
     parser = argparse.ArgumentParser(description='Batch jobs to Maxwell to process AGIPD data')
     parser.add_argument('run_number', type=int, help='run number')
-    parser.add_argument('run_type', type=str, choices=['pid', 'hg', 'list'], help='Process type')
+    parser.add_argument('run_type', type=str, choices=['pid', 'hg', 'photons', 'reduce', 'reorder', 'list'], help='Process type')
     parser.add_argument('--config_file', type=str, default=CONFIG_PATH, help='Configuration file')
     parser.add_argument('--pulse_id', type=int, help='PulseID to extract data')
     parser.add_argument('--test', action='store_true', help='Testing the module')
@@ -1,19 +1,17 @@
 """
 calib.py - calibration module
 """
-import sys
 import concurrent.futures
+import multiprocessing
+import threading
+from itertools import repeat
 import h5py
 import numpy as np
-import pyqtgraph as pg
-from scipy.optimize import curve_fit
-from scipy.ndimage.filters import median_filter
 from .utils import HIGH_GAIN, MEDIUM_GAIN
-
-try:
-    from PyQt5 import QtCore, QtGui, QtWidgets
-except ImportError:
-    from PyQt4 import QtCore, QtGui, QtWidgets
+from .photons import SparseFrames, photonize
+from .utils import kernels
+from .utils.precision import Precision
+from .utils.preview import save_preview
 
 HG_GAIN = 1 / 68.8
 MG_GAIN = 1 / 1.376
@@ -22,6 +20,15 @@ CELL_ID = 1
 OFFSET_KEY = "AnalogOffset"
 BADMASK_KEY = "Badpixel"
 GAIN_LEVEL_KEY = "DigitalGainLevel"
+ASIC_SHAPE = (64, 64)
+CM_METHODS = ('median', 'peak')
+PEAK_WINDOW = 3
+HIST_CHUNK = 100
+SAMPLE_FRAMES = 32
+SAMPLE_PIXELS = 4096
+SAMPLE_STRATA = 16
+BOOTSTRAP_SIZE = 50
+CONFIDENCE = 0.95
 
 def gauss(arg, amplitude, mu, sigma):
     """
@@ -34,6 +41,60 @@ def gauss(arg, amplitude, mu, sigma):
     """
     return amplitude * np.exp(-(arg - mu)**2 / 2 / sigma**2)
 
+def asic_tiles(frames, asic_shape=ASIC_SHAPE):
+    """
+    Return frames (N, ss, fs) as ASIC tiles (N, n_ss, n_fs, asic_ss * asic_fs)
+    """
+    n_ss, n_fs = frames.shape[-2] // asic_shape[0], frames.shape[-1] // asic_shape[1]
+    tiles = frames.reshape(frames.shape[:-2] + (n_ss, asic_shape[0], n_fs, asic_shape[1]))
+    return np.moveaxis(tiles, -3, -2).reshape(frames.shape[:-2] + (n_ss, n_fs, -1))
+
+def common_mode(frames, mask=None, method='median', dark_limit=50, asic_shape=ASIC_SHAPE):
+    """
+    Estimate and subtract in place the per-frame, per-ASIC common mode baseline
+
+    frames - high gain ADU frames (N, ss, fs)
+    mask - good pixels mask, frame or frames shaped
+    method - 'median' of the dark-ish pixels or the 1 ADU histogram 'peak'
+    dark_limit - only the good pixels within (-dark_limit, dark_limit) are used,
+                 so that photon hits don't skew the baseline
+
+    Returns baselines (N, n_ss, n_fs), 0 for ASICs without dark-ish pixels
+    """
+    if method not in CM_METHODS:
+        raise ValueError('Wrong common mode method: {}'.format(method))
+    tiles = asic_tiles(frames, asic_shape)
+    valid = np.abs(tiles) < dark_limit
+    if mask is not None:
+        valid &= asic_tiles(np.broadcast_to(mask, frames.shape), asic_shape).astype(bool)
+    counts = valid.sum(axis=-1)
+    if method == 'median':
+        values = np.sort(np.where(valid, tiles, np.inf), axis=-1)
+        lower = np.take_along_axis(values, np.maximum(counts - 1, 0)[..., None] // 2, axis=-1)
+        upper = np.take_along_axis(values, counts[..., None] // 2, axis=-1)
+        baselines = ((lower + upper) / 2)[..., 0]
+    else:
+        bins = 2 * int(dark_limit)
+        idxs = np.floor(tiles + dark_limit).astype(np.int64)
+        offsets = np.arange(counts.size).reshape(counts.shape)[..., None] * bins
+        hists = np.bincount((idxs + offsets)[valid], minlength=counts.size * bins)
+        hists = hists.reshape(counts.shape + (bins,)).astype(np.float64)
+        # centroid of the bins around the peak of the smoothed histogram
+        window = np.arange(-PEAK_WINDOW, PEAK_WINDOW + 1)
+        smoothed = sum(np.roll(hists, shift, axis=-1) for shift in window)
+        peaks = np.clip(smoothed.argmax(axis=-1), PEAK_WINDOW, bins - PEAK_WINDOW - 1)
+        near = np.take_along_axis(hists, peaks[..., None] + window, axis=-1)
+        centroids = np.divide((near * window).sum(axis=-1), near.sum(axis=-1),
+                              out=np.zeros(peaks.shape), where=near.sum(axis=-1) > 0)
+        baselines = peaks + centroids + 0.5 - dark_limit
+    baselines = np.where(counts > 0, baselines, 0.)
+    n_ss, n_fs = baselines.shape[-2:]
+    view = frames.reshape(frames.shape[:-2] + (n_ss, asic_shape[0], n_fs, asic_shape[1]))
+    view -= baselines[..., :, None, :, None]
+    if not np.shares_memory(view, frames):
+        frames[...] = view.reshape(frames.shape)
+    return baselines
+
 class ROI(object):
     def __init__(self, lower_bound, higher_bound):
         if lower_bound > higher_bound:
@@ -56,124 +117,6 @@ class ROI(object):
         return ROI(self.lower_bound - base_roi.lower_bound,
                    self.higher_bound - base_roi.lower_bound)
 
-class CalibViewer(QtGui.QWidget):
-    def __init__(self, hist, adus, parent=None):
-        super(CalibViewer, self).__init__(parent=parent)
-        self.hist, self.adus = hist, adus
-        self.full_roi = ROI(self.adus.min(), self.adus.max())
-        self.zero_roi = ROI(self.full_roi.lower_bound,
-                            self.full_roi.lower_bound + 0.4 * self.full_roi.length)
-        self.one_roi = ROI(self.full_roi.higher_bound - 0.55 * self.full_roi.length,
-                           self.full_roi.higher_bound - 0.05 * self.full_roi.length)
-        self.update_fit()
-        self.init_ui()
-
-    @property
-    def zero_adu(self):
-        return self.zero_fit[1]
-
-    @property
-    def one_adu(self):
-        return self.one_fit[1]
-
-    def init_ui(self):
-        self.vbox_layout = QtGui.QVBoxLayout()
-        label_widget = QtGui.QLabel("ADU Histogram")
-        label_widget.setFont(QtGui.QFont('SansSerif', 20))
-        self.vbox_layout.addWidget(label_widget)
-        plot_widget = pg.PlotWidget(name="Plot", background='w')
-        one_hist_plot = plot_widget.plot(self.adus, self.one_hist, atialias=True)
-        one_hist_plot.setPen(color=(255, 0, 0, 150), width=2, style=QtCore.Qt.DashDotLine)
-        hist_plot = plot_widget.plot(self.adus, self.hist, anitalias=True)
-        hist_plot.setPen(color=(0, 0, 0, 255), width=3)
-        self.zero_plot = plot_widget.plot(self.adus,
-                                          gauss(self.adus,
-                                                self.zero_fit[0],
-                                                self.zero_fit[1],
-                                                self.zero_fit[2]),
-                                          antialias=True)
-        self.zero_plot.setPen(color='b', width=2, style=QtCore.Qt.DashLine)
-        self.zero_lr = pg.LinearRegionItem(values=list(self.zero_roi.bounds),
-                                           bounds=list(self.full_roi.bounds))
-        self.zero_lr.setBrush(QtGui.QBrush(QtGui.QColor(0, 0, 255, 50)))
-        self.zero_lr.sigRegionChanged.connect(self.update_zero_roi)
-        plot_widget.addItem(self.zero_lr)
-        self.one_plot = plot_widget.plot(self.adus,
-                                         gauss(self.adus,
-                                               self.one_fit[0],
-                                               self.one_fit[1],
-                                               self.one_fit[2]),
-                                         antialias=True)
-        self.one_plot.setPen(color='r', width=2, style=QtCore.Qt.DashLine)
-        self.one_lr = pg.LinearRegionItem(values=list(self.one_roi.bounds),
-                                          bounds=list(self.full_roi.bounds))
-        self.one_lr.setBrush(QtGui.QBrush(QtGui.QColor(255, 0, 0, 50)))
-        self.one_lr.sigRegionChanged.connect(self.update_one_roi)
-        plot_widget.addItem(self.one_lr)
-        self.vbox_layout.addWidget(plot_widget)
-        hbox = QtGui.QHBoxLayout()
-        update_button = QtGui.QPushButton("Update Plot")
-        update_button.clicked.connect(self.update_plot)
-        hbox.addWidget(update_button)
-        exit_button = QtGui.QPushButton("Done")
-        exit_button.clicked.connect(self.close)
-        hbox.addWidget(exit_button)
-        hbox.addStretch(1)
-        self.zero_label = QtGui.QLabel("Zero ADU: {:5.1f}".format(self.zero_adu))
-        hbox.addWidget(self.zero_label)
-        self.one_label = QtGui.QLabel("One ADU: {:5.1f}".format(self.one_adu))
-        hbox.addWidget(self.one_label)
-        self.vbox_layout.addLayout(hbox)
-        self.setLayout(self.vbox_layout)
-        self.setGeometry(0, 0, 1280, 720)
-        self.setWindowTitle('Photon Calibration')
-        self.show()
-
-    def update_zero_roi(self):
-        self.zero_roi = ROI(*self.zero_lr.getRegion())
-
-    def update_one_roi(self):
-        self.one_roi = ROI(*self.one_lr.getRegion())
-
-    def update_fit(self):
-        zero_slice = self.zero_roi.relative_roi(self.full_roi).index
-        zero_max = self.adus[zero_slice][self.hist[zero_slice].argmax()]
-        self.zero_fit, _ = curve_fit(gauss,
-                                     self.adus[zero_slice],
-                                     self.hist[zero_slice],
-                                     bounds=([0, zero_max - 10, 0], [np.inf, zero_max + 10, np.inf]))
-        one_slice = self.one_roi.relative_roi(self.full_roi).index
-        self.one_hist = (self.hist - gauss(self.adus,
-                                           self.zero_fit[0],
-                                           self.zero_fit[1],
-                                           self.zero_fit[2]))
-        one_max = self.adus[one_slice][self.one_hist[one_slice].argmax()]
-        self.one_fit, _ = curve_fit(gauss,
-                                    self.adus[one_slice],
-                                    self.one_hist[one_slice],
-                                    bounds=([0, one_max - 10, 0], [np.inf, one_max + 10, np.inf]))
-
-    def update_plot(self):
-        self.update_fit()
-        self.zero_plot.setData(self.adus, gauss(self.adus,
-                                                self.zero_fit[0],
-                                                self.zero_fit[1],
-                                                self.zero_fit[2]))
-        self.one_plot.setData(self.adus, gauss(self.adus,
-                                               self.one_fit[0],
-                                               self.one_fit[1],
-                                               self.one_fit[2]))
-        self.zero_label.setText("Zero ADU: {:5.1f}".format(self.zero_adu))
-        self.one_label.setText("One ADU: {:5.1f}".format(self.one_adu))
-
-def run_app(hist, adus):
-    app = QtCore.QCoreApplication.instance()
-    if app is None:
-        app = QtWidgets.QApplication(sys.argv)
-    main_win = CalibViewer(hist, adus)
-    app.exec_()
-    return main_win.zero_adu, main_win.one_adu
-
 class DarkAGIPD(object):
     OFFSET_KEY = OFFSET_KEY
     BADMASK_KEY = BADMASK_KEY
@@ -181,8 +124,18 @@ class DarkAGIPD(object):
     MODULE_SHAPE = (512, 128)
 
     def __init__(self, filename, mask_inv=True):
+        self.filename, self.mask_inv = filename, mask_inv
         self.data_file = h5py.File(filename, 'r')
-        self.mask_inv = mask_inv
+
+    def __getstate__(self):
+        # the file is reopened in every worker instead of being pickled
+        state = self.__dict__.copy()
+        del state['data_file']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data_file = h5py.File(self.filename, 'r')
 
     def offset(self, gain_mode, cell_id, module_id):
         return self.data_file[self.OFFSET_KEY][gain_mode, cell_id, module_id]
@@ -199,103 +152,354 @@ class AGIPDCalib(object):
     CELL_ID = CELL_ID
     FLAT_ROI = (0, 20)
 
-    def __init__(self, raw_data, raw_gain, dark, module_id):
+    def __init__(self, raw_data, raw_gain, dark, module_id, common_mode=None):
         self.raw_data, self.raw_gain, self.dark, self.module_id = raw_data, raw_gain, dark, module_id
-        self._init_adu()
-        self._flat_correct()
-        self._init_mask()
-        self.data = ((self.adu * self.mask).T * self.GAIN).T
-
-    def _init_adu(self):
-        hg_adus = self.raw_data - self.dark.offset(HIGH_GAIN, self.CELL_ID, self.module_id)
-        mg_adus = self.raw_data - self.dark.offset(MEDIUM_GAIN, self.CELL_ID, self.module_id)
-        self.adu = np.stack((hg_adus, mg_adus))
-
-    def _flat_correct(self):
-        self.zero_levels = self.adu[0, :, self.FLAT_ROI[0]:self.FLAT_ROI[1]].mean(axis=(1, 2))
-        self.adu[0] = (self.adu[0].T - self.zero_levels).T
-
-    def _init_mask(self):
-        hg_mask = (self.raw_gain < self.dark.gain_level(MEDIUM_GAIN,
-                                                        self.CELL_ID,
-                                                        self.module_id)).astype(np.uint8)
-        mg_mask = (self.raw_gain > self.dark.gain_level(MEDIUM_GAIN,
-                                                        self.CELL_ID,
-                                                        self.module_id)).astype(np.uint8)
-        bad_mask = self.dark.bad_mask(HG_GAIN, self.CELL_ID, self.module_id)
-        self.mask = np.stack((hg_mask, mg_mask)) * bad_mask
+        self.common_mode = common_mode
+        self._calibrate()
+
+    def _calibrate(self):
+        # offsets, flat correction, gain masks and gain factors in a single kernel
+        calib = kernels.calibrate(self.raw_data, self.raw_gain,
+                                  self.dark.offset(HIGH_GAIN, self.CELL_ID, self.module_id),
+                                  self.dark.offset(MEDIUM_GAIN, self.CELL_ID, self.module_id),
+                                  self.dark.gain_level(MEDIUM_GAIN, self.CELL_ID, self.module_id),
+                                  self.dark.bad_mask(HIGH_GAIN, self.CELL_ID, self.module_id),
+                                  None if self.common_mode else self.FLAT_ROI, self.GAIN)
+        self.adu, self.mask, self.data, self.zero_levels = calib
+        if self.common_mode:
+            # per-ASIC baselines replace the whole module flat correction
+            self.cm_levels = common_mode(self.adu[0], self.mask[0], self.common_mode)
+            np.multiply(self.adu[0], self.mask[0], out=self.data[0])
+            self.data[0] *= self.GAIN[0]
 
     @property
     def calib_data(self):
         return self.data.sum(axis=0)
 
-    def save_data(self, out_file):
-        data_group = out_file.create_group('MODULE{:02d}'.format(self.module_id))
-        data_group.create_dataset('adu', data=self.adu)
-        data_group.create_dataset('mask', data=self.mask)
-        data_group.create_dataset('data', data=self.data)
+    @property
+    def group_name(self):
+        return 'MODULE{:02d}'.format(self.module_id)
+
+    def save_data(self, out_file, policy=None, preview=False, train_ids=None):
+        """
+        Write the calibrated frames in the smallest dtypes allowed by the precision
+        policy, lossless by default, the binned preview pyramid of calib_data is
+        written too if preview, with per-train thumbnails if train_ids are given
+        """
+        policy = policy or Precision()
+        data_group = out_file.create_group(self.group_name)
+        for key, value in (('adu', self.adu), ('mask', self.mask), ('data', self.data)):
+            policy.create_dataset(data_group, key, value, compression='gzip')
+        if preview:
+            save_preview(data_group, self.calib_data, train_ids)
+
+    def photons(self, zero_adu, one_adu):
+        """
+        Return high gain frames converted to photon counts as SparseFrames
+        """
+        return SparseFrames.from_dense(photonize(self.adu[0] * self.mask[0], zero_adu, one_adu))
+
+    def save_photons(self, out_file, zero_adu, one_adu):
+        data_group = out_file.require_group(self.group_name)
+        photon_group = data_group.create_group('photons')
+        photon_group.attrs['zero_adu'], photon_group.attrs['one_adu'] = zero_adu, one_adu
+        self.photons(zero_adu, one_adu).save(photon_group)
+
+    def append_data(self, out_file, policy=None):
+        """
+        Append the calibrated frames to the output file, creating resizable
+        datasets on the first call, used to write data block by block
+        """
+        policy = policy or Precision()
+        data_group = out_file.require_group(self.group_name)
+        for key, value in (('adu', self.adu), ('mask', self.mask), ('data', self.data)):
+            policy.append(data_group, key, value, axis=1, compression='gzip')
+
+def fit_levels(hist, adus, zero_roi, one_roi):
+    """
+    Fit the zero and one photon peaks of an ADU histogram with gaussians, the one
+    photon peak is fitted after subtracting the zero photon one
+
+    hist - histogram values
+    adus - histogram bin centers
+    zero_roi, one_roi - ADU ranges (lower, higher) of the zero and one photon peaks
+
+    Returns zero and one photon peak gaussian parameters (amplitude, mu, sigma)
+    and the histogram with the zero photon peak subtracted
+    """
+    from scipy.optimize import curve_fit
+    zero_idx = (adus > zero_roi[0]) & (adus < zero_roi[1])
+    zero_max = adus[zero_idx][hist[zero_idx].argmax()]
+    zero_fit, _ = curve_fit(gauss,
+                            adus[zero_idx],
+                            hist[zero_idx],
+                            bounds=([0, zero_max - 10, 0], [np.inf, zero_max + 10, np.inf]))
+    one_hist = hist - gauss(adus, zero_fit[0], zero_fit[1], zero_fit[2])
+    one_idx = (adus > one_roi[0]) & (adus < one_roi[1])
+    one_max = adus[one_idx][one_hist[one_idx].argmax()]
+    one_fit, _ = curve_fit(gauss,
+                           adus[one_idx],
+                           one_hist[one_idx],
+                           bounds=([0, one_max - 10, 0], [np.inf, one_max + 10, np.inf]))
+    return zero_fit, one_fit, one_hist
+
+def log_scale(hist):
+    hist = np.where(hist == 0, 1, hist)
+    return np.log(hist) - np.log(hist.min())
+
+def fill_zero_bin(hist, roi):
+    """
+    Replace the bin of exact zeros (masked pixels) with the mean of its neighbours
+    """
+    if roi[0] < 0 < roi[1]:
+        zero_peak = int(abs(roi[0]))
+        hist[zero_peak] = (hist[zero_peak - 1] + hist[zero_peak + 1]) / 2
+    return hist
+
+def frame_hist(frames, roi=(-200, 100)):
+    bins = int(roi[1] - roi[0])
+    hist = fill_zero_bin(kernels.histogram(frames, bins, roi), roi)
+    edges = np.linspace(roi[0], roi[1], bins + 1)
+    return hist, (edges[:-1] + edges[1:]) / 2
+
+def frame_zero_adu(frame, zero_verge):
+    hist, adus = frame_hist(frame, roi=(frame.min(), zero_verge))
+    return adus[hist.argmax()]
+
+def stratified_order(size, n_strata, rng):
+    """
+    Return a random order of range(size) in which every prefix takes the indices
+    evenly from n_strata contiguous strata
+    """
+    ranks = np.empty(size)
+    for block in np.array_split(np.arange(size), max(min(n_strata, size), 1)):
+        ranks[block] = (rng.permutation(block.size) + rng.random()) / block.size
+    return np.argsort(ranks, kind='stable')
+
+def stratified_pixels(n_total, n_pixels, size, rng):
+    """
+    Return (size, n_pixels) flat pixel indices, a random pixel from every one of
+    n_pixels equal strata of the frame for each of size frames
+    """
+    n_pixels = min(n_pixels, n_total)
+    strata = np.arange(n_pixels) + rng.random((size, n_pixels))
+    return (strata * n_total // n_pixels).astype(np.int64)
+
+def fit_sample(frame_hists, adus, zero_roi, one_roi, scale=1.):
+    """
+    Fit the zero and one photon levels to the sum of per-frame histograms the
+    same way HGData.calibrate does, the sum is scaled by scale to the counts of
+    the full data first since the fits are done in log scale
+    """
+    from scipy.ndimage import median_filter
+    hist = median_filter(log_scale(scale * frame_hists.sum(axis=0)), 3)
+    zero_fit, one_fit, _ = fit_levels(hist, adus, zero_roi, one_roi)
+    return zero_fit[1], one_fit[1]
+
+class LevelsEstimate(object):
+    """
+    Zero and one photon ADU levels estimated from a sample of the frames
+
+    zero_adu, one_adu - levels fitted to the histogram of the whole sample
+    zero_interval, one_interval - (lower, higher) bootstrap confidence intervals
+    frames - number of sampled frames
+    pixels - number of sampled pixels per frame
+    """
+    def __init__(self, zero_adu, one_adu, zero_interval, one_interval, frames, pixels):
+        self.zero_adu, self.one_adu = zero_adu, one_adu
+        self.zero_interval, self.one_interval = zero_interval, one_interval
+        self.frames, self.pixels = frames, pixels
+
+    @property
+    def precision(self):
+        """
+        Largest half width of the confidence intervals
+        """
+        return max((self.zero_interval[1] - self.zero_interval[0]) / 2,
+                   (self.one_interval[1] - self.one_interval[0]) / 2)
+
+    def __str__(self):
+        return ("Zero ADU: {:5.1f} [{:5.1f}, {:5.1f}], One ADU: {:5.1f} [{:5.1f}, {:5.1f}], "
+                "{:d} frames".format(self.zero_adu, self.zero_interval[0], self.zero_interval[1],
+                                     self.one_adu, self.one_interval[0], self.one_interval[1],
+                                     self.frames))
 
 class HGData(object):
+    """
+    High gain ADU frames for the photon calibration
+
+    data - high gain ADU frames
+    optimize - subtract the zero ADU level of every frame right away, otherwise
+               it's done on the first histogram
+    """
     ZERO_VERGE = 50
 
-    def __init__(self, data):
-        self.data = data
-        self.optimize()
+    def __init__(self, data, optimize=True):
+        self.data, self.zero_adus = data, None
+        if optimize:
+            self.optimize()
 
     @property
     def size(self):
         return self.data.shape[0]
 
     def hist_frame(self, idx, roi=(-200, 100)):
-        hist, edges = np.histogram(self.data[idx].ravel(), roi[1] - roi[0], range=roi)
-        if roi[0] < 0 < roi[1]:
-            zero_peak = abs(roi[0])
-            hist[zero_peak] = (hist[zero_peak - 1] + hist[zero_peak + 1]) / 2
-        return hist, (edges[:-1] + edges[1:]) / 2
+        return frame_hist(self.data[idx], roi)
 
     def zero_adu(self, idx):
-        hist, adus = self.hist_frame(idx, roi=(self.data[idx].min(), self.ZERO_VERGE))
-        return adus[hist.argmax()]
+        return frame_zero_adu(self.data[idx], self.ZERO_VERGE)
+
+    def optimize_chunks(self, chunk_size=HIST_CHUNK):
+        """
+        Subtract the zero ADU level of every frame chunk by chunk, yield every
+        corrected chunk of frames, the data is replaced once all the chunks are done
+        """
+        data, zero_adus = np.empty(self.data.shape), np.empty(self.size)
+        context = None
+        if threading.current_thread() is not threading.main_thread():
+            # forking a multithreaded process is unsafe, the viewer runs this in a worker thread
+            context = multiprocessing.get_context('forkserver')
+        with concurrent.futures.ProcessPoolExecutor(mp_context=context) as executor:
+            for start in range(0, self.size, chunk_size):
+                stop = min(start + chunk_size, self.size)
+                zero_adus[start:stop] = list(executor.map(frame_zero_adu, self.data[start:stop],
+                                                          repeat(self.ZERO_VERGE)))
+                data[start:stop] = (self.data[start:stop].T - zero_adus[start:stop]).T
+                yield data[start:stop]
+        self.data, self.zero_adus = data, zero_adus
 
     def optimize(self):
-        futures = []
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            for idx in range(self.size):
-                futures.append(executor.submit(self.zero_adu, idx))
-        self.zero_adus = np.array([fut.result() for fut in futures])
-        self.data = (self.data.T - self.zero_adus).T
+        for _ in self.optimize_chunks():
+            pass
+
+    def iter_hist(self, roi=(-100, 200), chunk_size=HIST_CHUNK):
+        """
+        Iterate over the histogram of the frames accumulated chunk by chunk, the
+        frames are optimized on the way if they weren't yet
+
+        Yields histogram, bin centers and number of frames accumulated
+        """
+        if self.zero_adus is None:
+            chunks = self.optimize_chunks(chunk_size)
+        else:
+            chunks = (self.data[start:start + chunk_size] for start in range(0, self.size, chunk_size))
+        bins = int(roi[1] - roi[0])
+        edges = np.linspace(roi[0], roi[1], bins + 1)
+        hist, count = np.zeros(bins, dtype=np.int64), 0
+        for chunk in chunks:
+            hist += kernels.histogram(chunk, bins, roi)
+            count += chunk.shape[0]
+            yield fill_zero_bin(hist.copy(), roi), (edges[:-1] + edges[1:]) / 2, count
 
     def histogram(self, roi=(-100, 200)):
+        if self.zero_adus is None:
+            self.optimize()
         return self.hist_frame(slice(0, self.size), roi=roi)
 
+    def photonize(self, zero_adu, one_adu):
+        """
+        Return frames converted to photon counts as SparseFrames, zero_adu and
+        one_adu are the levels returned by calibrate or calibrate_gui, the frames
+        are optimized first if they weren't yet
+        """
+        if self.zero_adus is None:
+            self.optimize()
+        return SparseFrames.from_dense(photonize(self.data, zero_adu, one_adu))
+
     def log_hist(self, roi=(-100, 200)):
         hist, adus = self.histogram(roi)
-        hist[hist == 0] = 1
-        return np.log(hist) - np.log(hist.min()), adus
-
-    def calibrate_gui(self, roi=(-100, 200)):
-        hist, adus = self.log_hist(roi)
-        zero_adu, one_adu = run_app(median_filter(hist, 3), adus)
-        return zero_adu, one_adu
+        return log_scale(hist), adus
+
+    def calibrate_gui(self, roi=(-100, 200), chunk_size=HIST_CHUNK):
+        """
+        Open the calibration viewer right away, the histogram is accumulated in
+        the background and the plot is updated after every chunk of frames
+        """
+        from scipy.ndimage import median_filter
+        from .viewer import run_app
+        source = ((median_filter(log_scale(hist), 3), adus, count)
+                  for hist, adus, count in self.iter_hist(roi, chunk_size))
+        bins = int(roi[1] - roi[0])
+        edges = np.linspace(roi[0], roi[1], bins + 1)
+        return run_app(None, (edges[:-1] + edges[1:]) / 2, source=source)
 
     def calibrate(self, full_roi=(-100, 200), zero_roi=(-50, 50), one_roi=(30, 100)):
+        from scipy.ndimage import median_filter
         hist, adus = self.log_hist(full_roi)
-        hist = median_filter(hist, 3)
-        zero_slice = slice(int(zero_roi[0] - full_roi[0]), int(zero_roi[1] - full_roi[0]))
-        zero_max = adus[zero_slice][hist[zero_slice].argmax()]
-        zero_fit, _ = curve_fit(gauss,
-                                adus[zero_slice],
-                                hist[zero_slice],
-                                bounds=([0, zero_max - 10, 0], [np.inf, zero_max + 10, np.inf]))
-        one_slice = slice(int(one_roi[0] - full_roi[0]), int(one_roi[1] - full_roi[0]))
-        one_hist = (hist - gauss(adus, zero_fit[0], zero_fit[1], zero_fit[2]))[one_slice]
-        one_max = adus[one_slice][one_hist.argmax()]
-        one_fit, _ = curve_fit(gauss,
-                               adus[one_slice],
-                               one_hist,
-                               bounds=([0, one_max - 10, 0], [np.inf, one_max + 10, np.inf]))
+        zero_fit, one_fit, _ = fit_levels(median_filter(hist, 3), adus, zero_roi, one_roi)
         return zero_fit[1], one_fit[1]
 
+    def sample_hists(self, frame_idxs, pixels, roi, rng):
+        """
+        Return the histograms of stratified pixel samples of the frames, the zero
+        ADU levels of the frames are subtracted if they weren't yet
+        """
+        frame_idxs = np.sort(frame_idxs)
+        frames = np.asarray(self.data[frame_idxs])
+        pixel_idxs = stratified_pixels(frames[0].size, pixels, frame_idxs.size, rng)
+        values = np.take_along_axis(frames.reshape(frame_idxs.size, -1), pixel_idxs,
+                                    axis=1).astype(np.float64)
+        if self.zero_adus is None:
+            values = (values.T - [frame_zero_adu(frame, self.ZERO_VERGE) for frame in frames]).T
+        bins = int(roi[1] - roi[0])
+        return np.stack([fill_zero_bin(kernels.histogram(row, bins, roi), roi) for row in values])
+
+    def estimate(self, full_roi=(-100, 200), zero_roi=(-50, 50), one_roi=(30, 100), precision=1.,
+                 frames=SAMPLE_FRAMES, pixels=SAMPLE_PIXELS, strata=SAMPLE_STRATA,
+                 n_boot=BOOTSTRAP_SIZE, confidence=CONFIDENCE, seed=None):
+        """
+        Estimate the zero and one photon ADU levels from stratified random samples
+        of frames and pixels, the sample is doubled until the confidence intervals
+        are narrower than precision or all the frames are sampled
+
+        precision - target half width of the confidence intervals in ADU
+        frames - initial number of sampled frames, drawn evenly from strata
+                 contiguous parts of the run
+        pixels - number of sampled pixels per frame, one from every equal part of the frame
+        n_boot - number of bootstrap resamples of the sampled frames
+        confidence - confidence level of the intervals
+
+        Returns LevelsEstimate
+        """
+        rng = np.random.default_rng(seed)
+        order = stratified_order(self.size, strata, rng)
+        edges = np.linspace(full_roi[0], full_roi[1], int(full_roi[1] - full_roi[0]) + 1)
+        adus = (edges[:-1] + edges[1:]) / 2
+        frame_hists, size = np.zeros((0, adus.size), dtype=np.int64), min(frames, self.size)
+        n_pixels = min(pixels, int(np.prod(self.data.shape[1:])))
+        quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+        while True:
+            frame_hists = np.concatenate((frame_hists, self.sample_hists(
+                order[frame_hists.shape[0]:size], pixels, full_roi, rng)))
+            scale = self.size * np.prod(self.data.shape[1:]) / (size * n_pixels)
+            try:
+                zero_adu, one_adu = fit_sample(frame_hists, adus, zero_roi, one_roi, scale)
+            except (ValueError, RuntimeError):
+                # the sample is too sparse to fit, a larger one or all the data is used
+                if size < self.size:
+                    size = min(2 * size, self.size)
+                    continue
+                zero_adu, one_adu = self.calibrate(full_roi, zero_roi, one_roi)
+                return LevelsEstimate(zero_adu, one_adu, (zero_adu, zero_adu), (one_adu, one_adu),
+                                      self.size, int(np.prod(self.data.shape[1:])))
+            # frames are resampled as a whole, the pixels of a frame share its zero level
+            levels = []
+            for weights in rng.multinomial(size, np.full(size, 1. / size), size=n_boot):
+                try:
+                    levels.append(fit_sample(weights[:, None] * frame_hists, adus, zero_roi,
+                                             one_roi, scale))
+                except (ValueError, RuntimeError):
+                    continue
+            if len(levels) > n_boot // 2:
+                zero_interval, one_interval = np.quantile(levels, quantiles, axis=0).T
+            else:
+                zero_interval, one_interval = (-np.inf, np.inf), (-np.inf, np.inf)
+            estimate = LevelsEstimate(zero_adu, one_adu, tuple(zero_interval), tuple(one_interval),
+                                      size, n_pixels)
+            if estimate.precision <= precision or size == self.size:
+                return estimate
+            size = min(2 * size, self.size)
+
     # def mg_calibrate(self, rel_roi=(20, 60)):
     #     hg_totals = np.sum(np.array(self.hg_data <= 0, dtype=np.uint32), axis=0)
     #     mg_totals = np.sum(np.array(self.mg_data <= 0, dtype=np.uint32), axis=0)
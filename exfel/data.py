@@ -2,11 +2,24 @@
 wrapper.py - a module with main data processing class implementations
 """
 import argparse
+import glob
 import os
+import re
 import concurrent.futures
+from contextlib import nullcontext
+from multiprocessing import shared_memory
 import numpy as np
 import h5py
 from . import utils
+from .utils import metrics, kernels
+from .utils.precision import Precision
+from .utils.cache import BlockCache, file_identity, cache_key
+from .utils.chunk_writer import ChunkWriter, deflated, inflate_frames, read_frames
+from .utils.prefetch import Prefetcher
+from .utils.preview import save_preview
+from .sources import source_mask
+from .reorder import read_pulse_index
+from .reduce import PulseReducer
 
 DATA_PATH = "entry_1/instrument_1/detector_1/detector_corrected/data"
 TRAIN_PATH = "/instrument/trainID"
@@ -16,10 +29,40 @@ RAW_TRAIN_PATH = "/INSTRUMENT/MID_DET_AGIPD1M-1/DET/{:d}CH0:xtdf/image/trainId"
 RAW_PULSE_PATH = "/INSTRUMENT/MID_DET_AGIPD1M-1/DET/{:d}CH0:xtdf/image/pulseId"
 RAW_GAIN_PATH = "/INSTRUMENT/MID_DET_AGIPD1M-1/DET/{:d}CH0:xtdf/image/gain"
 
+def memmap_dataset(dataset):
+    """
+    Return a read-only np.memmap view of a contiguous uncompressed HDF5 dataset,
+    None if the dataset layout doesn't allow it (chunked, compressed, external,
+    not yet allocated or non-numeric)
+    """
+    if dataset.chunks is not None or dataset.external or dataset.file.driver != 'sec2':
+        return None
+    if dataset.dtype.kind not in 'biuf' or not dataset.shape:
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype,
+                     offset=offset, shape=dataset.shape)
+
+def index_runs(idxs):
+    """
+    Return the (start, stop) ranges of the consecutive indices in idxs
+    """
+    if not idxs.size:
+        return []
+    breaks = np.flatnonzero(np.diff(idxs) != 1) + 1
+    starts = idxs[np.concatenate(([0], breaks))]
+    stops = idxs[np.concatenate((breaks - 1, [idxs.size - 1]))] + 1
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
 class Pool(object):
-    def __init__(self, num_workers=utils.CORES_COUNT):
+    def __init__(self, num_workers=utils.CORES_COUNT, metrics=None):
         self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
         self.futures = []
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.metrics.num_workers = num_workers
 
     def __enter__(self):
         return self
@@ -28,26 +71,136 @@ class Pool(object):
         return self.executor.__exit__(exc_type, exc_value, exc_tb)
 
     def submit(self, func, *args, **kwargs):
-        self.futures.append(self.executor.submit(func, *args, **kwargs))
+        if self.metrics is None:
+            self.futures.append(self.executor.submit(func, *args, **kwargs))
+        else:
+            name = '{}{}'.format(getattr(func, '__name__', 'task'), args)
+            self.futures.append(self.executor.submit(metrics.run_task, func, name,
+                                                     self.metrics.profile_dir,
+                                                     *args, **kwargs))
 
     def shutdown(self, wait=True):
         self.executor.shutdown(wait)
 
+    def result(self, fut):
+        if self.metrics is None:
+            return fut.result()
+        chunk, record = fut.result()
+        self.metrics.add_task(record)
+        return chunk
+
     def get(self, out_dict):
         for fut in self.futures:
-            chunk = fut.result()
+            chunk = self.result(fut)
             for key in chunk:
                 out_dict[key].append(chunk[key])
         for key in out_dict:
             out_dict[key] = np.concatenate(out_dict[key])
+        if self.metrics is not None:
+            self.metrics.count(frames_out=len(next(iter(out_dict.values()))))
+        return out_dict
+
+class SharedArray(np.ndarray):
+    """
+    np.ndarray backed by a shared memory block, the block is kept mapped as long
+    as the array or any of its views is alive
+    """
+    def __new__(cls, shm, shape, dtype):
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf).view(cls)
+        arr.shm = shm
+        return arr
+
+    def __array_finalize__(self, obj):
+        pass
+
+    def __reduce__(self):
+        return np.asarray(self).__reduce__()
+
+class SharedPool(Pool):
+    """
+    Process pool with shared memory result transport: the parent preallocates
+    output buffers, workers write their results straight into their slices and
+    return only small metadata. The buffers are released if the pool exits
+    with an exception or if any task fails, allocate them inside the with block
+    """
+    def __init__(self, num_workers=utils.CORES_COUNT, metrics=None):
+        super(SharedPool, self).__init__(num_workers, metrics)
+        self.buffers = {}
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            return super(SharedPool, self).__exit__(exc_type, exc_value, exc_tb)
+        finally:
+            if exc_type is not None:
+                self.release()
+
+    def allocate(self, key, shape, dtype):
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        self.buffers[key] = (shared_memory.SharedMemory(create=True, size=size), shape, dtype)
+
+    @property
+    def specs(self):
+        return dict((key, (shm.name, shape, dtype.str))
+                    for key, (shm, shape, dtype) in self.buffers.items())
+
+    def release(self):
+        """
+        Close and unlink all the shared memory buffers
+        """
+        for shm, _, _ in self.buffers.values():
+            shm.close()
+            shm.unlink()
+        self.buffers = {}
+
+    def get(self, out_dict=None):
+        out_dict = {} if out_dict is None else out_dict
+        try:
+            for fut in self.futures:
+                self.result(fut)
+        except BaseException:
+            self.release()
+            raise
+        for key, (shm, shape, dtype) in self.buffers.items():
+            out_dict[key] = SharedArray(shm, shape, dtype)
+        # the blocks stay mapped by the arrays until they are garbage collected
+        for shm, _, _ in self.buffers.values():
+            shm.unlink()
+        if self.metrics is not None and out_dict:
+            self.metrics.count(frames_out=len(next(iter(out_dict.values()))))
         return out_dict
 
+def attach_shared(specs):
+    """
+    Attach to the shared memory buffers allocated by SharedPool in a worker
+    """
+    blocks = {}
+    try:
+        for key, (name, _, _) in specs.items():
+            blocks[key] = shared_memory.SharedMemory(name=name)
+    except BaseException:
+        for block in blocks.values():
+            block.close()
+        raise
+    arrays = dict((key, np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[key].buf))
+                  for key, (_, shape, dtype) in specs.items())
+    return blocks, arrays
+
 class CheetahData(object):
     OUT_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), utils.OUT_PATH)
     PIDS = 4 * np.arange(0, 176)
+    BLOCK_SIZE = 1000
     DATA_KEY = utils.DATA_KEY
     PULSE_KEY = utils.PULSE_KEY
     TRAIN_KEY = utils.TRAIN_KEY
+    BG_KEY = utils.BG_KEY
+    PUPIL_KEY = utils.PUPIL_KEY
+    MMAP = True
+    PRECISION = Precision()
+    metrics = None
+    cache = None
+    writer = None
+    sources = ()
 
     def __init__(self,
                  file_path,
@@ -56,6 +209,13 @@ class CheetahData(object):
                  train_path=TRAIN_PATH):
         self.file_path = file_path
         self.data_path, self.pulse_path, self.train_path = data_path, pulse_path, train_path
+        self._views = {}
+
+    def __getstate__(self):
+        # memory maps are reopened in every worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_views'] = {}
+        return state
 
     @property
     def size(self):
@@ -67,37 +227,158 @@ class CheetahData(object):
 
     @property
     def data_file(self):
-        return h5py.File(self.file_path, 'r')
+        with metrics.stage('open'):
+            return h5py.File(self.file_path, 'r')
+
+    def dataset(self, path):
+        """
+        Return a dataset at the given path, served as a zero-copy np.memmap view
+        if the dataset is stored contiguous and uncompressed, h5py.Dataset otherwise
+        """
+        if path not in self._views:
+            dataset = self.data_file[path]
+            view = memmap_dataset(dataset) if self.MMAP else None
+            if view is None:
+                return dataset
+            self._views[path] = view
+        return self._views[path]
 
     @property
     def data(self):
-        return self.data_file[self.data_path]
+        return self.dataset(self.data_path)
 
     @property
     def train_ids(self):
-        return self.data_file[self.train_path]
+        return self.dataset(self.train_path)
 
     @property
     def pulse_ids(self):
-        return self.data_file[self.pulse_path]
+        return self.dataset(self.pulse_path)
 
     @property
     def chunks(self):
         limits = np.linspace(0, self.size, utils.CORES_COUNT + 1).astype(int)
         return list(zip(limits[:-1], limits[1:]))
 
+    def blocks(self, block_size=None):
+        block_size = block_size or self.BLOCK_SIZE
+        limits = np.append(np.arange(0, self.size, block_size), self.size)
+        return list(zip(limits[:-1], limits[1:]))
+
+    def pulse_index(self):
+        """
+        Return a dictionary of pulse ID (first frame, number of frames) pairs if
+        the file is written by reorder.reorder_pulse_major, None otherwise
+        """
+        return read_pulse_index(self.data_file)
+
+    def pulse_blocks(self, pid, block_size=None):
+        """
+        Return the blocks holding the frames of pulse ID pid, a single contiguous
+        range in a pulse-major file, all the blocks otherwise
+        """
+        index = self.pulse_index()
+        if index is None:
+            return self.blocks(block_size)
+        block_size = block_size or self.BLOCK_SIZE
+        first, count = index.get(int(pid), (0, 0))
+        limits = np.append(np.arange(first, first + count, block_size), first + count)
+        return list(zip(limits[:-1], limits[1:]))
+
     def empty_dict(self):
         return dict([(self.DATA_KEY, []),
                      (self.PULSE_KEY, []),
                      (self.TRAIN_KEY, [])])
 
+    def prefetch(self, chunk_func=None, args=(), block_size=None, depth=2, mem_cap=None,
+                 mode='thread', pid=None):
+        """
+        Return an iterator over the file in blocks of block_size frames, the next
+        blocks are read in the background while the current one is processed
+
+        chunk_func - chunk reading method, data_chunk by default
+        args - extra chunk_func arguments, e.g. the pulse ID for ordered_data_chunk
+        depth - number of blocks read ahead
+        mem_cap - maximum number of bytes held by the blocks read ahead
+        mode - 'thread' or 'process' background reader
+        pid - read only the pulse_blocks of the pulse ID pid, all the blocks if None
+        """
+        tasks = self.blocks(block_size) if pid is None else self.pulse_blocks(pid, block_size)
+        return Prefetcher(chunk_func or self.data_chunk, tasks, args, depth=depth,
+                          mem_cap=mem_cap, mode=mode)
+
+    def pool(self):
+        return Pool(metrics=self.metrics)
+
+    def instrument(self, profile_dir=None, hooks=None):
+        """
+        Enable timing and throughput metrics collection
+
+        profile_dir - folder to dump per-worker cProfile statistics
+        hooks - list of callables invoked with every task metrics record
+        """
+        self.metrics = metrics.Metrics(profile_dir=profile_dir, hooks=hooks)
+        return self.metrics
+
+    def stage(self, name):
+        return nullcontext() if self.metrics is None else self.metrics.stage(name)
+
+    def use_cache(self, cache=None):
+        """
+        Serve the results of the cached library calls from an on-disk BlockCache,
+        a cache in utils.CACHE_PATH by default
+        """
+        self.cache = cache or BlockCache()
+        return self.cache
+
+    def use_writer(self, writer=None):
+        """
+        Compress the output data chunks in parallel with a ChunkWriter, a writer
+        with utils.CORES_COUNT workers by default
+        """
+        self.writer = writer or ChunkWriter()
+        return self.writer
+
+    def identity(self):
+        """
+        Return a tuple identifying the content of the input file
+        """
+        return file_identity(self.file_path)
+
+    def cache_key(self, *parts):
+        return cache_key(type(self).__name__, self.identity(), self.data_path,
+                         getattr(self, 'gain_path', None), self.pulse_path, self.train_path, parts)
+
+    def _cached(self, parts, func, *args):
+        if self.cache is None:
+            return func(*args)
+        key = self.cache_key(*parts)
+        result = self.cache.get(key)
+        if result is None:
+            result = func(*args)
+            self.cache.put(key, result)
+        return result
+
+    def chunk_sources(self):
+        """
+        Return a dictionary of (dataset, index) pairs for every output key,
+        a chunk of frames start:stop is dataset[(slice(start, stop),) + index]
+        """
+        return dict([(self.DATA_KEY, (self.data, ())),
+                     (self.TRAIN_KEY, (self.train_ids, ())),
+                     (self.PULSE_KEY, (self.pulse_ids, ()))])
+
+    def _read_chunk(self, start, stop):
+        return dict((key, read_frames(dataset, start, stop, index))
+                    for key, (dataset, index) in self.chunk_sources().items())
+
     def data_chunk(self, start, stop):
-        return dict([(self.DATA_KEY, self.data[start:stop]),
-                     (self.TRAIN_KEY, self.train_ids[start:stop]),
-                     (self.PULSE_KEY, self.pulse_ids[start:stop])])
+        data_chunk = self._read_chunk(start, stop)
+        metrics.count(bytes_read=metrics.nbytes(data_chunk), frames_in=stop - start)
+        return data_chunk
 
     def get_data(self):
-        pool = Pool()
+        pool = self.pool()
         with pool:
             for start, stop in self.chunks:
                 pool.submit(self.data_chunk, start, stop)
@@ -105,24 +386,79 @@ class CheetahData(object):
 
     def filtered_data_chunk(self, start, stop, limit):
         data_chunk = self.data_chunk(start, stop)
-        axis = tuple(np.arange(1, self.dimensions))
-        idxs = np.where(data_chunk[self.DATA_KEY].max(axis=axis) > limit)
-        for key in data_chunk:
-            data_chunk[key] = data_chunk[key][idxs]
+        with metrics.stage('filter'):
+            idxs = np.where(kernels.frame_max(data_chunk[self.DATA_KEY]) > limit)
+            for key in data_chunk:
+                data_chunk[key] = data_chunk[key][idxs]
         return data_chunk
 
     def get_filtered_data(self, limit):
-        pool = Pool()
+        pool = self.pool()
         with pool:
             for start, stop in self.chunks:
                 pool.submit(self.filtered_data_chunk, start, stop, limit)
         return pool.get(self.empty_dict())
 
+    def roi_indices(self, bg_roi=utils.BG_ROI, pupil_roi=utils.PUPIL_ROI):
+        """
+        Return flat pixel indices of the background and pupil regions, given in
+        the assembled image coordinates
+        """
+        frame_shape = self.data.shape[-2:]
+        return utils.roi_index(bg_roi, frame_shape), utils.roi_index(pupil_roi, frame_shape)
+
+    def normalized_data_chunk(self, start, stop, limit, bg_index, pupil_index, pupil_limit=None,
+                              normalize=False):
+        """
+        Trim and normalize frames start:stop in a single pass, per-frame background
+        and pupil intensities are computed for every frame and stored with the
+        hits, the frames above limit (and with the pupil intensity above pupil_limit)
+        """
+        data_chunk = self.data_chunk(start, stop)
+        with metrics.stage('filter'):
+            frames = data_chunk[self.DATA_KEY]
+            bg_intensity, pupil_intensity = utils.normalize_frames(frames, bg_index, pupil_index)
+            hits = kernels.frame_max(frames) > limit
+            if pupil_limit is not None:
+                hits &= pupil_intensity > pupil_limit
+            if normalize:
+                # frames that can't be normalized are dropped
+                hits &= np.isfinite(bg_intensity) & np.isfinite(pupil_intensity) & \
+                        (pupil_intensity != 0)
+            idxs = np.where(hits)
+            for key in data_chunk:
+                data_chunk[key] = data_chunk[key][idxs]
+            data_chunk[self.BG_KEY] = bg_intensity[idxs]
+            data_chunk[self.PUPIL_KEY] = pupil_intensity[idxs]
+            if normalize:
+                frames = data_chunk[self.DATA_KEY].astype(np.float32)
+                frames -= data_chunk[self.BG_KEY].reshape((-1,) + (1,) * (frames.ndim - 1))
+                frames /= data_chunk[self.PUPIL_KEY].reshape((-1,) + (1,) * (frames.ndim - 1))
+                data_chunk[self.DATA_KEY] = frames
+        return data_chunk
+
+    def get_normalized_data(self, limit, pupil_limit=None, normalize=False,
+                            bg_roi=utils.BG_ROI, pupil_roi=utils.PUPIL_ROI):
+        """
+        Return frames trimmed by limit together with their background and pupil
+        intensities, frames are normalized as (frame - background) / pupil if normalize
+        """
+        bg_index, pupil_index = self.roi_indices(bg_roi, pupil_roi)
+        pool = self.pool()
+        with pool:
+            for start, stop in self.chunks:
+                pool.submit(self.normalized_data_chunk, start, stop, limit, bg_index,
+                            pupil_index, pupil_limit, normalize)
+        out_dict = self.empty_dict()
+        out_dict.update([(self.BG_KEY, []), (self.PUPIL_KEY, [])])
+        return pool.get(out_dict)
+
     def ordered_data_chunk(self, start, stop, pid):
         data_chunk = self.data_chunk(start, stop)
-        idxs = np.where(data_chunk[self.PULSE_KEY] == pid)
-        for key in data_chunk:
-            data_chunk[key] = data_chunk[key][idxs]
+        with metrics.stage('filter'):
+            idxs = np.where(data_chunk[self.PULSE_KEY] == pid)
+            for key in data_chunk:
+                data_chunk[key] = data_chunk[key][idxs]
         return data_chunk
 
     def get_ordered_data(self, pids=None):
@@ -134,17 +470,195 @@ class CheetahData(object):
             _pids = pids
         results = []
         for pid in _pids:
-            pool = Pool()
-            with pool:
-                for start, stop in self.chunks:
-                    pool.submit(self.ordered_data_chunk, start, stop, pid)
-            res = pool.get(self.empty_dict())
+            res = self._cached(('ordered', int(pid)), self._get_ordered, pid)
             if res[self.DATA_KEY].any():
                 results.append(res)
         if len(results) == 1:
             results = results[0]
         return results
 
+    def _get_ordered(self, pid):
+        index = self.pulse_index()
+        if index is not None:
+            first, count = index.get(int(pid), (0, 0))
+            return self.data_chunk(first, first + count)
+        pool = self.pool()
+        with pool:
+            for start, stop in self.chunks:
+                pool.submit(self.ordered_data_chunk, start, stop, pid)
+        return pool.get(self.empty_dict())
+
+    def reduced_chunk(self, start, stop, limit=None):
+        reducer = PulseReducer(limit)
+        for block_start in range(start, stop, self.BLOCK_SIZE):
+            data_chunk = self.data_chunk(block_start, min(block_start + self.BLOCK_SIZE, stop))
+            with metrics.stage('filter'):
+                reducer.update(data_chunk[self.DATA_KEY], data_chunk[self.PULSE_KEY])
+        return reducer
+
+    def get_reduced_data(self, limit=None):
+        """
+        Return PulseReducer with per-pulse ID mean, variance, sum, maximum and hit
+        counts computed in a single read of the file
+
+        limit - frames with the maximum above limit count as hits
+        """
+        pool = self.pool()
+        reducer = PulseReducer(limit)
+        with pool:
+            for start, stop in self.chunks:
+                pool.submit(self.reduced_chunk, start, stop, limit)
+            futures, pool.futures = set(pool.futures), []
+            while futures:
+                done, futures = concurrent.futures.wait(futures,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    reducer.merge(pool.result(fut))
+        return reducer
+
+    def trim_chunk(self, start, stop, limit):
+        dataset, index = self.chunk_sources()[self.DATA_KEY]
+        data = read_frames(dataset, start, stop, index)
+        metrics.count(bytes_read=data.nbytes, frames_in=stop - start)
+        with metrics.stage('filter'):
+            return start + np.where(kernels.frame_max(data) > limit)[0]
+
+    def shared_chunk(self, start, stop, idxs, specs, offset):
+        """
+        Read frames start:stop, or only the frames idxs out of them, into the
+        shared memory buffers specs starting at offset, return the number of frames
+        """
+        size = stop - start if idxs is None else idxs.size
+        blocks, arrays = attach_shared(specs)
+        try:
+            for key, (dataset, index) in self.chunk_sources().items():
+                out = arrays[key][offset:offset + size]
+                if idxs is None and not index and isinstance(dataset, h5py.Dataset) \
+                   and deflated(dataset):
+                    out[...] = inflate_frames(dataset, start, stop)
+                    metrics.count(bytes_read=out.nbytes)
+                    continue
+                with metrics.stage('read'):
+                    if idxs is None and isinstance(dataset, h5py.Dataset):
+                        dataset.read_direct(out, source_sel=(slice(start, stop),) + index)
+                    elif idxs is None:
+                        out[...] = dataset[(slice(start, stop),) + index]
+                    elif isinstance(dataset, h5py.Dataset):
+                        # only the selected frames are read, a run of them at a time
+                        pos = 0
+                        for run_start, run_stop in index_runs(idxs):
+                            length = run_stop - run_start
+                            dataset.read_direct(out, dest_sel=np.s_[pos:pos + length],
+                                                source_sel=(slice(run_start, run_stop),) + index)
+                            pos += length
+                    else:
+                        np.take(dataset[(slice(None),) + index], idxs, axis=0, out=out)
+                metrics.count(bytes_read=out.nbytes)
+            metrics.count(frames_in=size)
+        finally:
+            # the blocks can't be closed while the arrays export their buffers
+            out = arrays = None
+            for block in blocks.values():
+                block.close()
+        return size
+
+    def _get_shared(self, selections):
+        sizes = [stop - start if idxs is None else idxs.size for start, stop, idxs in selections]
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        pool = SharedPool(metrics=self.metrics)
+        with pool:
+            for key, (dataset, index) in self.chunk_sources().items():
+                pool.allocate(key, (int(offsets[-1]),) + dataset.shape[1 + len(index):],
+                              dataset.dtype)
+            for (start, stop, idxs), offset in zip(selections, offsets):
+                pool.submit(self.shared_chunk, start, stop, idxs, pool.specs, int(offset))
+        return pool.get(self.empty_dict())
+
+    def join(self, *sources):
+        """
+        Join auxiliary sources.Source datasets to the frames by train and pulse IDs
+        """
+        self.sources = tuple(self.sources) + sources
+        return self.sources
+
+    def frame_ids(self):
+        """
+        Return the train and pulse IDs of all the frames
+        """
+        ids = []
+        for key in (self.TRAIN_KEY, self.PULSE_KEY):
+            dataset, index = self.chunk_sources()[key]
+            ids.append(np.asarray(dataset[(slice(None),) + index]).ravel())
+        return tuple(ids)
+
+    def joined_values(self):
+        """
+        Return a dictionary of the joined source values of all the frames
+        """
+        train_ids, pulse_ids = self.frame_ids()
+        return dict((source.name, source.align(train_ids, pulse_ids)) for source in self.sources)
+
+    def get_joined_data(self, filters=None, normalize=None):
+        """
+        Return the frames together with the joined source values, the frames are
+        selected by the source values before any of them is read
+
+        filters - dictionary of source name and (lower, upper) range pairs, frames
+                  out of the ranges or with missing values are dropped
+        normalize - name of the source to divide the frames by, e.g. pulse energy,
+                    frames with zero or non-finite values are dropped
+        """
+        filters = dict(filters or {})
+        if normalize is not None:
+            filters.setdefault(normalize, (None, None))
+        values = self.joined_values()
+        mask = source_mask(values, filters, self.size)
+        if normalize is not None:
+            # frames that can't be normalized are dropped
+            norm = values[normalize].reshape(self.size, -1)
+            mask &= (np.isfinite(norm) & (norm != 0)).all(axis=1)
+        data = self._get_shared([(start, stop, start + np.where(mask[start:stop])[0])
+                                 for start, stop in self.chunks])
+        for name, value in values.items():
+            data[name] = value[mask]
+        if normalize is not None:
+            frames = data[self.DATA_KEY].astype(np.float32)
+            frames /= data[normalize].reshape((-1,) + (1,) * (frames.ndim - 1))
+            data[self.DATA_KEY] = frames
+        return data
+
+    def get_shared_data(self):
+        """
+        Shared memory counterpart of get_data, the result isn't pickled or copied
+        """
+        return self._get_shared([(start, stop, None) for start, stop in self.chunks])
+
+    def get_shared_filtered_data(self, limit):
+        """
+        Shared memory counterpart of get_filtered_data, a trimming pre-pass gives
+        the exact output offsets of every chunk
+        """
+        pool = self.pool()
+        with pool:
+            for start, stop in self.chunks:
+                pool.submit(self.trim_chunk, start, stop, limit)
+        idxs_list = [pool.result(fut) for fut in pool.futures]
+        return self._get_shared([(start, stop, idxs)
+                                 for (start, stop), idxs in zip(self.chunks, idxs_list)])
+
+    def get_shared_ordered_data(self, pid):
+        """
+        Shared memory counterpart of get_ordered_data for a single pulse ID
+        """
+        index = self.pulse_index()
+        if index is not None:
+            first, count = index.get(int(pid), (0, 0))
+            return self._get_shared([(first, first + count, None)])
+        dataset, index = self.chunk_sources()[self.PULSE_KEY]
+        pulse_ids = dataset[(slice(None),) + index]
+        return self._get_shared([(start, stop, start + np.where(pulse_ids[start:stop] == pid)[0])
+                                 for start, stop in self.chunks])
+
     def _create_out_file(self, out_path):
         utils.make_output_dir(os.path.dirname(out_path))
         return h5py.File(out_path, 'w')
@@ -156,20 +670,59 @@ class CheetahData(object):
         arg_group.create_dataset('pulseId_path', data=self.pulse_path)
         arg_group.create_dataset('trainId_path', data=self.train_path)
 
+    def _create_data(self, group, key, data):
+        if self.writer is None:
+            return self.PRECISION.create_dataset(group, key, data, compression='gzip')
+        return self.writer.create_dataset(group, key, data, self.PRECISION)
+
     def _save_data(self, data, out_file):
         data_group = out_file.create_group('data')
         for key in data:
             if key == self.DATA_KEY:
-                data_group.create_dataset(key, data=data[key], compression='gzip')
+                self._create_data(data_group, key, data[key])
             else:
                 data_group.create_dataset(key, data=data[key])
 
-    def save(self, out_path):
+    def save_metrics(self, out_path):
+        if self.metrics is not None:
+            self.metrics.count(bytes_written=os.path.getsize(out_path))
+            self.metrics.finish()
+            self.metrics.save(out_path)
+
+    def save(self, out_path, preview=False):
+        """
+        Write all the frames, with the binned preview pyramid and per-train
+        thumbnails in the preview group if preview
+        """
         out_file = self._create_out_file(out_path)
         self._save_parameters(out_file)
         data = self.get_data()
-        self._save_data(data, out_file)
-        out_file.close()
+        if preview:
+            with self.stage('preview'):
+                save_preview(out_file, data[self.DATA_KEY], data[self.TRAIN_KEY])
+        with self.stage('write'):
+            self._save_data(data, out_file)
+            out_file.close()
+        self.save_metrics(out_path)
+
+    def save_normalized(self, out_path, limit, pupil_limit=None, normalize=False):
+        out_file = self._create_out_file(out_path)
+        self._save_parameters(out_file)
+        data = self.get_normalized_data(limit, pupil_limit, normalize)
+        with self.stage('write'):
+            self._save_data(data, out_file)
+            out_file['data'].attrs['normalized'] = normalize
+            out_file.close()
+        self.save_metrics(out_path)
+
+    def save_reduced(self, out_path, limit=None):
+        out_file = self._create_out_file(out_path)
+        self._save_parameters(out_file)
+        reducer = self.get_reduced_data(limit)
+        with self.stage('write'):
+            reducer.save(out_file, self.PULSE_KEY)
+            out_file.close()
+        self.save_metrics(out_path)
 
     def _save_data_list(self, data_list, out_file):
         data_group = out_file.create_group('data')
@@ -177,7 +730,7 @@ class CheetahData(object):
             pid_group = data_group.create_group("pulseId {:d}".format(data[self.PULSE_KEY][0]))
             for key in data:
                 if key == self.DATA_KEY:
-                    pid_group.create_dataset(key, data=data[key], compression='gzip')
+                    self._create_data(pid_group, key, data[key])
                 elif key == self.PULSE_KEY:
                     continue
                 else:
@@ -187,11 +740,13 @@ class CheetahData(object):
         out_file = self._create_out_file(out_path)
         self._save_parameters(out_file)
         data = self.get_ordered_data(pids)
-        if isinstance(pids, int):
-            self._save_data(data, out_file)
-        else:
-            self._save_data_list(data, out_file)
-        out_file.close()
+        with self.stage('write'):
+            if isinstance(pids, int):
+                self._save_data(data, out_file)
+            else:
+                self._save_data_list(data, out_file)
+            out_file.close()
+        self.save_metrics(out_path)
 
 class RawData(CheetahData):
     GAIN_KEY = utils.GAIN_KEY
@@ -205,7 +760,7 @@ class RawData(CheetahData):
 
     @property
     def gain(self):
-        return self.data_file[self.gain_path]
+        return self.dataset(self.gain_path)
 
     def empty_dict(self):
         return dict([(self.DATA_KEY, []),
@@ -213,11 +768,11 @@ class RawData(CheetahData):
                      (self.PULSE_KEY, []),
                      (self.TRAIN_KEY, [])])
 
-    def data_chunk(self, start, stop):
-        return dict([(self.DATA_KEY, self.data[start:stop]),
-                     (self.GAIN_KEY, self.gain[start:stop]),
-                     (self.TRAIN_KEY, self.train_ids[start:stop]),
-                     (self.PULSE_KEY, self.pulse_ids[start:stop])])
+    def chunk_sources(self):
+        return dict([(self.DATA_KEY, (self.data, ())),
+                     (self.GAIN_KEY, (self.gain, ())),
+                     (self.TRAIN_KEY, (self.train_ids, ())),
+                     (self.PULSE_KEY, (self.pulse_ids, ()))])
 
     def _save_parameters(self, out_file):
         arg_group = out_file.create_group('arguments')
@@ -257,11 +812,11 @@ class RawJoined(CheetahData):
                      (self.PULSE_KEY, []),
                      (self.TRAIN_KEY, [])])
 
-    def data_chunk(self, start, stop):
-        return dict([(self.DATA_KEY, self.data[start:stop, 0]),
-                     (self.GAIN_KEY, self.data[start:stop, 1]),
-                     (self.TRAIN_KEY, self.train_ids[start:stop, 0]),
-                     (self.PULSE_KEY, self.pulse_ids[start:stop, 0])])
+    def chunk_sources(self):
+        return dict([(self.DATA_KEY, (self.data, (0,))),
+                     (self.GAIN_KEY, (self.data, (1,))),
+                     (self.TRAIN_KEY, (self.train_ids, (0,))),
+                     (self.PULSE_KEY, (self.pulse_ids, (0,)))])
 
 class RawModuleJoined(RawJoined):
     def __init__(self,
@@ -275,3 +830,138 @@ class RawModuleJoined(RawJoined):
                                               pulse_path.format(module_id),
                                               train_path.format(module_id))
         self.module_id = module_id
+
+def cheetah_files(run_number, tag='data', run_path=utils.CHEETAH_RUN_PATH,
+                  file_mask=utils.CHEETAH_FILE_MASK):
+    """
+    Return the paths of all the cheetah files of a run sorted by the file number,
+    the files matching file_mask without a file number are skipped
+    """
+    pattern = os.path.join(run_path, file_mask).format(run=run_number, tag=tag)
+    numbers = dict((path, re.search(r'-c(\d+)\.\w+$', path)) for path in glob.glob(pattern))
+    file_paths = [path for path, match in numbers.items() if match is not None]
+    if not file_paths:
+        raise ValueError('No cheetah files found: {}'.format(pattern))
+    return sorted(file_paths, key=lambda path: int(numbers[path].group(1)))
+
+class CheetahRun(CheetahData):
+    """
+    Cheetah run split across many files read as one CheetahData, frames are
+    addressed by a global index running over the files in the file number order
+
+    run_number - run number
+    tag - cheetah output tag, the run folder suffix
+    run_path - run folder path template, formatted with run and tag
+    file_mask - cheetah file glob mask, formatted with run
+    """
+    def __init__(self,
+                 run_number,
+                 tag='data',
+                 run_path=utils.CHEETAH_RUN_PATH,
+                 file_mask=utils.CHEETAH_FILE_MASK,
+                 data_path=DATA_PATH,
+                 pulse_path=PULSE_PATH,
+                 train_path=TRAIN_PATH):
+        # there is no single file behind a run, see file_paths
+        super(CheetahRun, self).__init__(None, data_path, pulse_path, train_path)
+        self.run_number, self.tag = run_number, tag
+        self.run_dir = run_path.format(run=run_number, tag=tag)
+        self.readers = [CheetahData(file_path, data_path, pulse_path, train_path)
+                        for file_path in cheetah_files(run_number, tag, run_path, file_mask)]
+        self.offsets = np.cumsum([0] + [reader.size for reader in self.readers])
+
+    @property
+    def file_paths(self):
+        return [reader.file_path for reader in self.readers]
+
+    @property
+    def size(self):
+        return int(self.offsets[-1])
+
+    @property
+    def data_file(self):
+        # the dataset layout is the same in every file, frames are read per file
+        return self.readers[0].data_file
+
+    def dataset(self, path):
+        return self.readers[0].dataset(path)
+
+    def identity(self):
+        return tuple(reader.identity() for reader in self.readers)
+
+    def locate(self, start):
+        """
+        Return the reader of the frame start and the global index of its first frame
+        """
+        if not 0 <= start < self.size:
+            raise ValueError('Wrong frame index: {}'.format(start))
+        idx = np.searchsorted(self.offsets, start, side='right') - 1
+        return self.readers[idx], int(self.offsets[idx])
+
+    def split(self, limits_func):
+        """
+        Split the run into ranges within single files, limits_func returns the
+        relative range limits of a file of the given size
+        """
+        ranges = []
+        for offset, reader in zip(self.offsets, self.readers):
+            limits = offset + limits_func(reader.size)
+            ranges.extend((int(start), int(stop)) for start, stop in zip(limits[:-1], limits[1:])
+                          if stop > start)
+        return ranges
+
+    @property
+    def chunks(self):
+        # every file is read by at least one worker and all the workers are busy
+        parts = -(-utils.CORES_COUNT // len(self.readers))
+        return self.split(lambda size: np.linspace(0, size, parts + 1).astype(int))
+
+    def blocks(self, block_size=None):
+        block_size = block_size or self.BLOCK_SIZE
+        return self.split(lambda size: np.append(np.arange(0, size, block_size), size))
+
+    def _read_chunk(self, start, stop):
+        chunks = []
+        while start < stop:
+            reader, offset = self.locate(start)
+            file_stop = min(stop, offset + reader.size)
+            chunks.append(reader._read_chunk(start - offset, file_stop - offset))
+            start = file_stop
+        if len(chunks) == 1:
+            return chunks[0]
+        return dict((key, np.concatenate([chunk[key] for chunk in chunks])) for key in chunks[0])
+
+    def trim_chunk(self, start, stop, limit):
+        reader, offset = self.locate(start)
+        return offset + reader.trim_chunk(start - offset, stop - offset, limit)
+
+    def shared_chunk(self, start, stop, idxs, specs, offset):
+        reader, file_offset = self.locate(start)
+        return reader.shared_chunk(start - file_offset, stop - file_offset,
+                                   None if idxs is None else idxs - file_offset, specs, offset)
+
+    def get_shared_ordered_data(self, pid):
+        selections = []
+        for start, stop in self.chunks:
+            reader, offset = self.locate(start)
+            dataset, index = reader.chunk_sources()[self.PULSE_KEY]
+            pulse_ids = dataset[(slice(start - offset, stop - offset),) + index]
+            selections.append((start, stop, start + np.where(pulse_ids == pid)[0]))
+        return self._get_shared(selections)
+
+    def pulse_index(self):
+        # cheetah files are always train-major
+        return None
+
+    def frame_ids(self):
+        ids = [reader.frame_ids() for reader in self.readers]
+        return (np.concatenate([train_ids for train_ids, _ in ids]),
+                np.concatenate([pulse_ids for _, pulse_ids in ids]))
+
+    def _save_parameters(self, out_file):
+        arg_group = out_file.create_group('arguments')
+        arg_group.create_dataset('run_dir', data=np.string_(self.run_dir))
+        arg_group.create_dataset('file_paths', data=[np.string_(path) for path in self.file_paths])
+        arg_group.create_dataset('data_path', data=self.data_path)
+        arg_group.create_dataset('pulseId_path', data=self.pulse_path)
+        arg_group.create_dataset('trainId_path', data=self.train_path)
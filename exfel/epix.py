@@ -0,0 +1,164 @@
+"""
+epix.py - streaming ePix histogram module
+"""
+import os
+import concurrent.futures
+import h5py
+import numpy as np
+from . import utils
+from .utils import kernels
+from .data import Pool, SharedPool, attach_shared
+
+RAW_PATH = '/gpfs/exfel/exp/MID/201901/p002543/raw/r{run_number:04d}'
+EPIX_FILENAME = 'RAW-R{run_number:04d}-EPIX{epix_id:02d}'
+DATA_PATH = '/INSTRUMENT/MID_EXP_EPIX-{epix_id:d}/DET/RECEIVER:daqOutput/data/image/pixels'
+TRAIN_PATH = '/INSTRUMENT/MID_EXP_EPIX-{epix_id:d}/DET/RECEIVER:daqOutput/data/trainId'
+EPIX_DARK = '/gpfs/exfel/exp/MID/201901/p002543/usr/Shared/ePix{epix_id:02d}-r0035.h5'
+OFFSET_PATH = 'darks'
+MASK_PATH = 'mask'
+HIST_MODES = ('total', 'pixel', 'train')
+CHUNK_SIZE = 100
+
+def epix_files(raw_base, run_number, epix_id):
+    prefix = EPIX_FILENAME.format(run_number=run_number, epix_id=epix_id)
+    return sorted(os.path.join(raw_base, filename)
+                  for filename in os.listdir(raw_base)
+                  if filename.startswith(prefix))
+
+def load_dark(dark_path):
+    with h5py.File(dark_path, 'r') as dark:
+        offset = dark[OFFSET_PATH][:].astype(np.float64)
+        mask = dark[MASK_PATH][:].astype(np.float64)
+    return offset, mask
+
+def hist_frames(raw_data, train_ids, offset, mask, bins, roi, mode):
+    idxs = kernels.dark_bin_index(raw_data, offset, mask, bins, roi)
+    if mode == 'total':
+        return np.bincount(idxs[idxs >= 0], minlength=bins)
+    if mode == 'pixel':
+        n_pixels = mask.size
+        flat = idxs.reshape(-1, n_pixels) + np.arange(n_pixels) * bins
+        flat = flat[idxs.reshape(-1, n_pixels) >= 0]
+        return np.bincount(flat, minlength=n_pixels * bins).reshape(mask.shape + (bins,))
+    flat = idxs.reshape(idxs.shape[0], -1) + (np.arange(idxs.shape[0]) * bins)[:, None]
+    flat = flat[idxs.reshape(idxs.shape[0], -1) >= 0]
+    hists = np.bincount(flat, minlength=idxs.shape[0] * bins).reshape(-1, bins)
+    return merge_train_hists([train_ids], [hists])
+
+def hist_chunk(file_path, data_path, train_path, start, stop, offset, mask, bins, roi, mode,
+               chunk_size=CHUNK_SIZE):
+    """
+    Dark correct and histogram ePix frames start:stop read by chunk_size frames,
+    return a partial integer histogram: (bins,) for 'total' mode, (train IDs,
+    (n_trains, bins) histograms) for 'train' mode
+    """
+    hist, train_list, hist_list = 0, [], []
+    with h5py.File(file_path, 'r') as raw_file:
+        for idx in range(start, stop, chunk_size):
+            raw_data = raw_file[data_path][idx:min(idx + chunk_size, stop)]
+            train_ids = raw_file[train_path][idx:idx + raw_data.shape[0]] if mode == 'train' else None
+            chunk = hist_frames(raw_data, train_ids, offset, mask, bins, roi, mode)
+            if mode == 'train':
+                train_list.append(chunk[0])
+                hist_list.append(chunk[1])
+            else:
+                hist = hist + chunk
+    if mode == 'train':
+        return merge_train_hists(train_list, hist_list)
+    return hist
+
+def hist_pixels(file_paths, data_path, rows, offset, mask, bins, roi, specs,
+                chunk_size=CHUNK_SIZE):
+    """
+    Dark correct and histogram the pixel rows of all the ePix frames in file_paths,
+    the counts are added in place to the rows of the per-pixel histogram in the
+    shared memory buffer specs
+    """
+    blocks, arrays = attach_shared(specs)
+    try:
+        hist = arrays['hist'][rows]
+        for file_path in file_paths:
+            with h5py.File(file_path, 'r') as raw_file:
+                dataset = raw_file[data_path]
+                for idx in range(0, dataset.shape[0], chunk_size):
+                    raw_data = dataset[idx:idx + chunk_size, rows]
+                    hist += hist_frames(raw_data, None, offset[rows], mask[rows], bins, roi, 'pixel')
+    finally:
+        hist = arrays = None
+        for block in blocks.values():
+            block.close()
+
+def merge_train_hists(train_list, hist_list):
+    train_ids, inverse = np.unique(np.concatenate(train_list), return_inverse=True)
+    hists = np.zeros((train_ids.size, hist_list[0].shape[1]), dtype=np.int64)
+    np.add.at(hists, inverse, np.concatenate(hist_list))
+    return train_ids, hists
+
+def epix_histogram(run_number, epix_id=2, raw_path=RAW_PATH, dark_path=None, roi=(0, 30),
+                   bins=100, mode='total', chunk_size=CHUNK_SIZE, num_workers=utils.CORES_COUNT):
+    """
+    Histogram dark corrected ePix data of a run, frames are processed in chunks
+    by the pool workers and only partial integer histograms are sent back. In
+    the 'pixel' mode every worker fills the int32 histograms of its own pixel
+    rows in shared memory instead, the data is binned in float64
+
+    run_number - run number
+    epix_id - ePix detector ID
+    raw_path - raw data folder template, formatted with run_number
+    dark_path - dark calibration file, ePix{epix_id - 1} file of EPIX_DARK by default
+    roi - energy range of the histogram
+    bins - number of histogram bins
+    mode - 'total' for the histogram of the whole run, 'pixel' for per-pixel
+           histograms, 'train' for per-train histograms
+
+    Returns a dictionary with 'hist' and bin center 'energies', plus 'trainId'
+    in the 'train' mode
+    """
+    if mode not in HIST_MODES:
+        raise ValueError('Wrong histogram mode: {}'.format(mode))
+    if dark_path is None:
+        dark_path = EPIX_DARK.format(epix_id=epix_id - 1)
+    offset, mask = load_dark(dark_path)
+    data_path, train_path = DATA_PATH.format(epix_id=epix_id), TRAIN_PATH.format(epix_id=epix_id)
+    edges = np.linspace(roi[0], roi[1], bins + 1)
+    result = {'energies': (edges[1:] + edges[:-1]) / 2}
+    file_paths = epix_files(raw_path.format(run_number=run_number), run_number, epix_id)
+    if mode == 'pixel':
+        pool = SharedPool(num_workers)
+        with pool:
+            # new shared memory blocks are zero filled
+            pool.allocate('hist', mask.shape + (bins,), np.int32)
+            limits = np.linspace(0, mask.shape[0], min(num_workers, mask.shape[0]) + 1).astype(int)
+            for start, stop in zip(limits[:-1], limits[1:]):
+                pool.submit(hist_pixels, file_paths, data_path, slice(start, stop), offset, mask,
+                            bins, roi, pool.specs, chunk_size)
+        result['hist'] = pool.get()['hist']
+        return result
+    if mode == 'train':
+        train_list, hist_list = [np.zeros(0, dtype=np.int64)], [np.zeros((0, bins), dtype=np.int64)]
+    else:
+        result['hist'] = np.zeros(bins, dtype=np.int64)
+    pool = Pool(num_workers)
+    with pool:
+        for file_path in file_paths:
+            with h5py.File(file_path, 'r') as raw_file:
+                size = raw_file[data_path].shape[0]
+            limits = np.linspace(0, size, min(num_workers, size) + 1).astype(int)
+            for start, stop in zip(limits[:-1], limits[1:]):
+                pool.submit(hist_chunk, file_path, data_path, train_path, start, stop,
+                            offset, mask, bins, roi, mode, chunk_size)
+        # partial histograms are merged as soon as they arrive and released
+        futures, pool.futures = set(pool.futures), []
+        while futures:
+            done, futures = concurrent.futures.wait(futures,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                if mode == 'train':
+                    train_ids, hists = pool.result(fut)
+                    train_list.append(train_ids)
+                    hist_list.append(hists)
+                else:
+                    result['hist'] += pool.result(fut)
+    if mode == 'train':
+        result['trainId'], result['hist'] = merge_train_hists(train_list, hist_list)
+    return result
@@ -0,0 +1,133 @@
+"""
+integrate.py - azimuthal and radial integration module
+"""
+import os
+import pickle
+import hashlib
+import numpy as np
+from . import utils
+from .utils import slab_shape, pixel_coordinates
+
+HC = 12398.419843320026  # Planck constant times speed of light, eV * Angstrom
+
+class AzimuthalIntegrator(object):
+    """
+    Radial I(q) and azimuthal I(q, phi) integrator working on module space frames
+
+    The pixel to (q, phi) bin mapping is precomputed once as a sparse matrix and
+    cached in utils.CACHE_PATH, a batch of frames is then reduced with a single
+    sparse matrix product without assembling the detector images
+
+    geometry - CrystFEL geometry dictionary, AGIPD geometry by default
+    q_bins - number of momentum transfer bins
+    phi_bins - number of azimuthal bins, I(q) only if None
+    q_range - (q_min, q_max) in inverse Angstroms, the full detector range by default
+    mask - module space mask of good pixels
+    subpixels - every pixel is split into subpixels x subpixels points
+    clen - detector distance in meters, taken from geometry by default
+    photon_energy - photon energy in eV, taken from geometry by default
+    """
+    def __init__(self, geometry=None, q_bins=500, phi_bins=None, q_range=None, mask=None,
+                 subpixels=2, clen=None, photon_energy=None, cache=True):
+        self.geometry = utils.load_geometry() if geometry is None else geometry
+        panel = next(iter(self.geometry['panels'].values()))
+        self.clen = float(panel['clen'] if clen is None else clen) + float(panel.get('coffset', 0.))
+        self.photon_energy = float(self.geometry['beam']['photon_energy']
+                                   if photon_energy is None else photon_energy)
+        self.q_bins, self.phi_bins, self.subpixels = q_bins, phi_bins, subpixels
+        self.shape = slab_shape(self.geometry)
+        self.mask = np.ones(self.shape, dtype=bool) if mask is None else mask.reshape(self.shape)
+        self.q_range = q_range or self._full_q_range()
+        cache_path = os.path.join(utils.CACHE_PATH, 'integrator-{:s}.npz'.format(self.digest))
+        if cache and os.path.isfile(cache_path):
+            self._load(cache_path)
+        else:
+            self._init_matrix()
+            if cache:
+                self._save(cache_path)
+
+    @property
+    def wavelength(self):
+        return HC / self.photon_energy
+
+    @property
+    def digest(self):
+        params = (self.clen, self.photon_energy, self.q_bins, self.phi_bins,
+                  tuple(self.q_range), self.subpixels)
+        digest = hashlib.sha1(pickle.dumps(self.geometry, protocol=pickle.HIGHEST_PROTOCOL))
+        digest.update(repr(params).encode())
+        digest.update(np.packbits(self.mask).tobytes())
+        return digest.hexdigest()
+
+    @property
+    def q_edges(self):
+        return np.linspace(self.q_range[0], self.q_range[1], self.q_bins + 1)
+
+    @property
+    def q(self):
+        return (self.q_edges[1:] + self.q_edges[:-1]) / 2
+
+    @property
+    def phi_edges(self):
+        return np.linspace(-np.pi, np.pi, (self.phi_bins or 1) + 1)
+
+    @property
+    def phi(self):
+        return (self.phi_edges[1:] + self.phi_edges[:-1]) / 2
+
+    def q_phi(self, subpixels):
+        x, y = pixel_coordinates(self.geometry, subpixels)
+        theta = 0.5 * np.arctan2(np.sqrt(x**2 + y**2), self.clen)
+        return 4 * np.pi * np.sin(theta) / self.wavelength, np.arctan2(y, x)
+
+    def _full_q_range(self):
+        q, _ = self.q_phi(1)
+        return (float(q[:, self.mask].min()), float(q[:, self.mask].max()))
+
+    def _init_matrix(self):
+        from scipy import sparse
+        q, phi = self.q_phi(self.subpixels)
+        q_idxs = np.digitize(q, self.q_edges) - 1
+        q_idxs[q == self.q_range[1]] = self.q_bins - 1
+        phi_idxs = np.clip(np.digitize(phi, self.phi_edges) - 1, 0, (self.phi_bins or 1) - 1)
+        bins = q_idxs * (self.phi_bins or 1) + phi_idxs
+        pixels = np.broadcast_to(np.arange(self.mask.size).reshape(self.shape), bins.shape)
+        valid = (q_idxs >= 0) & (q_idxs < self.q_bins) & self.mask[None]
+        weights = np.full(valid.sum(), 1. / self.subpixels**2)
+        n_bins = self.q_bins * (self.phi_bins or 1)
+        self.matrix = sparse.csr_matrix((weights, (bins[valid], pixels[valid])),
+                                        shape=(n_bins, self.mask.size))
+        self.matrix.sum_duplicates()
+        self.norm = np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    def _save(self, cache_path):
+        utils.make_output_dir(utils.CACHE_PATH)
+        tmp_path = '{:s}.{:d}.npz'.format(cache_path[:-4], os.getpid())
+        np.savez(tmp_path, data=self.matrix.data, indices=self.matrix.indices,
+                 indptr=self.matrix.indptr, shape=self.matrix.shape, norm=self.norm)
+        os.replace(tmp_path, cache_path)
+
+    def _load(self, cache_path):
+        from scipy import sparse
+        with np.load(cache_path) as cache_file:
+            self.matrix = sparse.csr_matrix((cache_file['data'], cache_file['indices'],
+                                             cache_file['indptr']),
+                                            shape=tuple(cache_file['shape']))
+            self.norm = cache_file['norm']
+
+    def integrate(self, frames):
+        """
+        Reduce a batch of module space frames to I(q) of shape (N, q_bins), or
+        I(q, phi) of shape (N, q_bins, phi_bins), mean intensity in every bin,
+        NaN in empty bins
+        """
+        frames = np.asarray(frames)
+        batch = frames.reshape((-1, self.mask.size))
+        sums = (self.matrix @ batch.T).T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = np.where(self.norm > 0, sums / self.norm, np.nan)
+        if frames.size == self.mask.size:
+            result = result[0]
+        if self.phi_bins:
+            result = result.reshape(result.shape[:-1] + (self.q_bins, self.phi_bins))
+        return result
@@ -0,0 +1,135 @@
+"""
+photons.py - photonization and sparse photon counts format module
+"""
+import numpy as np
+
+OFFSETS_KEY = 'offsets'
+INDICES_KEY = 'indices'
+COUNTS_KEY = 'counts'
+COUNT_DTYPES = (np.uint8, np.uint16, np.uint32)
+
+def photonize(frames, zero_adu, one_adu, threshold=0.5):
+    """
+    Convert calibrated frames to integer photon counts
+
+    frames - calibrated frames in ADU
+    zero_adu - zero photon ADU level
+    one_adu - one photon ADU level
+    threshold - fraction of a photon above which a pixel counts one more photon
+    """
+    photons = np.floor((frames - zero_adu) / (one_adu - zero_adu) + (1 - threshold))
+    return np.clip(photons, 0, None).astype(np.uint32)
+
+def count_dtype(max_count):
+    for dtype in COUNT_DTYPES:
+        if max_count <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+class SparseFrames(object):
+    """
+    Sparse photon counts of a stack of frames: nonzero pixels of frame i are
+    indices[offsets[i]:offsets[i + 1]] with counts counts[offsets[i]:offsets[i + 1]]
+
+    offsets - per-frame offsets, array of size n_frames + 1
+    indices - flat pixel indices
+    counts - photon counts
+    frame_shape - shape of a single frame
+    """
+    def __init__(self, offsets, indices, counts, frame_shape):
+        self.offsets, self.indices, self.counts = offsets, indices, counts
+        self.frame_shape = tuple(frame_shape)
+
+    @classmethod
+    def from_dense(cls, frames):
+        flat = np.asarray(frames).reshape(frames.shape[0], -1)
+        frame_idxs, indices = np.nonzero(flat)
+        counts = flat[frame_idxs, indices]
+        offsets = np.zeros(flat.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(frame_idxs, minlength=flat.shape[0]), out=offsets[1:])
+        return cls(offsets, indices.astype(np.uint32),
+                   counts.astype(count_dtype(counts.max() if counts.size else 0)),
+                   frames.shape[1:])
+
+    @classmethod
+    def concatenate(cls, frames_list):
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for frames in frames_list:
+            offsets.append(frames.offsets[1:] - frames.offsets[0] + offsets[-1][-1])
+        counts = np.concatenate([frames.counts for frames in frames_list])
+        return cls(np.concatenate(offsets), np.concatenate([frames.indices for frames in frames_list]),
+                   counts.astype(count_dtype(counts.max() if counts.size else 0)),
+                   frames_list[0].frame_shape)
+
+    @property
+    def size(self):
+        return self.offsets.size - 1
+
+    @property
+    def n_pixels(self):
+        return int(np.prod(self.frame_shape))
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.indices.nbytes + self.counts.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def to_csr(self):
+        """
+        Return frames as scipy.sparse.csr_matrix of shape (n_frames, n_pixels)
+        """
+        from scipy import sparse
+        return sparse.csr_matrix((self.counts, self.indices, self.offsets),
+                                 shape=(self.size, self.n_pixels))
+
+    def to_dense(self):
+        dense = np.zeros((self.size, self.n_pixels), dtype=self.counts.dtype)
+        frame_idxs = np.repeat(np.arange(self.size), np.diff(self.offsets))
+        dense[frame_idxs, self.indices] = self.counts
+        return dense.reshape((self.size,) + self.frame_shape)
+
+    def save(self, group):
+        group.attrs['frame_shape'] = self.frame_shape
+        group.create_dataset(OFFSETS_KEY, data=self.offsets)
+        group.create_dataset(INDICES_KEY, data=self.indices, compression='gzip')
+        group.create_dataset(COUNTS_KEY, data=self.counts, compression='gzip')
+
+    def append(self, group):
+        """
+        Append frames to a sparse photon counts group, creating it on the first call
+        """
+        if OFFSETS_KEY not in group:
+            group.attrs['frame_shape'] = self.frame_shape
+            group.create_dataset(OFFSETS_KEY, data=self.offsets - self.offsets[0],
+                                 chunks=True, maxshape=(None,))
+            for key, value in ((INDICES_KEY, self.indices), (COUNTS_KEY, self.counts)):
+                group.create_dataset(key, data=value, chunks=(2**16,), maxshape=(None,),
+                                     dtype=np.uint32 if key == COUNTS_KEY else value.dtype,
+                                     compression='gzip')
+            return
+        offsets = group[OFFSETS_KEY]
+        size, last = offsets.shape[0], offsets[-1]
+        offsets.resize(size + self.size, axis=0)
+        offsets[size:] = self.offsets[1:] - self.offsets[0] + last
+        for key, value in ((INDICES_KEY, self.indices), (COUNTS_KEY, self.counts)):
+            dataset = group[key]
+            dataset.resize(last + value.size, axis=0)
+            dataset[last:] = value
+
+def read_sparse(group, start=0, stop=None):
+    """
+    Read frames start:stop from a sparse photon counts group, only the
+    corresponding parts of the index and count arrays are read
+    """
+    offsets = group[OFFSETS_KEY][start:None if stop is None else stop + 1]
+    indices = group[INDICES_KEY][offsets[0]:offsets[-1]]
+    counts = group[COUNTS_KEY][offsets[0]:offsets[-1]]
+    return SparseFrames(offsets - offsets[0], indices, counts, group.attrs['frame_shape'])
+
+def read_dense(group, start=0, stop=None):
+    return read_sparse(group, start, stop).to_dense()
+
+def read_csr(group, start=0, stop=None):
+    return read_sparse(group, start, stop).to_csr()
@@ -0,0 +1,330 @@
+"""
+pipeline.py - declarative multi-stage processing pipeline module
+"""
+import os
+import concurrent.futures
+from collections import deque
+from contextlib import nullcontext
+import numpy as np
+import h5py
+from . import utils
+from .utils import metrics, kernels
+from .utils.precision import Precision
+from .utils.cache import file_identity, cache_key
+
+MODES = ('serial', 'process', 'mpi')
+
+class Stage(object):
+    """
+    Pipeline stage transforming a chunk dictionary into a new one, a stage
+    returning None drops the chunk
+
+    num_workers - number of parallel workers of the stage
+    queue_size - maximum number of chunks in flight, 2 * num_workers by default
+    """
+    name = 'filter'
+
+    def __init__(self, num_workers=1, queue_size=None):
+        if num_workers < 1:
+            raise ValueError('Number of workers must be positive: {}'.format(num_workers))
+        self.num_workers = num_workers
+        self.queue_size = queue_size or 2 * num_workers
+
+    def __call__(self, chunk):
+        with metrics.stage(self.name):
+            return self.process(chunk)
+
+    def process(self, chunk):
+        raise NotImplementedError
+
+    def cache_key(self):
+        """
+        Return a tuple of everything the stage output depends on, None if the
+        output can't be cached
+        """
+        return None
+
+class ReadStage(Stage):
+    """
+    Source stage reading a CheetahData family file in blocks of block_size frames
+
+    pid - read only the blocks holding the pulse ID pid if the file is pulse-major,
+          all the blocks otherwise
+    """
+    name = 'read'
+
+    def __init__(self, reader, block_size=None, num_workers=1, queue_size=None, pid=None):
+        super(ReadStage, self).__init__(num_workers, queue_size)
+        self.reader, self.block_size, self.pid = reader, block_size, pid
+
+    def tasks(self):
+        if self.pid is None:
+            return self.reader.blocks(self.block_size)
+        return self.reader.pulse_blocks(self.pid, self.block_size)
+
+    def __call__(self, task):
+        # data_chunk times the read itself
+        return self.process(task)
+
+    def process(self, task):
+        return self.reader.data_chunk(*task)
+
+    def cache_key(self):
+        return (type(self.reader).__name__, self.reader.identity(),
+                self.reader.data_path, getattr(self.reader, 'gain_path', None),
+                self.reader.pulse_path, self.reader.train_path)
+
+class TrimStage(Stage):
+    """
+    Keep the frames with the maximum above limit and of the pulse ID pid,
+    either of the conditions is skipped if None
+    """
+    def __init__(self, limit=None, pid=None, num_workers=1, queue_size=None):
+        super(TrimStage, self).__init__(num_workers, queue_size)
+        self.limit, self.pid = limit, pid
+
+    def process(self, chunk):
+        frames = chunk[utils.DATA_KEY]
+        hits = np.ones(frames.shape[0], dtype=bool)
+        if self.limit is not None:
+            hits &= kernels.frame_max(frames) > self.limit
+        if self.pid is not None:
+            hits &= chunk[utils.PULSE_KEY] == self.pid
+        if not hits.any():
+            return None
+        return dict((key, value[hits]) for key, value in chunk.items())
+
+    def cache_key(self):
+        return ('trim', self.limit, self.pid)
+
+class CalibrateStage(Stage):
+    """
+    Apply AGIPD dark calibration to raw module frames, the chunk gain is replaced
+    with the high and medium gain ADU, mask and calibrated data of AGIPDCalib
+
+    common_mode - per-ASIC common mode method ('median' or 'peak'), the whole
+                  module flat correction if None
+    """
+    name = 'calibrate'
+    FRAME_AXES = {'adu': 1, 'mask': 1, utils.DATA_KEY: 1}
+
+    def __init__(self, dark, module_id, common_mode=None, num_workers=1, queue_size=None):
+        super(CalibrateStage, self).__init__(num_workers, queue_size)
+        self.dark, self.module_id, self.common_mode = dark, module_id, common_mode
+
+    def process(self, chunk):
+        from .calib import AGIPDCalib
+        calib_data = AGIPDCalib(chunk[utils.DATA_KEY], chunk[utils.GAIN_KEY],
+                                self.dark, self.module_id, self.common_mode)
+        return dict([('adu', calib_data.adu), ('mask', calib_data.mask),
+                     (utils.DATA_KEY, calib_data.data),
+                     (utils.TRAIN_KEY, chunk[utils.TRAIN_KEY]),
+                     (utils.PULSE_KEY, chunk[utils.PULSE_KEY])])
+
+    def cache_key(self):
+        from .calib import AGIPDCalib
+        return ('calibrate', file_identity(self.dark.filename), self.dark.mask_inv,
+                self.module_id, AGIPDCalib.CELL_ID, AGIPDCalib.GAIN.tolist(),
+                AGIPDCalib.FLAT_ROI, self.common_mode)
+
+class GeometryStage(Stage):
+    """
+    Assemble detector slab frames into images with the AGIPD geometry
+    """
+    name = 'geometry'
+
+    def __init__(self, num_workers=1, queue_size=None):
+        super(GeometryStage, self).__init__(num_workers, queue_size)
+        self.maps = None
+
+    def process(self, chunk):
+        if self.maps is None:
+            self.maps = utils.pixel_maps()
+        rows, cols, shape = self.maps
+        chunk[utils.DATA_KEY] = kernels.assemble(chunk[utils.DATA_KEY], rows, cols, shape)
+        return chunk
+
+    def cache_key(self):
+        return ('geometry', file_identity(utils.AGIPD_GEOM_PATH))
+
+class WriteStage(object):
+    """
+    Sink appending the chunks to resizable datasets of an HDF5 group, always run
+    in the process running the pipeline
+
+    out_path - output file path
+    group_name - output group name
+    axes - frame axis of every key, 0 by default
+    reader - CheetahData family reader to save the parameters of
+    policy - output precision policy, lossless Precision by default
+    """
+    name = 'write'
+
+    def __init__(self, out_path, group_name='data', axes=None, reader=None, policy=None):
+        self.out_path, self.group_name = out_path, group_name
+        self.axes = axes or {}
+        self.reader, self.policy = reader, policy or Precision()
+        self.out_file, self.size = None, 0
+
+    def __enter__(self):
+        utils.make_output_dir(os.path.dirname(self.out_path))
+        self.out_file = h5py.File(self.out_path, 'w')
+        if self.reader is not None:
+            self.reader._save_parameters(self.out_file)
+        self.size = 0
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.out_file.close()
+
+    def __call__(self, chunk):
+        group = self.out_file.require_group(self.group_name)
+        for key, value in chunk.items():
+            self.policy.append(group, key, value, axis=self.axes.get(key, 0),
+                               compression='gzip' if value.ndim > 1 else None)
+        self.size += chunk[utils.PULSE_KEY].size
+
+def mpi_executor(max_workers):
+    from mpi4py.futures import MPIPoolExecutor
+    return MPIPoolExecutor(max_workers=max_workers)
+
+class Pipeline(object):
+    """
+    Chain of a ReadStage source, processing stages and an optional WriteStage
+    sink, every stage runs in its own pool of num_workers and holds at most
+    queue_size chunks in flight, so that a slow stage throttles the ones before it
+
+    stages - list of stages, ReadStage first
+    mode - 'serial' to run every stage in the current process, 'process' to run
+           every stage in a process pool, 'mpi' in an mpi4py.futures MPI pool
+           (run under mpiexec -m mpi4py.futures)
+    metrics - utils.metrics.Metrics collector, no metrics if None
+    cache - utils.cache.BlockCache of the output blocks, a cached block skips
+            all the stages, no caching if None
+    """
+    EXECUTORS = {'serial': None,
+                 'process': concurrent.futures.ProcessPoolExecutor,
+                 'mpi': mpi_executor}
+
+    def __init__(self, stages, mode='serial', metrics=None, cache=None):
+        if mode not in MODES:
+            raise ValueError('Wrong pipeline mode: {}'.format(mode))
+        if not stages or not isinstance(stages[0], ReadStage):
+            raise ValueError('Wrong pipeline source: {}'.format(stages[0] if stages else None))
+        self.source, self.mode, self.metrics, self.cache = stages[0], mode, metrics, cache
+        if isinstance(stages[-1], WriteStage):
+            self.stages, self.sink = list(stages[:-1]), stages[-1]
+        else:
+            self.stages, self.sink = list(stages), None
+
+    def _submit(self, executor, stage, chunk, idx):
+        if chunk is None:
+            # dropped chunks are passed on to keep the blocks in step with the tasks
+            fut = concurrent.futures.Future()
+            fut.set_result(None if self.metrics is None else (None, None))
+            return fut
+        func, args = stage, (chunk,)
+        if self.metrics is not None:
+            func, args = metrics.run_task, (stage, '{}({:d})'.format(stage.name, idx),
+                                            self.metrics.profile_dir, chunk)
+        if executor is None:
+            fut = concurrent.futures.Future()
+            fut.set_result(func(*args))
+            return fut
+        return executor.submit(func, *args)
+
+    def _result(self, fut):
+        if self.metrics is None:
+            return fut.result()
+        chunk, record = fut.result()
+        if record is not None:
+            self.metrics.add_task(record)
+        return chunk
+
+    def block_keys(self, tasks):
+        """
+        Return the cache keys of the output blocks, None if any of the stages
+        can't be cached
+        """
+        if self.cache is None:
+            return None
+        stage_keys = [stage.cache_key() for stage in self.stages]
+        if None in stage_keys:
+            return None
+        return [cache_key(stage_keys, tuple(task)) for task in tasks]
+
+    def _chain(self, tasks, executors):
+        chunks = tasks
+        for stage, executor in zip(self.stages, executors):
+            chunks = self._stream(stage, chunks, executor)
+        return chunks
+
+    def _stream(self, stage, chunks, executor):
+        queue = deque()
+        for idx, chunk in enumerate(chunks):
+            queue.append(self._submit(executor, stage, chunk, idx))
+            while len(queue) >= stage.queue_size:
+                yield self._result(queue.popleft())
+        while queue:
+            yield self._result(queue.popleft())
+
+    def __iter__(self):
+        """
+        Iterate over the output chunks of the last processing stage in the file order
+        """
+        make_executor = self.EXECUTORS[self.mode]
+        executors = [None if make_executor is None else make_executor(stage.num_workers)
+                     for stage in self.stages]
+        if self.metrics is not None:
+            self.metrics.num_workers = sum(stage.num_workers for stage in self.stages)
+        try:
+            tasks = self.source.tasks()
+            keys = self.block_keys(tasks)
+            if keys is None:
+                for chunk in self._chain(tasks, executors):
+                    if chunk is not None:
+                        yield chunk
+                return
+            # the cache is shared between runs, only the hits and misses of this one are counted
+            hits, misses = self.cache.hits, self.cache.misses
+            cached = [key in self.cache for key in keys]
+            chunks = self._chain([task for task, hit in zip(tasks, cached) if not hit], executors)
+            for task, key, hit in zip(tasks, keys, cached):
+                # the cache counts its own hits and misses
+                chunk = self.cache.get(key)
+                if not hit:
+                    computed = next(chunks)
+                    if chunk is None:
+                        chunk = computed
+                        self.cache.put(key, chunk or {})
+                elif chunk is None:
+                    # the block was evicted since the lookup, recompute it in place
+                    chunk = next(self._chain([task], [None] * len(executors)))
+                    self.cache.put(key, chunk or {})
+                if chunk:
+                    yield chunk
+            if self.metrics is not None:
+                self.metrics.count(cache_hits=self.cache.hits - hits,
+                                   cache_misses=self.cache.misses - misses)
+        finally:
+            for executor in executors:
+                if executor is not None:
+                    executor.shutdown(wait=True, cancel_futures=True)
+
+    def run(self):
+        """
+        Run the pipeline into the sink, return the number of frames written
+        """
+        if self.sink is None:
+            raise ValueError('Pipeline has no WriteStage sink')
+        stage = nullcontext if self.metrics is None else self.metrics.stage
+        with self.sink:
+            for chunk in self:
+                with stage(self.sink.name):
+                    self.sink(chunk)
+        if self.metrics is not None:
+            self.metrics.count(frames_out=self.sink.size,
+                               bytes_written=os.path.getsize(self.sink.out_path))
+            self.metrics.finish()
+            self.metrics.save(self.sink.out_path)
+        return self.sink.size
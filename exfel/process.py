@@ -2,8 +2,13 @@ import os
 import h5py
 import argparse
 from .data import RawModuleJoined
-from .calib import DarkAGIPD, AGIPDCalib
+from .reorder import reorder_pulse_major
+from .calib import DarkAGIPD, AGIPDCalib, HGData
 from .batch_jobs import ConfigParser
+from .pipeline import Pipeline, ReadStage, TrimStage, CalibrateStage, WriteStage
+from .utils.precision import Precision
+from .utils.cache import BlockCache
+from .utils.chunk_writer import ChunkWriter
 
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.ini')
 BEAM_LINES = ('DETLAB', 'FXE', 'HED', 'HSLAB', 'ITLAB', 'LA1',
@@ -14,16 +19,20 @@ class Process(object):
     DATA_STRUCTURE = "raw/r{run_number:04d}/RAW-R{run_number:04d}-AGIPD{module_id:02d}-S{chunk_num:05d}.h5"
     DATA_FOLDER = "raw/r{run_number:04d}"
     OUT_PID_PATH = "r{run_number:04d}/AGIPD{module_id:02d}-{tag:s}{pid:03d}.h5"
+    OUT_REDUCED_PATH = "r{run_number:04d}/AGIPD{module_id:02d}-S{chunk_num:05d}-RED.h5"
+    OUT_PULSE_MAJOR_PATH = "r{run_number:04d}/AGIPD{module_id:02d}-S{chunk_num:05d}-PM.h5"
     DARK_CALIB_PATH = "r{hg_run:04d}-r{mg_run:04d}-r{lg_run:04d}/Cheetah-AGIPD-calib.h5"
     DATA_PATH = "/INSTRUMENT/{beam_line:s}_DET_AGIPD1M-1/DET/{module_id:d}CH0:xtdf/image/data"
     TRAIN_PATH = "/INSTRUMENT/{beam_line:s}_DET_AGIPD1M-1/DET/{module_id:d}CH0:xtdf/image/trainId"
     PULSE_PATH = "/INSTRUMENT/{beam_line:s}_DET_AGIPD1M-1/DET/{module_id:d}CH0:xtdf/image/pulseId"
 
-    def __init__(self, run_number, config_file='config.ini'):
+    def __init__(self, run_number, config_file='config.ini', metrics=False, profile_dir=None):
         self.run_number = run_number
         self.config = ConfigParser(config_file)
+        self.metrics, self.profile_dir = metrics, profile_dir
         self._init_paths()
         self._init_dark()
+        self._init_cache()
 
     def _init_paths(self):
         if self.config.beam_line not in BEAM_LINES:
@@ -41,6 +50,17 @@ class Process(object):
             raise ValueError('Wrong dark calibration path: {}'.format(dark_path))
         self.dark_calib = DarkAGIPD(dark_path)
 
+    def _init_cache(self):
+        self.cache = None
+        if self.config.cache_dir:
+            self.cache = BlockCache(self.config.cache_dir, self.config.cache_size)
+
+    def print_cache_stats(self):
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print('Cache hits: {:d}, misses: {:d}, hit rate: {:.1%}, size: {:.2f} GB'.format(
+                stats['hits'], stats['misses'], stats['hit_rate'], stats['size'] / 2**30))
+
     @property
     def file_folder(self):
         return os.path.join(self.config.raw_path,
@@ -59,61 +79,177 @@ class Process(object):
                                                        module_id=module_id,
                                                        chunk_num=chunk_num))
 
+    def pulse_major_path(self, module_id, chunk_num):
+        return os.path.join(self.config.out_base,
+                            self.OUT_PULSE_MAJOR_PATH.format(run_number=self.run_number,
+                                                             module_id=module_id,
+                                                             chunk_num=chunk_num))
+
     def data_path(self, module_id):
-        return self.DATA_PATH.format(self.config.beam_line, module_id)
+        return self.DATA_PATH.format(beam_line=self.config.beam_line, module_id=module_id)
 
     def train_path(self, module_id):
-        return self.TRAIN_PATH.format(self.config.beam_line, module_id)
+        return self.TRAIN_PATH.format(beam_line=self.config.beam_line, module_id=module_id)
 
     def pulse_path(self, module_id):
-        return self.PULSE_PATH.format(self.config.beam_line, module_id)
+        return self.PULSE_PATH.format(beam_line=self.config.beam_line, module_id=module_id)
 
     def data_file(self, module_id, chunk_num):
-        return RawModuleJoined(module_id=module_id,
-                               file_path=self.file_path(module_id, chunk_num),
-                               data_path=self.data_path(module_id),
-                               train_path=self.train_path(module_id),
-                               pulse_path=self.pulse_path(module_id))
+        # the pulse-major copy written by save_pulse_major is read instead if there is one
+        file_path = self.pulse_major_path(module_id, chunk_num)
+        if not os.path.isfile(file_path):
+            file_path = self.file_path(module_id, chunk_num)
+        raw_data = RawModuleJoined(module_id=module_id,
+                                   file_path=file_path,
+                                   data_path=self.data_path(module_id),
+                                   train_path=self.train_path(module_id),
+                                   pulse_path=self.pulse_path(module_id))
+        if self.metrics:
+            raw_data.instrument(profile_dir=self.profile_dir)
+        if self.cache is not None:
+            raw_data.use_cache(self.cache)
+        if self.config.compress_workers:
+            raw_data.use_writer(ChunkWriter(self.config.compress_workers))
+        return raw_data
 
     def list_files(self):
         return [filename
                 for filename in os.listdir(self.file_folder)
                 if "AGIPD" in filename]
 
+    def pipeline(self, raw_data, out_path, pid=None, calibrate=False, module_id=None):
+        """
+        Return the read -> pulse ID filter -> dark calibration -> write pipeline
+        of a raw data file, the stage workers and the mode are taken from the config
+        """
+        queue_size, policy = self.config.queue_size, Precision(self.config.tolerance)
+        stages = [ReadStage(raw_data, self.config.block_size, self.config.read_workers, queue_size,
+                            pid=pid)]
+        if pid is not None:
+            stages.append(TrimStage(pid=pid, num_workers=self.config.read_workers,
+                                    queue_size=queue_size))
+        if calibrate:
+            stages.append(CalibrateStage(self.dark_calib, module_id, self.config.common_mode,
+                                         self.config.calib_workers, queue_size))
+            stages.append(WriteStage(out_path, 'MODULE{:02d}'.format(module_id),
+                                     axes=CalibrateStage.FRAME_AXES, policy=policy))
+        else:
+            stages.append(WriteStage(out_path, reader=raw_data, policy=policy))
+        return Pipeline(stages, mode=self.config.pipeline_mode, metrics=raw_data.metrics,
+                        cache=self.cache)
+
     def save_cell_data(self, module_id, chunk_num, pid):
         raw_data = self.data_file(module_id, chunk_num)
         out_path = self.out_path(module_id, pid, 'PID')
         print('Reading file: {:s}'.format(raw_data.file_path))
-        print('PulseID: {:s}'.format(pid))
+        print('PulseID: {:d}'.format(pid))
         print('Writing to file: {}'.format(out_path))
-        raw_data.save_ordered(out_path, pid)
+        n_frames = self.pipeline(raw_data, out_path, pid).run()
+        print('Number of frames: {:d}'.format(n_frames))
+        self.print_cache_stats()
+
+    def save_reduced_data(self, module_id, chunk_num):
+        raw_data = self.data_file(module_id, chunk_num)
+        out_path = os.path.join(self.config.out_base,
+                                self.OUT_REDUCED_PATH.format(run_number=self.run_number,
+                                                             module_id=module_id,
+                                                             chunk_num=chunk_num))
+        print('Reading file: {:s}'.format(raw_data.file_path))
+        print('Writing per-pulse reduction products to file: {}'.format(out_path))
+        raw_data.save_reduced(out_path)
+
+    def save_pulse_major(self, module_id, chunk_num):
+        raw_data = self.data_file(module_id, chunk_num)
+        out_path = self.pulse_major_path(module_id, chunk_num)
+        if raw_data.file_path == out_path:
+            print('File is already pulse-major: {:s}'.format(out_path))
+            return
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        print('Reading file: {:s}'.format(raw_data.file_path))
+        print('Writing pulse-major file: {}'.format(out_path))
+        n_frames = reorder_pulse_major(raw_data, out_path, self.config.block_size,
+                                       self.config.reorder_mem)
+        print('Number of frames: {:d}'.format(n_frames))
 
     def save_hg_data(self, module_id, chunk_num, pid):
         raw_data = self.data_file(module_id, chunk_num)
+        out_path = self.out_path(module_id, pid, 'HG')
         print('Reading file: {:s}'.format(raw_data.file_path))
-        print('PulseID: {:s}'.format(pid))
-        data = raw_data.get_ordered_data(pids=pid)
-        print('Data shape: {}'.format(data['data'].shape))
+        print('PulseID: {:d}'.format(pid))
         print('Applying dark calibration files: {}'.format(self.dark_calib.data_file.filename))
-        calib_data = AGIPDCalib(data['data'], data['gain'], self.dark_calib, module_id)
-        out_path = self.out_path(module_id, pid, 'HG')
-        print('Getting the High Gain data')
         print('Writing to file: {}'.format(out_path))
+        n_frames = self.pipeline(raw_data, out_path, pid, calibrate=True, module_id=module_id).run()
+        print('Number of frames: {:d}'.format(n_frames))
+        self.print_cache_stats()
+
+    def save_photon_data(self, module_id, chunk_num, pid, zero_adu=None, one_adu=None):
+        """
+        Write high gain data converted to sparse photon counts, the photon levels
+        are fitted on the first block of data if not provided
+        """
+        raw_data = self.data_file(module_id, chunk_num)
+        out_path = self.out_path(module_id, pid, 'PH')
+        print('Reading file: {:s}'.format(raw_data.file_path))
+        print('PulseID: {:d}'.format(pid))
+        print('Writing to file: {}'.format(out_path))
+        blocks = raw_data.prefetch(raw_data.ordered_data_chunk,
+                                   args=(pid,),
+                                   block_size=self.config.block_size,
+                                   depth=self.config.prefetch_depth,
+                                   mem_cap=self.config.prefetch_mem,
+                                   mode=self.config.prefetch_mode,
+                                   pid=pid)
         out_file = h5py.File(out_path, 'w')
-        calib_data.save_data(out_file)
+        photon_group = out_file.create_group('MODULE{:02d}/photons'.format(module_id))
+        for data in blocks:
+            if not data['data'].size:
+                continue
+            with raw_data.stage('calibrate'):
+                calib_data = AGIPDCalib(data['data'], data['gain'], self.dark_calib, module_id,
+                                        self.config.common_mode)
+                # the frames are optimized by photonize, after the levels are estimated
+                hg_data = HGData(calib_data.adu[0] * calib_data.mask[0], optimize=False)
+                if (zero_adu is None or one_adu is None) and self.config.calib_precision:
+                    # the levels are estimated once, on the first block, from a sample
+                    estimate = hg_data.estimate(precision=self.config.calib_precision)
+                    zero_adu, one_adu = estimate.zero_adu, estimate.one_adu
+                    print(estimate)
+                elif zero_adu is None or one_adu is None:
+                    zero_adu, one_adu = hg_data.calibrate()
+                    print('Zero ADU: {:5.1f}, One ADU: {:5.1f}'.format(zero_adu, one_adu))
+                photons = hg_data.photonize(zero_adu, one_adu)
+            with raw_data.stage('write'):
+                photons.append(photon_group)
+                out_file.require_group('data')
+                for key in (raw_data.TRAIN_KEY, raw_data.PULSE_KEY):
+                    if key not in out_file['data']:
+                        out_file['data'].create_dataset(key, data=data[key], maxshape=(None,))
+                    else:
+                        dataset = out_file['data'][key]
+                        dataset.resize(dataset.shape[0] + data[key].size, axis=0)
+                        dataset[-data[key].size:] = data[key]
+        photon_group.attrs['zero_adu'], photon_group.attrs['one_adu'] = zero_adu, one_adu
         out_file.close()
+        raw_data.save_metrics(out_path)
 
 def main():
     parser = argparse.ArgumentParser(description='Run raw AGIPD data processing')
     parser.add_argument('run_number', type=int, help='run number')
-    parser.add_argument('run_type', type=str, choices=['pid', 'hg', 'list'], help='Process type')
+    parser.add_argument('run_type', type=str, choices=['pid', 'hg', 'photons', 'reduce', 'reorder', 'list'], help='Process type')
     parser.add_argument('--config_file', type=str, default=CONFIG_PATH, help='Configuration file')
     parser.add_argument('--chunk_number', type=int, help='chunk number')
     parser.add_argument('--module_id', type=int, help='AGIPD module number')
     parser.add_argument('--pulse_id', type=int, help='PulseID to extract data')
+    parser.add_argument('--zero_adu', type=float, help='Zero photon ADU level')
+    parser.add_argument('--one_adu', type=float, help='One photon ADU level')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Write timing and throughput metrics next to the output file')
+    parser.add_argument('--profile_dir', type=str, help='Folder to dump per-worker cProfile stats')
     args = parser.parse_args()
 
-    process = Process(args.run_number, args.config_file)
+    process = Process(args.run_number, args.config_file,
+                      metrics=args.metrics or args.profile_dir is not None,
+                      profile_dir=args.profile_dir)
     if args.run_type == 'pid':
         process.save_cell_data(module_id=args.module_id,
                                chunk_num=args.chunk_number,
@@ -122,6 +258,16 @@ def main():
         process.save_hg_data(module_id=args.module_id,
                              chunk_num=args.chunk_number,
                              pid=args.pulse_id)
+    elif args.run_type == 'photons':
+        process.save_photon_data(module_id=args.module_id,
+                                 chunk_num=args.chunk_number,
+                                 pid=args.pulse_id,
+                                 zero_adu=args.zero_adu,
+                                 one_adu=args.one_adu)
+    elif args.run_type == 'reduce':
+        process.save_reduced_data(module_id=args.module_id, chunk_num=args.chunk_number)
+    elif args.run_type == 'reorder':
+        process.save_pulse_major(module_id=args.module_id, chunk_num=args.chunk_number)
     elif args.run_type == 'list':
         files = process.list_files()
         print('\n'.join(files))
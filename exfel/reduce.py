@@ -0,0 +1,107 @@
+"""
+reduce.py - one-pass per-pulse reduction module
+"""
+import numpy as np
+
+COUNT_KEY = 'count'
+HITS_KEY = 'hits'
+MEAN_KEY = 'mean'
+VAR_KEY = 'variance'
+SUM_KEY = 'sum'
+MAX_KEY = 'max'
+
+class PulseStats(object):
+    """
+    Running statistics of the frames of one pulse ID: count, hit count,
+    mean and sum of squared deviations (Welford), exact sum (int64 for integer
+    frames, float64 otherwise), maximum
+    """
+    def __init__(self, frames, limit=None):
+        frames = np.asarray(frames)
+        self.count = frames.shape[0]
+        axis = tuple(range(1, frames.ndim))
+        self.hits = self.count if limit is None else int((frames.max(axis=axis) > limit).sum())
+        self.mean = frames.mean(axis=0, dtype=np.float64)
+        self.m2 = ((frames - self.mean)**2).sum(axis=0)
+        self.sum = frames.sum(axis=0, dtype=np.int64 if frames.dtype.kind in 'biu' else np.float64)
+        self.max = frames.max(axis=0)
+
+    def merge(self, other):
+        # Chan et al. pairwise update, exact up to the floating point rounding
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 = self.m2 + other.m2 + delta**2 * (self.count * other.count / count)
+        self.mean = self.mean + delta * (other.count / count)
+        self.sum = self.sum + other.sum
+        self.max = np.maximum(self.max, other.max)
+        self.count, self.hits = count, self.hits + other.hits
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.count
+
+class PulseReducer(object):
+    """
+    One-pass per-pulse ID reducer computing mean, variance, sum, maximum and
+    hit counts over all trains, partial reducers of different workers or MPI
+    ranks are combined with merge
+
+    limit - frames with the maximum above limit count as hits, all frames if None
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.stats = {}
+
+    def update(self, frames, pulse_ids):
+        pulse_ids = np.asarray(pulse_ids)
+        order = np.argsort(pulse_ids, kind='stable')
+        pids, starts = np.unique(pulse_ids[order], return_index=True)
+        for pid, start, stop in zip(pids, starts, np.append(starts[1:], order.size)):
+            stats = PulseStats(frames[np.sort(order[start:stop])], self.limit)
+            if pid in self.stats:
+                self.stats[pid].merge(stats)
+            else:
+                self.stats[pid] = stats
+        return self
+
+    def merge(self, other):
+        for pid, stats in other.stats.items():
+            if pid in self.stats:
+                self.stats[pid].merge(stats)
+            else:
+                self.stats[pid] = stats
+        return self
+
+    def mpi_reduce(self, comm, root=0):
+        """
+        Merge the reducers of all ranks of comm, the result is returned at root
+        """
+        return comm.reduce(self, op=merge_reducers, root=root)
+
+    @property
+    def pulse_ids(self):
+        return np.array(sorted(self.stats))
+
+    def products(self):
+        if not self.stats:
+            raise ValueError('No frames have been reduced')
+        pids = self.pulse_ids
+        stats = [self.stats[pid] for pid in pids]
+        return dict([(COUNT_KEY, np.array([item.count for item in stats])),
+                     (HITS_KEY, np.array([item.hits for item in stats])),
+                     (MEAN_KEY, np.stack([item.mean for item in stats])),
+                     (VAR_KEY, np.stack([item.variance for item in stats])),
+                     (SUM_KEY, np.stack([item.sum for item in stats])),
+                     (MAX_KEY, np.stack([item.max for item in stats]))])
+
+    def save(self, out_file, pulse_key='pulseId'):
+        data_group = out_file.create_group('data')
+        data_group.create_dataset(pulse_key, data=self.pulse_ids)
+        for key, value in self.products().items():
+            data_group.create_dataset(key, data=value, compression='gzip')
+        if self.limit is not None:
+            data_group.attrs['limit'] = self.limit
+
+def merge_reducers(first, second):
+    return first.merge(second)
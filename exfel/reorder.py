@@ -0,0 +1,142 @@
+"""
+reorder.py - out-of-core pulse-major reorder module
+
+Raw files are written train-major, the reorder rewrites them so that the frames
+of every pulse ID lie in one contiguous range, the readers recognize the layout
+by the file attribute and read a pulse ID in a single slice
+"""
+import h5py
+import numpy as np
+from .utils import metrics
+from .utils.chunk_writer import read_frames
+from .utils.prefetch import Prefetcher
+
+LAYOUT_ATTR = 'layout'
+PULSE_MAJOR = 'pulse-major'
+INDEX_GROUP = 'pulse_index'
+INDEX_PULSE_KEY = 'pulseId'
+INDEX_FIRST_KEY = 'first'
+INDEX_COUNT_KEY = 'count'
+REORDER_MEM = 2**30
+
+def frame_paths(reader):
+    """
+    Return the paths of all the frame datasets of a CheetahData family reader
+    """
+    paths = [reader.data_path, getattr(reader, 'gain_path', None), reader.train_path,
+             reader.pulse_path]
+    return [path for idx, path in enumerate(paths) if path is not None and path not in paths[:idx]]
+
+def read_pulse_index(data_file):
+    """
+    Return a dictionary of pulse ID (first frame, number of frames) pairs of a
+    pulse-major file, None if the file has another layout
+    """
+    if data_file.attrs.get(LAYOUT_ATTR) != PULSE_MAJOR:
+        return None
+    index_group = data_file[INDEX_GROUP]
+    return dict((int(pid), (int(first), int(count)))
+                for pid, first, count in zip(index_group[INDEX_PULSE_KEY][()],
+                                             index_group[INDEX_FIRST_KEY][()],
+                                             index_group[INDEX_COUNT_KEY][()]))
+
+def read_rows(start, stop, reader, paths):
+    """
+    Return a dictionary of the frames start:stop of every dataset in paths
+    """
+    rows = dict((path, read_frames(reader.dataset(path), start, stop)) for path in paths)
+    metrics.count(bytes_read=metrics.nbytes(rows), frames_in=stop - start)
+    return rows
+
+class PulseBuffers(object):
+    """
+    Fixed-size output buffers of depth frames for every pulse ID, a full buffer
+    is flushed to the next free frames of its pulse ID range in the output
+
+    outputs - dictionary of output datasets
+    first - first output frame of every pulse ID
+    depth - number of frames buffered per pulse ID
+    """
+    def __init__(self, outputs, first, depth):
+        self.outputs, self.depth = outputs, depth
+        self.buffers = dict((path, np.empty((first.size, depth) + dataset.shape[1:],
+                                            dtype=dataset.dtype))
+                            for path, dataset in outputs.items())
+        self.fill, self.position = np.zeros(first.size, dtype=np.int64), first.astype(np.int64)
+
+    def flush(self, idx):
+        size, position = self.fill[idx], self.position[idx]
+        if size:
+            for path, dataset in self.outputs.items():
+                dataset[position:position + size] = self.buffers[path][idx, :size]
+            self.position[idx] += size
+            self.fill[idx] = 0
+
+    def add(self, idx, rows):
+        size, start = next(iter(rows.values())).shape[0], 0
+        while start < size:
+            fill = self.fill[idx]
+            count = min(self.depth - fill, size - start)
+            for path, values in rows.items():
+                self.buffers[path][idx, fill:fill + count] = values[start:start + count]
+            self.fill[idx] += count
+            start += count
+            if self.fill[idx] == self.depth:
+                self.flush(idx)
+
+    def close(self):
+        for idx in range(self.fill.size):
+            self.flush(idx)
+
+def reorder_pulse_major(readers, out_path, block_size=None, mem_cap=REORDER_MEM):
+    """
+    Rewrite the frames of a reader, or of a list of readers of the sequence files
+    of a module run, into one pulse-major file: the frames of every pulse ID are
+    stored contiguously in their original order, the memory used doesn't depend
+    on the run length
+
+    block_size - number of frames read at a time
+    mem_cap - size of the per-pulse output buffers in bytes
+
+    Returns the number of frames written
+    """
+    readers = readers if isinstance(readers, (list, tuple)) else [readers]
+    paths = frame_paths(readers[0])
+    pulse_ids = np.concatenate([reader.frame_ids()[1] for reader in readers])
+    pids, first, counts = np.unique(np.sort(pulse_ids, kind='stable'), return_index=True,
+                                    return_counts=True)
+    pulse_idxs = np.searchsorted(pids, pulse_ids)
+    with h5py.File(out_path, 'w') as out_file:
+        readers[0]._save_parameters(out_file)
+        outputs = {}
+        for path in paths:
+            dataset = readers[0].dataset(path)
+            outputs[path] = out_file.create_dataset(path, dtype=dataset.dtype,
+                                                    shape=(pulse_ids.size,) + dataset.shape[1:])
+        frame_bytes = sum(int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+                          for dataset in outputs.values())
+        depth = max(int(mem_cap // (frame_bytes * max(pids.size, 1))), 1)
+        buffers = PulseBuffers(outputs, first, depth)
+        offset = 0
+        for reader in readers:
+            # the next block is read while the current one is sorted into the buffers
+            blocks = reader.blocks(block_size)
+            for (start, stop), rows in zip(blocks, Prefetcher(read_rows, blocks, (reader, paths))):
+                block_idxs = pulse_idxs[offset + start:offset + stop]
+                order = np.argsort(block_idxs, kind='stable')
+                idxs, starts = np.unique(block_idxs[order], return_index=True)
+                bounds = np.append(starts, order.size)
+                rows = dict((path, values[order]) for path, values in rows.items())
+                with metrics.stage('write'):
+                    for idx, row_start, row_stop in zip(idxs, bounds[:-1], bounds[1:]):
+                        buffers.add(idx, dict((path, values[row_start:row_stop])
+                                              for path, values in rows.items()))
+            offset += reader.size
+        with metrics.stage('write'):
+            buffers.close()
+        index_group = out_file.create_group(INDEX_GROUP)
+        index_group.create_dataset(INDEX_PULSE_KEY, data=pids)
+        index_group.create_dataset(INDEX_FIRST_KEY, data=first)
+        index_group.create_dataset(INDEX_COUNT_KEY, data=counts)
+        out_file.attrs[LAYOUT_ATTR] = PULSE_MAJOR
+    return pulse_ids.size
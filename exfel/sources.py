@@ -0,0 +1,125 @@
+"""
+sources.py - auxiliary data sources joined to the frames by train and pulse IDs
+"""
+import glob
+import h5py
+import numpy as np
+
+XGM_DATA_PATH = "/INSTRUMENT/SA2_XTD1_XGM/XGM/DOOCS:output/data/intensityTD"
+XGM_TRAIN_PATH = "/INSTRUMENT/SA2_XTD1_XGM/XGM/DOOCS:output/data/trainId"
+CONTROL_TRAIN_PATH = "/INDEX/trainId"
+PULSE_RANGE = 2**16
+
+def sorted_join(keys, frame_keys):
+    """
+    Return the indices of frame_keys in keys and the mask of the frame keys found
+    """
+    order = np.argsort(keys, kind='stable')
+    if not order.size:
+        return np.zeros(frame_keys.shape, dtype=np.int64), np.zeros(frame_keys.shape, dtype=bool)
+    sorted_keys = keys[order]
+    idxs = np.clip(np.searchsorted(sorted_keys, frame_keys), 0, order.size - 1)
+    return order[idxs], sorted_keys[idxs] == frame_keys
+
+class Source(object):
+    """
+    Instrument or control dataset of the run aligned to the frames, the values
+    of the frames missing in the source are NaN
+
+    name - output key of the aligned values
+    file_path - source file path or glob mask of the sequence files
+    data_path - values dataset path
+    train_path - train IDs dataset path
+    pulse_path - pulse IDs dataset path of pulse resolved 1D values, None for per-train values
+    pulse_step - pulse ID step between the columns of per-train pulse arrays
+                 (trains, pulses), the values are per-train if None
+    interpolate - linearly interpolate slow per-train data between the trains it's
+                  recorded at
+    """
+    def __init__(self, name, file_path, data_path, train_path=CONTROL_TRAIN_PATH, pulse_path=None,
+                 pulse_step=None, interpolate=False):
+        if interpolate and (pulse_path is not None or pulse_step is not None):
+            raise ValueError('Only per-train sources can be interpolated: {}'.format(name))
+        self.name, self.file_path = name, file_path
+        self.data_path, self.train_path, self.pulse_path = data_path, train_path, pulse_path
+        self.pulse_step, self.interpolate = pulse_step, interpolate
+        self._data = None
+
+    @classmethod
+    def xgm(cls, file_path, name='xgm', pulse_step=1):
+        """
+        XGM pulse energy source, pulse_step is the AGIPD pulse ID step between
+        the XGM pulses
+        """
+        return cls(name, file_path, XGM_DATA_PATH, XGM_TRAIN_PATH, pulse_step=pulse_step)
+
+    @property
+    def file_paths(self):
+        file_paths = sorted(glob.glob(self.file_path))
+        if not file_paths:
+            raise ValueError('No source files found: {}'.format(self.file_path))
+        return file_paths
+
+    def read(self):
+        """
+        Return the train IDs, the pulse IDs (None if not pulse resolved) and the
+        values of the source, read once
+        """
+        if self._data is None:
+            train_ids, pulse_ids, values = [], [], []
+            for file_path in self.file_paths:
+                with h5py.File(file_path, 'r') as source_file:
+                    train_ids.append(source_file[self.train_path][()].ravel())
+                    values.append(source_file[self.data_path][()])
+                    if self.pulse_path is not None:
+                        pulse_ids.append(source_file[self.pulse_path][()].ravel())
+            self._data = (np.concatenate(train_ids),
+                          np.concatenate(pulse_ids) if pulse_ids else None,
+                          np.concatenate(values))
+        return self._data
+
+    def align(self, train_ids, pulse_ids):
+        """
+        Return the source values of the frames of the given train and pulse IDs
+        """
+        src_trains, src_pulses, values = self.read()
+        train_ids, pulse_ids = np.asarray(train_ids).ravel(), np.asarray(pulse_ids).ravel()
+        if self.interpolate:
+            order = np.argsort(src_trains, kind='stable')
+            return np.interp(train_ids, src_trains[order], values[order].astype(np.float64),
+                             left=np.nan, right=np.nan)
+        if self.pulse_path is not None:
+            idxs, found = sorted_join(src_trains.astype(np.int64) * PULSE_RANGE + src_pulses,
+                                      train_ids.astype(np.int64) * PULSE_RANGE + pulse_ids)
+            result = values[idxs].astype(np.float64)
+        elif self.pulse_step is not None:
+            idxs, found = sorted_join(src_trains, train_ids)
+            columns = pulse_ids // self.pulse_step
+            found &= columns < values.shape[1]
+            result = values[idxs, np.clip(columns, 0, values.shape[1] - 1)].astype(np.float64)
+        else:
+            idxs, found = sorted_join(src_trains, train_ids)
+            result = values[idxs].astype(np.float64)
+        result[~found] = np.nan
+        return result
+
+def source_mask(values, filters, size):
+    """
+    Return the mask of the frames with all the joined values within the filters
+    ranges, frames with NaN values are dropped
+
+    values - dictionary of aligned source values
+    filters - dictionary of (lower, upper) ranges, either bound is skipped if None
+    size - number of frames
+    """
+    mask = np.ones(size, dtype=bool)
+    for name, (lower, upper) in filters.items():
+        if name not in values:
+            raise ValueError('Wrong source name: {}'.format(name))
+        with np.errstate(invalid='ignore'):
+            mask &= ~np.isnan(values[name]).reshape(mask.size, -1).any(axis=1)
+            if lower is not None:
+                mask &= (values[name] >= lower).reshape(mask.size, -1).all(axis=1)
+            if upper is not None:
+                mask &= (values[name] <= upper).reshape(mask.size, -1).all(axis=1)
+    return mask
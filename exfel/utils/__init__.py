@@ -2,6 +2,7 @@
 utils - utility package
 """
 from .utilities import HIGH_GAIN, MEDIUM_GAIN, LOW_GAIN
-from .utilities import DATA_KEY, GAIN_KEY, PULSE_KEY, TRAIN_KEY
-from .utilities import CHEETAH_PATH, OUT_PATH
-from .utilities import CORES_COUNT, apply_agipd_geom, make_output_dir
+from .utilities import DATA_KEY, GAIN_KEY, PULSE_KEY, TRAIN_KEY, BG_KEY, PUPIL_KEY
+from .utilities import CHEETAH_PATH, CHEETAH_RUN_PATH, CHEETAH_FILE_MASK, OUT_PATH, CACHE_PATH, BG_ROI, PUPIL_ROI
+from .utilities import slab_shape, pixel_coordinates, pixel_maps, roi_index, normalize_frames
+from .utilities import CORES_COUNT, AGIPD_GEOM_PATH, apply_agipd_geom, load_geometry, make_output_dir
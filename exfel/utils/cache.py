@@ -0,0 +1,104 @@
+"""
+cache.py - content-addressed on-disk cache of processed data blocks
+"""
+import os
+import hashlib
+import numpy as np
+from .utilities import CACHE_PATH, make_output_dir
+
+BLOCKS_PATH = os.path.join(CACHE_PATH, 'blocks')
+CACHE_EXT = '.npz'
+
+def file_identity(path):
+    """
+    Return a tuple identifying the content of the file at path: absolute path,
+    size and modification time
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def cache_key(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+class BlockCache(object):
+    """
+    On-disk cache of data chunk dictionaries addressed by a hash of everything
+    they were computed from, the least recently used blocks are evicted once the
+    cache grows over max_bytes
+
+    cache_dir - cache folder
+    max_bytes - cache size budget in bytes
+    """
+    def __init__(self, cache_dir=BLOCKS_PATH, max_bytes=50 * 2**30):
+        self.cache_dir, self.max_bytes = cache_dir, max_bytes
+        self.hits, self.misses = 0, 0
+        make_output_dir(self.cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_EXT)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """
+        Return the cached chunk dictionary, None if the key is not cached
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as cache_file:
+                chunk = dict((name, cache_file[name]) for name in cache_file.files)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return chunk
+
+    def put(self, key, chunk):
+        """
+        Store a chunk dictionary, an empty dictionary stands for a chunk with no
+        frames left
+        """
+        tmp_path = '{:s}.{:d}.tmp'.format(self.path(key), os.getpid())
+        with open(tmp_path, 'wb') as tmp_file:
+            np.savez(tmp_file, **chunk)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(CACHE_EXT):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, filename))
+        return sorted(entries)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            os.remove(os.path.join(self.cache_dir, filename))
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.,
+                'size': self.size}
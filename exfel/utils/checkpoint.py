@@ -0,0 +1,212 @@
+"""
+checkpoint.py - task journal and resumable output writer module
+
+A job writes the output of every completed task before it records the task
+range and its output offset in a small journal next to the output, a job
+restarted with the same parameters reopens the partial output and skips the
+recorded tasks
+"""
+import os
+import json
+import h5py
+import numpy as np
+from .utilities import BG_KEY, PUPIL_KEY, make_output_dir
+from .precision import Precision
+from .preview import PREVIEW_FACTORS, PREVIEW_GROUP, PREVIEW_KEY, THUMBNAIL_KEY
+from .preview import train_sums, merge_train_sums, save_thumbnails
+
+JOURNAL_EXT = '.journal'
+DATA_GROUP = 'data'
+FRAMES_KEYS = ('data', 'trainID', 'pulseID', BG_KEY, PUPIL_KEY)
+THUMBNAIL_BLOCK = 1000
+
+def dtype_range(dtype):
+    """
+    Return the (vmin, vmax) range of an integer dtype, None for other dtypes
+    """
+    if np.dtype(dtype).kind not in 'iu':
+        return None
+    info = np.iinfo(dtype)
+    return int(info.min), int(info.max)
+
+def journal_path(out_path):
+    return os.path.splitext(out_path)[0] + JOURNAL_EXT
+
+class TaskJournal(object):
+    """
+    Append-only log of the completed (start, stop) task ranges of a job and of
+    their (output offset, number of output frames), every record is flushed to
+    disk before the next task is written
+
+    path - journal file path
+    header - JSON serializable description of the job, a journal of another job
+             is discarded
+    """
+    def __init__(self, path, header):
+        self.path, self.header = path, header
+        self.tasks = {}
+        self.resumed = False
+        self.load()
+
+    def load(self):
+        records = []
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # the last record is torn if the job was killed while writing it
+                        break
+        if records and records[0].get('header') == self.header:
+            self.tasks = dict((tuple(record['task']), (record['offset'], record['count']))
+                              for record in records[1:])
+            self.resumed = True
+        self.rewrite()
+
+    def rewrite(self):
+        make_output_dir(os.path.dirname(os.path.abspath(self.path)))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as journal_file:
+            journal_file.write(json.dumps({'header': self.header}) + '\n')
+            for task, (offset, count) in sorted(self.tasks.items(), key=lambda item: item[1]):
+                journal_file.write(json.dumps({'task': list(task), 'offset': offset,
+                                               'count': count}) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        self.tasks, self.resumed = {}, False
+        self.rewrite()
+
+    @property
+    def size(self):
+        return max([offset + count for offset, count in self.tasks.values()] or [0])
+
+    def missing(self, tasks):
+        """
+        Return the tasks not recorded in the journal
+        """
+        return [task for task in tasks if tuple(task) not in self.tasks]
+
+    def commit(self, task, offset, count):
+        with open(self.path, 'a') as journal_file:
+            journal_file.write(json.dumps({'task': [int(value) for value in task],
+                                           'offset': int(offset), 'count': int(count)}) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self.tasks[tuple(task)] = (int(offset), int(count))
+
+class CheckpointWriter(object):
+    """
+    Single writer appending the trimmed frames of completed tasks to the
+    resizable datasets of the output file, every append is journaled, the
+    datasets are compressed and encoded by the precision policy in the dtype
+    picked from the declared range of the input dtypes, so that the appends
+    of a resumed job are stored in the same dtype
+
+    out_path - output file path
+    header - JSON serializable description of the job
+    frame_shape - assembled frame shape
+    dtypes - dtypes of the frames, train IDs, pulse IDs, background and pupil intensities
+    preview - write the binned frame pyramid and the per-train thumbnails
+    policy - output precision policy, lossless Precision by default
+    """
+    def __init__(self, out_path, header, frame_shape, dtypes, preview=False, policy=None):
+        self.out_path, self.preview, self.policy = out_path, preview, policy or Precision()
+        self.frame_shape, self.dtypes = tuple(frame_shape), [np.dtype(dtype) for dtype in dtypes]
+        self.journal = TaskJournal(journal_path(out_path), header)
+        self.out_file = None
+        if self.journal.resumed:
+            try:
+                self.out_file = h5py.File(out_path, 'r+')
+                self.datasets()
+            except (OSError, KeyError):
+                # the partial output is unreadable, the job starts over
+                if self.out_file is not None:
+                    self.out_file.close()
+                self.out_file = None
+                self.journal.reset()
+        if self.out_file is None:
+            make_output_dir(os.path.dirname(os.path.abspath(out_path)))
+            self.out_file = h5py.File(out_path, 'w')
+            self.create_datasets()
+        self.size = self.journal.size
+        # frames written after the last journaled task are overwritten
+        self.resize(self.size)
+
+    @property
+    def resumed(self):
+        return self.journal.resumed
+
+    def missing(self, tasks):
+        return self.journal.missing(tasks)
+
+    def create_datasets(self):
+        data_group = self.out_file.create_group(DATA_GROUP)
+        self.policy.create_dataset(data_group, FRAMES_KEYS[0],
+                                   np.zeros((0,) + self.frame_shape, dtype=self.dtypes[0]),
+                                   axis=0, vrange=dtype_range(self.dtypes[0]),
+                                   chunks=(1,) + self.frame_shape, compression='gzip')
+        for key, dtype in zip(FRAMES_KEYS[1:], self.dtypes[1:]):
+            self.policy.create_dataset(data_group, key, np.zeros(0, dtype=dtype), axis=0,
+                                       vrange=dtype_range(dtype))
+        if self.preview:
+            preview_group = self.out_file.create_group(PREVIEW_GROUP)
+            for factor in PREVIEW_FACTORS:
+                level_shape = tuple(size // factor for size in self.frame_shape)
+                preview_group.create_dataset(PREVIEW_KEY.format(factor), shape=(0,) + level_shape,
+                                             maxshape=(None,) + level_shape,
+                                             chunks=(1,) + level_shape, dtype=np.float32,
+                                             compression='gzip')
+
+    def datasets(self):
+        datasets = [self.out_file[DATA_GROUP][key] for key in FRAMES_KEYS]
+        if self.preview:
+            datasets.extend(self.out_file[PREVIEW_GROUP][PREVIEW_KEY.format(factor)]
+                            for factor in PREVIEW_FACTORS)
+        return datasets
+
+    def resize(self, size):
+        for dataset in self.datasets():
+            if dataset.shape[0] != size:
+                dataset.resize(size, axis=0)
+
+    def append(self, task, chunk, pyramid=None):
+        """
+        Write the (data, train IDs, pulse IDs, background, pupil) chunk of a task
+        and the preview pyramid of its frames, then record the task in the journal
+
+        Returns the output offset of the chunk
+        """
+        offset, count = self.size, chunk[1].size
+        for key, values in zip(FRAMES_KEYS, chunk):
+            self.policy.append(self.out_file[DATA_GROUP], key, values, axis=0)
+        if self.preview:
+            preview_group = self.out_file[PREVIEW_GROUP]
+            for factor, level in pyramid.items():
+                dataset = preview_group[PREVIEW_KEY.format(factor)]
+                dataset.resize(offset + count, axis=0)
+                dataset[offset:offset + count] = level
+        self.out_file.flush()
+        self.journal.commit(task, offset, count)
+        self.size += count
+        return offset
+
+    def save_thumbnails(self):
+        """
+        Write the per-train thumbnails once all the tasks are written
+        """
+        preview_group = self.out_file[PREVIEW_GROUP]
+        if THUMBNAIL_KEY in preview_group:
+            return
+        top = preview_group[PREVIEW_KEY.format(max(PREVIEW_FACTORS))]
+        train_ids = self.out_file[DATA_GROUP][FRAMES_KEYS[1]]
+        parts = [train_sums(top[start:start + THUMBNAIL_BLOCK],
+                            train_ids[start:start + THUMBNAIL_BLOCK])
+                 for start in range(0, max(self.size, 1), THUMBNAIL_BLOCK)]
+        save_thumbnails(self.out_file, *merge_train_sums(parts))
+
+    def close(self):
+        self.out_file.close()
@@ -0,0 +1,139 @@
+"""
+chunk_writer.py - parallel HDF5 chunk compression module
+
+Worker processes deflate whole HDF5 chunks and the writing process stores the
+compressed bytes with write_direct_chunk, the datasets are ordinary gzip
+datasets readable by any HDF5 reader. The reading counterpart inflates the raw
+chunks read with read_direct_chunk, so that decompression is timed apart from
+the read
+"""
+import concurrent.futures
+import itertools
+import zlib
+import h5py
+import numpy as np
+from h5py._hl.filters import guess_chunk
+from .utilities import CORES_COUNT
+from . import metrics
+
+GZIP_LEVEL = 4
+BLOCK_BYTES = 64 * 2**20
+
+def chunk_offsets(shape, chunks):
+    """
+    Return the offsets of all the chunks of a dataset in the storage order
+    """
+    return itertools.product(*[range(0, size, chunk) for size, chunk in zip(shape, chunks)])
+
+def compress_block(block, chunks, level=GZIP_LEVEL):
+    """
+    Deflate every chunk of a block of frames, the edge chunks are zero padded
+    to the full chunk shape as HDF5 stores them
+
+    Returns a list of (offset in the block, compressed bytes) pairs
+    """
+    result = []
+    for offset in chunk_offsets(block.shape, chunks):
+        chunk = block[tuple(slice(start, start + size) for start, size in zip(offset, chunks))]
+        if chunk.shape != tuple(chunks):
+            padded = np.zeros(chunks, dtype=chunk.dtype)
+            padded[tuple(slice(0, size) for size in chunk.shape)] = chunk
+            chunk = padded
+        result.append((offset, zlib.compress(np.ascontiguousarray(chunk).tobytes(), level)))
+    return result
+
+def deflated(dataset):
+    """
+    Check if the chunks of an h5py dataset are only gzip compressed, so that
+    they can be inflated with zlib
+    """
+    return (dataset.chunks is not None and dataset.compression == 'gzip' and not dataset.shuffle
+            and not dataset.fletcher32 and dataset.scaleoffset is None)
+
+def inflate_frames(dataset, start, stop):
+    """
+    Return the frames start:stop of a gzip compressed dataset, the raw chunks
+    are timed as the 'read' stage and their inflation as the 'decompress' stage
+    """
+    chunks, shape = dataset.chunks, dataset.shape
+    stop = min(stop, shape[0])
+    frames = np.empty((max(stop - start, 0),) + shape[1:], dtype=dataset.dtype)
+    if stop <= start:
+        return frames
+    first = start // chunks[0] * chunks[0]
+    for offset in chunk_offsets((stop - first,) + shape[1:], chunks):
+        origin = (first + offset[0],) + offset[1:]
+        lower, upper = max(start, origin[0]), min(stop, origin[0] + chunks[0])
+        sizes = [min(chunk_size, size - pos)
+                 for pos, chunk_size, size in zip(origin[1:], chunks[1:], shape[1:])]
+        out_sel = (slice(lower - start, upper - start),) + \
+                  tuple(slice(pos, pos + size) for pos, size in zip(origin[1:], sizes))
+        with metrics.stage('read'):
+            if dataset.id.get_chunk_info_by_coord(origin).byte_offset is None:
+                # the chunk isn't allocated, HDF5 serves the fill value
+                frames[out_sel] = dataset[(slice(lower, upper),) +
+                                          tuple(slice(pos, pos + size)
+                                                for pos, size in zip(origin[1:], sizes))]
+                continue
+            filter_mask, chunk_bytes = dataset.id.read_direct_chunk(origin)
+        with metrics.stage('decompress'):
+            # the filter is skipped for the chunks that don't compress
+            if not filter_mask & 1:
+                chunk_bytes = zlib.decompress(chunk_bytes)
+            chunk = np.frombuffer(chunk_bytes, dtype=dataset.dtype).reshape(chunks)
+        frames[out_sel] = chunk[(slice(lower - origin[0], upper - origin[0]),) +
+                                tuple(slice(0, size) for size in sizes)]
+    return frames
+
+def read_frames(dataset, start, stop, index=()):
+    """
+    Return dataset[(slice(start, stop),) + index], the gzip chunks of h5py
+    datasets are inflated apart from the read to time the decompression
+    """
+    if not index and isinstance(dataset, h5py.Dataset) and deflated(dataset):
+        return inflate_frames(dataset, start, stop)
+    with metrics.stage('read'):
+        return dataset[(slice(start, stop),) + index]
+
+class ChunkWriter(object):
+    """
+    Writer of gzip compressed datasets with the chunks compressed in a process pool
+
+    num_workers - number of compressing processes
+    level - gzip compression level
+    block_bytes - approximate size of a block of frames sent to a worker
+    """
+    def __init__(self, num_workers=CORES_COUNT, level=GZIP_LEVEL, block_bytes=BLOCK_BYTES):
+        if not 0 <= level <= 9:
+            raise ValueError('Wrong gzip compression level: {}'.format(level))
+        self.num_workers, self.level, self.block_bytes = num_workers, level, block_bytes
+
+    def blocks(self, array, chunks):
+        frame_bytes = max(array[:1].nbytes, 1)
+        step = chunks[0] * max(self.block_bytes // (frame_bytes * chunks[0]), 1)
+        return [(start, array[start:start + step]) for start in range(0, array.shape[0], step)]
+
+    def create_dataset(self, group, key, data, policy=None):
+        """
+        Write data encoded with the Precision policy to a new gzip compressed
+        dataset of group
+        """
+        if policy is None:
+            array, attrs = np.asarray(data), {}
+        else:
+            array, attrs = policy.encode(data, key)
+        if array.ndim == 0 or array.size == 0:
+            dataset = group.create_dataset(key, data=array)
+        else:
+            chunks = guess_chunk(array.shape, None, array.dtype.itemsize)
+            dataset = group.create_dataset(key, shape=array.shape, dtype=array.dtype, chunks=chunks,
+                                           compression='gzip', compression_opts=self.level)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                futures = [(start, executor.submit(compress_block, block, chunks, self.level))
+                           for start, block in self.blocks(array, chunks)]
+                for start, fut in futures:
+                    for offset, chunk_bytes in fut.result():
+                        dataset.id.write_direct_chunk((start + offset[0],) + offset[1:], chunk_bytes)
+        for name, value in attrs.items():
+            dataset.attrs[name] = value
+        return dataset
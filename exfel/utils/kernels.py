@@ -0,0 +1,251 @@
+"""
+kernels.py - hot loop kernels with NumPy and optional Numba backends
+
+The NumPy backend is always available, the Numba backend runs fused parallel
+kernels without the full-size temporaries of the NumPy expressions. The backend
+is chosen with set_backend or the EXFEL_BACKEND environment variable: 'numpy',
+'numba' or 'auto' (Numba if it is installed)
+"""
+import os
+import threading
+import numpy as np
+
+BACKENDS = ('auto', 'numpy', 'numba')
+BACKEND_ENV = 'EXFEL_BACKEND'
+THREADING_ENV = 'NUMBA_THREADING_LAYER'
+
+_KERNELS = {}
+_LAUNCH_LOCK = threading.Lock()
+
+def numba_available():
+    try:
+        import numba
+    except ImportError:
+        return False
+    return True
+
+def set_backend(name):
+    """
+    Choose the kernels backend, the choice is inherited by the worker processes
+    started afterwards
+    """
+    if name not in BACKENDS:
+        raise ValueError('Wrong kernels backend: {}'.format(name))
+    if name == 'numba' and not numba_available():
+        raise ValueError('Numba backend is not available')
+    os.environ[BACKEND_ENV] = name
+
+def get_backend():
+    name = os.environ.get(BACKEND_ENV, 'auto')
+    if name not in BACKENDS:
+        raise ValueError('Wrong kernels backend: {}'.format(name))
+    if name == 'auto':
+        return 'numba' if numba_available() else 'numpy'
+    return name
+
+def numba_kernels():
+    """
+    Compile the Numba kernels on first use, the machine code is cached on disk
+    """
+    if _KERNELS:
+        return _KERNELS
+    import numba
+    if THREADING_ENV not in os.environ:
+        # the pools fork their workers after the parent ran the kernels, the TBB
+        # layer hangs the parent at exit and the OpenMP layer crashes the workers
+        numba.config.THREADING_LAYER = 'workqueue'
+
+    @numba.njit(parallel=True, cache=True)
+    def frame_max(flat):
+        out = np.empty(flat.shape[0], dtype=flat.dtype)
+        for n in numba.prange(flat.shape[0]):
+            vmax = flat[n, 0]
+            for idx in range(1, flat.shape[1]):
+                # NaN propagates as in ndarray.max
+                if vmax != vmax:
+                    break
+                if flat[n, idx] > vmax or flat[n, idx] != flat[n, idx]:
+                    vmax = flat[n, idx]
+            out[n] = vmax
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def histogram(flat, edges, n_parts):
+        n_bins = edges.size - 1
+        first, last = edges[0], edges[-1]
+        norm = n_bins / (last - first)
+        counts = np.zeros((n_parts, n_bins), dtype=np.int64)
+        for part in numba.prange(n_parts):
+            for idx in range(part * flat.size // n_parts, (part + 1) * flat.size // n_parts):
+                val = np.float64(flat[idx])
+                if not (val >= first and val <= last):
+                    continue
+                # the same bin search as np.histogram with uniform bins
+                bin_idx = int((val - first) * norm)
+                if bin_idx == n_bins:
+                    bin_idx -= 1
+                if val < edges[bin_idx]:
+                    bin_idx -= 1
+                elif bin_idx != n_bins - 1 and val >= edges[bin_idx + 1]:
+                    bin_idx += 1
+                counts[part, bin_idx] += 1
+        return counts.sum(axis=0)
+
+    @numba.njit(parallel=True, cache=True)
+    def dark_bin_index(raw, offset, mask, edges):
+        n_bins = edges.size - 1
+        first, last = edges[0], edges[-1]
+        norm = n_bins / (last - first)
+        out = np.empty(raw.shape, dtype=np.int64)
+        for n in numba.prange(raw.shape[0]):
+            for idx in range(raw.shape[1]):
+                val = (np.float64(raw[n, idx]) - offset[idx]) * mask[idx]
+                if not (val >= first and val <= last):
+                    out[n, idx] = -1
+                    continue
+                bin_idx = int((val - first) * norm)
+                if bin_idx == n_bins:
+                    bin_idx -= 1
+                if val < edges[bin_idx]:
+                    bin_idx -= 1
+                elif bin_idx != n_bins - 1 and val >= edges[bin_idx + 1]:
+                    bin_idx += 1
+                out[n, idx] = bin_idx
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def calibrate(raw, gain, hg_offset, mg_offset, gain_level, bad_mask, flat_start, flat_stop,
+                  gains, adu, mask, data, zero_levels):
+        n_ss, n_fs = raw.shape[1], raw.shape[2]
+        for n in numba.prange(raw.shape[0]):
+            total = 0.
+            for ss in range(flat_start, flat_stop):
+                for fs in range(n_fs):
+                    total += raw[n, ss, fs] - hg_offset[ss, fs]
+            zero_levels[n] = 0.
+            if flat_stop > flat_start:
+                zero_levels[n] = total / ((flat_stop - flat_start) * n_fs)
+            for ss in range(n_ss):
+                for fs in range(n_fs):
+                    adu[0, n, ss, fs] = raw[n, ss, fs] - hg_offset[ss, fs] - zero_levels[n]
+                    adu[1, n, ss, fs] = raw[n, ss, fs] - mg_offset[ss, fs]
+                    mask[0, n, ss, fs] = (gain[n, ss, fs] < gain_level[ss, fs]) * bad_mask[ss, fs]
+                    mask[1, n, ss, fs] = (gain[n, ss, fs] > gain_level[ss, fs]) * bad_mask[ss, fs]
+                    data[0, n, ss, fs] = adu[0, n, ss, fs] * mask[0, n, ss, fs] * gains[0]
+                    data[1, n, ss, fs] = adu[1, n, ss, fs] * mask[1, n, ss, fs] * gains[1]
+
+    @numba.njit(parallel=True, cache=True)
+    def assemble(flat, rows, cols, out):
+        for n in numba.prange(flat.shape[0]):
+            for idx in range(flat.shape[1]):
+                out[n, rows[idx], cols[idx]] = flat[n, idx]
+
+    _KERNELS.update(frame_max=frame_max, histogram=histogram, dark_bin_index=dark_bin_index,
+                    calibrate=calibrate, assemble=assemble)
+    return _KERNELS
+
+def launch(name, *args):
+    """
+    Run the Numba kernel name, the workqueue threading layer doesn't allow
+    concurrent launches from several threads
+    """
+    with _LAUNCH_LOCK:
+        return numba_kernels()[name](*args)
+
+def native(array):
+    """
+    Return a C-contiguous native byte order array, Numba kernels accept no other
+    """
+    array = np.asarray(array)
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('='))
+
+def frame_max(frames):
+    """
+    Return the maximum of every frame
+    """
+    if get_backend() == 'numba' and frames.size:
+        return launch('frame_max', native(frames).reshape(frames.shape[0], -1))
+    return np.asarray(frames).reshape(frames.shape[0], -1).max(axis=1)
+
+def histogram(data, bins, roi):
+    """
+    Return the counts of np.histogram(data, bins, range=roi), data values are
+    binned as float64
+    """
+    edges = np.linspace(float(roi[0]), float(roi[1]), bins + 1)
+    if get_backend() == 'numba':
+        flat = native(data).ravel()
+        # the threading layer is chosen by numba_kernels before the threads are started
+        numba_kernels()
+        from numba import get_num_threads
+        return launch('histogram', flat, edges, max(min(get_num_threads(), flat.size), 1))
+    flat = np.asarray(data, dtype=np.float64).ravel()
+    return np.histogram(flat, bins, range=(edges[0], edges[-1]))[0]
+
+def dark_bin_index(raw_data, offset, mask, bins, roi):
+    """
+    Return histogram bin indices of dark corrected frames (raw_data - offset) * mask
+    computed in float64, the bins are the ones of np.histogram(data, bins, range=roi),
+    values outside of roi get -1
+    """
+    offset, mask = np.asarray(offset, dtype=np.float64), np.asarray(mask, dtype=np.float64)
+    edges = np.linspace(float(roi[0]), float(roi[1]), bins + 1)
+    if get_backend() == 'numba':
+        flat = native(raw_data).reshape(raw_data.shape[0], -1)
+        idxs = launch('dark_bin_index', flat, native(offset).ravel(), native(mask).ravel(), edges)
+        return idxs.reshape(raw_data.shape)
+    data = (raw_data - offset) * mask
+    # the same bin search as np.histogram with uniform bins
+    inside = (data >= edges[0]) & (data <= edges[-1])
+    idxs = (np.where(inside, data - edges[0], 0) * (bins / (edges[-1] - edges[0]))).astype(np.int64)
+    idxs[idxs == bins] -= 1
+    idxs -= data < edges[idxs]
+    idxs += (data >= edges[idxs + 1]) & (idxs != bins - 1)
+    idxs[~inside] = -1
+    return idxs
+
+def calibrate(raw_data, raw_gain, hg_offset, mg_offset, gain_level, bad_mask, flat_roi, gains):
+    """
+    AGIPD dark calibration of frames (N, ss, fs), the arithmetic is carried in float64
+
+    hg_offset, mg_offset - high and medium gain dark offsets
+    gain_level - medium gain digital level, pixels below are high gain, above are medium gain
+    bad_mask - good pixels mask
+    flat_roi - rows range of the high gain zero level flat correction, no correction if None
+    gains - high and medium gain ADU to energy factors
+
+    Returns adu (2, N, ss, fs), mask (2, N, ss, fs), data (2, N, ss, fs), zero levels (N,)
+    """
+    hg_offset, mg_offset = np.asarray(hg_offset, np.float64), np.asarray(mg_offset, np.float64)
+    gains, bad_mask = np.asarray(gains, np.float64), np.asarray(bad_mask)
+    mask_dtype = np.result_type(np.uint8, bad_mask.dtype)
+    if get_backend() == 'numba':
+        shape = (2,) + raw_data.shape
+        adu, mask, data = np.empty(shape), np.empty(shape, mask_dtype), np.empty(shape)
+        zero_levels = np.empty(raw_data.shape[0])
+        launch('calibrate', native(raw_data), native(raw_gain), native(hg_offset),
+               native(mg_offset), native(gain_level), native(bad_mask),
+               *(flat_roi or (0, 0)), gains, adu, mask, data, zero_levels)
+        return adu, mask, data, zero_levels
+    adu = np.stack((raw_data - hg_offset, raw_data - mg_offset))
+    zero_levels = np.zeros(raw_data.shape[0])
+    if flat_roi:
+        zero_levels = adu[0, :, flat_roi[0]:flat_roi[1]].mean(axis=(1, 2))
+        adu[0] = (adu[0].T - zero_levels).T
+    mask = np.stack(((raw_gain < gain_level).astype(np.uint8),
+                     (raw_gain > gain_level).astype(np.uint8))) * bad_mask
+    data = ((adu * mask).T * gains).T
+    return adu, mask.astype(mask_dtype), data, zero_levels
+
+def assemble(frames, rows, cols, shape, dtype=None):
+    """
+    Scatter detector slab frames into assembled images of the given shape,
+    rows and cols are the image pixel maps of utils.pixel_maps
+    """
+    out = np.zeros((frames.shape[0],) + tuple(shape), dtype=dtype or frames.dtype)
+    if get_backend() == 'numba' and frames.size:
+        flat = native(frames).reshape(frames.shape[0], -1)
+        launch('assemble', flat, native(rows).ravel(), native(cols).ravel(), out)
+        return out
+    out[:, rows, cols] = frames
+    return out
@@ -0,0 +1,214 @@
+"""
+metrics.py - throughput and timing instrumentation module
+"""
+import os
+import csv
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+STAGES = ('open', 'read', 'decompress', 'filter', 'calibrate', 'geometry', 'write')
+COUNTERS = ('bytes_read', 'bytes_written', 'frames_in', 'frames_out')
+METRICS_EXT = {'json': '.metrics.json', 'csv': '.metrics.csv'}
+
+_ACTIVE = None
+_PROFILER = None
+
+def metrics_path(out_path, fmt='json'):
+    return os.path.splitext(out_path)[0] + METRICS_EXT[fmt]
+
+class TaskMetrics(object):
+    """
+    Timings and counters of a single task, filled in by the process running it
+
+    name - task name
+    worker - worker identifier (process id by default)
+    """
+    def __init__(self, name, worker=None):
+        self.name = name
+        self.worker = os.getpid() if worker is None else worker
+        self.stages = dict((stage, 0.) for stage in STAGES)
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.start = self.stop = time.time()
+
+    @property
+    def elapsed(self):
+        return self.stop - self.start
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.time() - start
+
+    def count(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + int(value)
+
+    def as_dict(self):
+        return {'name': self.name, 'worker': self.worker, 'start': self.start,
+                'stop': self.stop, 'elapsed': self.elapsed,
+                'stages': dict(self.stages), 'counters': dict(self.counters)}
+
+    @classmethod
+    def from_dict(cls, record):
+        task = cls(record['name'], record['worker'])
+        task.start, task.stop = record['start'], record['stop']
+        task.stages.update(record['stages'])
+        task.counters.update(record['counters'])
+        return task
+
+@contextmanager
+def stage(name):
+    """
+    Time a processing stage of the task running in the current process,
+    no-op if the task is not instrumented
+    """
+    if _ACTIVE is None:
+        yield
+    else:
+        with _ACTIVE.stage(name):
+            yield
+
+def count(**counters):
+    """
+    Increment counters of the task running in the current process,
+    no-op if the task is not instrumented
+    """
+    if _ACTIVE is not None:
+        _ACTIVE.count(**counters)
+
+def nbytes(chunk):
+    return sum(getattr(value, 'nbytes', 0) for value in chunk.values())
+
+def profile_path(profile_dir, worker=None):
+    return os.path.join(profile_dir, 'worker-{:d}.prof'.format(worker or os.getpid()))
+
+def worker_profiler():
+    """
+    Return the cProfile.Profile of the current worker process, shared by all
+    the tasks the worker runs
+    """
+    global _PROFILER
+    # a forked worker inherits the profiler of its parent
+    if _PROFILER is None or _PROFILER[0] != os.getpid():
+        _PROFILER = (os.getpid(), cProfile.Profile())
+    return _PROFILER[1]
+
+def run_task(func, name, profile_dir, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in a worker and collect its metrics, the worker
+    profile accumulated over all its tasks so far is dumped to profile_dir
+
+    Returns a tuple of func result and TaskMetrics record dictionary
+    """
+    global _ACTIVE
+    _ACTIVE = TaskMetrics(name)
+    profiler = worker_profiler() if profile_dir else None
+    try:
+        if profiler:
+            profiler.enable()
+        result = func(*args, **kwargs)
+        _ACTIVE.stop = time.time()
+        return result, _ACTIVE.as_dict()
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(profile_path(profile_dir, _ACTIVE.worker))
+        _ACTIVE = None
+
+class Metrics(object):
+    """
+    Run metrics collector, aggregates TaskMetrics records from pool workers
+
+    profile_dir - folder to dump per-worker cProfile statistics, no profiling if None
+    hooks - list of callables invoked with every TaskMetrics record received
+    """
+    def __init__(self, profile_dir=None, hooks=None):
+        self.profile_dir = profile_dir
+        self.hooks = list(hooks) if hooks else []
+        self.tasks = []
+        self.num_workers = 1
+        self.start = time.time()
+        self.stop = None
+        self.main = TaskMetrics('main')
+
+    def __getstate__(self):
+        # hooks may not be picklable and records are of no use to the workers
+        return {'profile_dir': self.profile_dir, 'hooks': [], 'tasks': [],
+                'num_workers': self.num_workers, 'start': self.start,
+                'stop': self.stop, 'main': TaskMetrics('main')}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def add_task(self, record):
+        task = record if isinstance(record, TaskMetrics) else TaskMetrics.from_dict(record)
+        self.tasks.append(task)
+        for hook in self.hooks:
+            hook(task)
+        return task
+
+    @contextmanager
+    def stage(self, name):
+        with self.main.stage(name):
+            yield
+
+    def count(self, **counters):
+        self.main.count(**counters)
+
+    def finish(self):
+        self.stop = time.time()
+        self.main.stop = self.stop
+
+    @property
+    def elapsed(self):
+        return (self.stop or time.time()) - self.start
+
+    @property
+    def idle_time(self):
+        busy = sum(task.elapsed for task in self.tasks)
+        return max(self.num_workers * self.elapsed - busy, 0.)
+
+    def summary(self):
+        stages = dict((name, 0.) for name in STAGES)
+        counters = dict((name, 0) for name in COUNTERS)
+        for task in self.tasks + [self.main]:
+            for key, value in task.stages.items():
+                stages[key] = stages.get(key, 0.) + value
+            for key, value in task.counters.items():
+                counters[key] = counters.get(key, 0) + value
+        elapsed = self.elapsed
+        return {'elapsed': elapsed, 'num_workers': self.num_workers,
+                'num_tasks': len(self.tasks), 'idle_time': self.idle_time,
+                'stages': stages, 'counters': counters,
+                'read_rate': counters['bytes_read'] / elapsed if elapsed else 0.,
+                'write_rate': counters['bytes_written'] / elapsed if elapsed else 0.,
+                'frame_rate': counters['frames_in'] / elapsed if elapsed else 0.}
+
+    def save(self, out_path, fmt='json'):
+        """
+        Write the metrics file next to the output file out_path
+
+        fmt - 'json' for the summary and every task record, 'csv' for a table of task records
+        """
+        path = metrics_path(out_path, fmt)
+        records = [task.as_dict() for task in self.tasks + [self.main]]
+        if fmt == 'json':
+            with open(path, 'w') as metrics_file:
+                json.dump({'summary': self.summary(), 'tasks': records}, metrics_file, indent=2)
+        elif fmt == 'csv':
+            with open(path, 'w', newline='') as metrics_file:
+                writer = csv.writer(metrics_file)
+                writer.writerow(('name', 'worker', 'elapsed') + STAGES + COUNTERS)
+                for rec in records:
+                    writer.writerow([rec['name'], rec['worker'], rec['elapsed']] +
+                                    [rec['stages'].get(key, 0.) for key in STAGES] +
+                                    [rec['counters'].get(key, 0) for key in COUNTERS])
+        else:
+            raise ValueError('Wrong metrics format: {}'.format(fmt))
+        return path
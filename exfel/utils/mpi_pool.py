@@ -7,113 +7,249 @@ import os
 import h5py
 import numpy as np
 from mpi4py import MPI
-from .utilities import apply_agipd_geom, make_output_dir
+from .utilities import make_output_dir, pixel_maps, roi_index, normalize_frames
+from .utilities import BG_ROI, PUPIL_ROI
+from .metrics import TaskMetrics, run_task
+from .cache import file_identity
+from .checkpoint import CheckpointWriter, DATA_GROUP, FRAMES_KEYS
+from .chunk_writer import read_frames
+from .preview import PREVIEW_FACTORS
+from . import metrics, kernels
 
 DATA_PATH = "entry_1/instrument_1/detector_1/detector_corrected/data"
 TRAIN_PATH = "/instrument/trainID"
 PULSE_PATH = "/instrument/pulseID"
-WORKER_WRITE_PATH = os.path.join(os.path.dirname(__file__), '../mpi_worker_write.py')
-WORKER_READ_PATH = os.path.join(os.path.dirname(__file__), '../mpi_worker_read.py')
+BLOCK_SIZE = 100
+TASK_SIZE = 100
+WINDOW_BYTES = 2**30
+WORKER_WRITE_MODULE = 'exfel.utils.mpi_worker_write'
+WORKER_READ_MODULE = 'exfel.utils.mpi_worker_read'
 
 def chunkify_mpi(data_size, n_procs):
     limits = np.linspace(0, data_size, n_procs + 1).astype(int)
     return list(zip(limits[:-1], limits[1:]))
 
-def process_frame(frame):
-    return apply_agipd_geom(frame).astype(np.int32)
+def task_ranges(data_size, task_size=TASK_SIZE):
+    return [(start, min(start + task_size, data_size)) for start in range(0, data_size, task_size)]
 
-def data_chunk(start, stop, cheetah_path, lim):
-    file_handler = h5py.File(cheetah_path, 'r')
+def print_progress(counter, size, end='\0'):
+    percent = (counter * 100) // size if size else 100
+    print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * (percent // 2), percent), end=end)
+    sys.stdout.flush()
+
+def data_chunk(start, stop, cheetah_path, lim, block_size=BLOCK_SIZE):
+    with metrics.stage('open'):
+        file_handler = h5py.File(cheetah_path, 'r')
     pulse_ids = file_handler[PULSE_PATH]
     train_ids = file_handler[TRAIN_PATH]
     raw_data = file_handler[DATA_PATH]
-    data, tidslist, pidslist = [], [], []
-    for idx in range(start, stop):
-        if raw_data[idx].max() > lim:
-            pidslist.append(pulse_ids[idx])
-            tidslist.append(train_ids[idx])
-            data.append(process_frame(raw_data[idx]))
-    return np.array(data), np.array(tidslist), np.array(pidslist)
-
-def data_mpi(cheetah_path, data_size, n_procs, lim=20000):
-    ranges = chunkify_mpi(data_size, n_procs - 1)
-    pool = MPIPool(WORKER_READ_PATH, [cheetah_path, str(lim)], n_procs)
-    return pool.read_map(ranges)
+    data_dtype = frame_dtype(raw_data.dtype)
+    rows, cols, shape = pixel_maps()
+    bg_index, pupil_index = roi_index(BG_ROI, shape), roi_index(PUPIL_ROI, shape)
+    data, tidslist, pidslist, bglist, pupillist = [], [], [], [], []
+    for idx in range(start, stop, block_size):
+        frames = read_frames(raw_data, idx, min(idx + block_size, stop))
+        metrics.count(bytes_read=frames.nbytes, frames_in=frames.shape[0])
+        with metrics.stage('filter'):
+            hits = np.where(kernels.frame_max(frames) > lim)[0]
+        if hits.size:
+            pidslist.append(pulse_ids[idx + hits])
+            tidslist.append(train_ids[idx + hits])
+            with metrics.stage('geometry'):
+                data.append(kernels.assemble(frames[hits], rows, cols, shape, data_dtype))
+            with metrics.stage('filter'):
+                bg_intensity, pupil_intensity = normalize_frames(data[-1], bg_index, pupil_index)
+            bglist.append(bg_intensity)
+            pupillist.append(pupil_intensity)
+            metrics.count(frames_out=hits.size)
+    if not data:
+        return (np.zeros((0,) + shape, dtype=data_dtype), np.zeros(0, dtype=train_ids.dtype),
+                np.zeros(0, dtype=pulse_ids.dtype), np.zeros(0), np.zeros(0))
+    return (np.concatenate(data), np.concatenate(tidslist), np.concatenate(pidslist),
+            np.concatenate(bglist), np.concatenate(pupillist))
+
+def frame_dtype(raw_dtype):
+    """
+    Return the dtype of the assembled frames, the raw dtype in the native byte
+    order: integer frames are never widened, floating point frames never truncated
+    """
+    return np.dtype(raw_dtype).newbyteorder('=')
+
+def task_nbytes(frame_shape, dtype, preview=False, task_size=TASK_SIZE):
+    """
+    Return the upper bound of the size of a task result, every frame of the task
+    kept by the trimming, with the preview pyramid if preview
+    """
+    # the train and pulse IDs, background and pupil intensities take 8 bytes each
+    frame_size = np.prod(frame_shape) * np.dtype(dtype).itemsize + 4 * 8
+    if preview:
+        frame_size += sum(np.prod([size // factor for size in frame_shape]) * 4
+                          for factor in PREVIEW_FACTORS)
+    return int(task_size * frame_size)
+
+def frame_dtypes(cheetah_path):
+    """
+    Return the output dtypes of the frames, train IDs, pulse IDs, background and
+    pupil intensities
+    """
+    with h5py.File(cheetah_path, 'r') as file_handler:
+        raw_dtype = file_handler[DATA_PATH].dtype
+        train_dtype, pulse_dtype = file_handler[TRAIN_PATH].dtype, file_handler[PULSE_PATH].dtype
+    return frame_dtype(raw_dtype), train_dtype, pulse_dtype, np.float64, np.float64
+
+def data_mpi(cheetah_path, data_size, n_procs, lim=20000, metrics=None, checkpoint_path=None):
+    """
+    Trim and assemble the frames with MPI workers
+
+    checkpoint_path - the processed tasks are written to this file and a rerun
+                      resumes from it, the frames are kept in memory only if None
+
+    Returns the lists of frames, train IDs, pulse IDs, background and pupil
+    intensities
+    """
+    if checkpoint_path is not None:
+        write_mpi(cheetah_path, checkpoint_path, data_size, n_procs, lim, metrics)
+        with h5py.File(checkpoint_path, 'r') as out_file:
+            return tuple([out_file[DATA_GROUP][key][()]] for key in FRAMES_KEYS)
+    results = []
+    pool = MPIPool(WORKER_READ_MODULE, [cheetah_path, str(lim)], n_procs, metrics)
+    pool.map(task_ranges(data_size), lambda task, chunk, pyramid: results.append(chunk))
+    return tuple(list(values) for values in zip(*results)) if results else ([],) * 5
 
 def write_args(cheetah_path, output_path, lim):
-    make_output_dir(output_path)
     outfile = h5py.File(output_path, 'r+')
-    arggroup = outfile.create_group('arguments')
-    arggroup.create_dataset('cheetah path', data=np.string_(cheetah_path))
-    arggroup.create_dataset('trimming limit', data=lim)
+    if 'arguments' not in outfile:
+        arggroup = outfile.create_group('arguments')
+        arggroup.create_dataset('cheetah path', data=np.string_(cheetah_path))
+        arggroup.create_dataset('trimming limit', data=lim)
     outfile.close()
 
-def write_mpi(cheetah_path, output_path, data_size, n_procs, lim=20000):
-    ranges = chunkify_mpi(data_size, n_procs - 1)
-    pool = MPIPool(WORKER_WRITE_PATH, [cheetah_path, output_path, str(lim)], n_procs)
-    pool.write_map(ranges)
+def write_mpi(cheetah_path, output_path, data_size, n_procs, lim=20000, metrics=None,
+              preview=False):
+    """
+    Trim, assemble and write the frames with MPI workers, the binned preview
+    pyramid and per-train thumbnails are written too if preview
+
+    Every written task is recorded in the journal next to the output, a rerun
+    with the same arguments after a failure processes only the missing tasks
+    and appends them to the partial output
+    """
+    tasks = task_ranges(data_size)
+    header = {'source': list(file_identity(cheetah_path)), 'data_size': int(data_size),
+              'task_size': TASK_SIZE, 'limit': int(lim), 'preview': bool(preview)}
+    shape, dtypes = pixel_maps()[2], frame_dtypes(cheetah_path)
+    writer = CheckpointWriter(output_path, header, shape, dtypes, preview)
+    missing = writer.missing(tasks)
+    if writer.resumed:
+        print('Resuming {}: {:d} of {:d} tasks left'.format(output_path, len(missing), len(tasks)))
+
+    def append(task, chunk, pyramid):
+        if metrics is None:
+            writer.append(task, chunk, pyramid)
+        else:
+            with metrics.stage('write'):
+                writer.append(task, chunk, pyramid)
+            metrics.count(bytes_written=sum(values.nbytes for values in chunk))
+
+    try:
+        if missing:
+            pool = MPIPool(WORKER_WRITE_MODULE, [cheetah_path, str(lim), str(int(preview))],
+                           n_procs, metrics)
+            pool.map(missing, append, task_bytes=task_nbytes(shape, dtypes[0], preview))
+        if preview:
+            writer.save_thumbnails()
+    finally:
+        writer.close()
     write_args(cheetah_path, output_path, lim)
+    if metrics is not None:
+        metrics.save(output_path)
+
+def serve(comm, func, profile_dir=None):
+    """
+    Worker side of MPIPool.map: run func(start, stop) on the (index, start, stop)
+    tasks sent by the parent until None is received, func returns a tuple of the
+    trimmed chunk and its preview pyramid
+    """
+    worker = TaskMetrics('worker {:d}'.format(comm.Get_rank()))
+    comm.send(obj=None, dest=0, tag=0)
+    while True:
+        with worker.stage('idle'):
+            task = comm.recv(source=0, tag=1)
+        if task is None:
+            break
+        index, start, stop = task
+        result, record = run_task(func, '{}({}, {})'.format(func.__name__, start, stop),
+                                  profile_dir, start, stop)
+        comm.send(obj=(index, result, record), dest=0, tag=2)
+    worker.stop = time.time()
+    comm.send(obj=worker.as_dict(), dest=0, tag=4)
+    comm.Disconnect()
 
 class MPIPool(object):
-    def __init__(self, workerpath, args, n_procs):
+    """
+    Pool of spawned MPI worker processes
+
+    worker - worker module run with python -m
+    args - worker command line arguments
+    n_procs - number of processes including the parent
+    """
+    def __init__(self, worker, args, n_procs, metrics=None):
         self.n_procs, self.n_workers = n_procs, n_procs - 1
         self.time = MPI.Wtime()
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.metrics.num_workers = self.n_workers
+        profile_dir = '' if self.metrics is None else self.metrics.profile_dir or ''
         self.comm = MPI.COMM_SELF.Spawn(sys.executable,
-                                        args=[workerpath] + args,
+                                        args=['-m', worker] + args + [profile_dir],
                                         maxprocs=self.n_workers)
 
     def shutdown(self):
         self.comm.Disconnect()
+        if self.metrics is not None:
+            self.metrics.finish()
         print('Elapsed time: {:.2f}s'.format(MPI.Wtime() - self.time))
 
-    def read_map(self, task_list):
-        status, queue = MPI.Status(), []
-        for task in task_list[:self.n_workers]:
-            self.comm.recv(source=MPI.ANY_SOURCE, status=status, tag=0)
-            self.comm.send(obj=task, dest=status.Get_source())
-            queue.append(status.Get_source())
-        pool_size = sum([self.comm.recv(source=rank, tag=1) for rank in queue])
-        for counter in range(pool_size):
-            percent = (counter * 100) // pool_size
-            print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * (percent // 2), percent), end='\0')
-            self.comm.recv(source=MPI.ANY_SOURCE, tag=2)
-        print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * 50, 100))
-        data_list, tids_list, pids_list = [], [], []
-        for rank in queue:
-            data, tids, pids = self.comm.recv(source=rank, tag=3)
-            data_list.append(data)
-            tids_list.append(tids)
-            pids_list.append(pids)
-        self.shutdown()
-        return data_list, tids_list, pids_list
+    def recv_metrics(self, tag):
+        record = self.comm.recv(source=MPI.ANY_SOURCE, tag=tag)
+        if record is not None and self.metrics is not None:
+            self.metrics.add_task(record)
+
+    def map(self, tasks, handle, window=None, task_bytes=None):
+        """
+        Send the (start, stop) tasks to the workers as they get free and call
+        handle(task, chunk, pyramid) on the results in the order of tasks
 
-    def write_map(self, task_list):
-        status, queue = MPI.Status(), []
-        for task in task_list[:self.n_workers]:
+        window - maximum number of tasks sent ahead of the first unhandled one,
+                 twice the number of workers by default
+        task_bytes - upper bound of a task result size, the window is narrowed to
+                     keep at most WINDOW_BYTES of results in flight, at least one task
+        """
+        window = 2 * self.n_workers if window is None else window
+        if task_bytes:
+            window = max(1, min(window, WINDOW_BYTES // task_bytes))
+        status, idle, results = MPI.Status(), [], {}
+        for _ in range(self.n_workers):
             self.comm.recv(source=MPI.ANY_SOURCE, status=status, tag=0)
-            self.comm.send(obj=task, dest=status.Get_source())
-            queue.append(status.Get_source())
-        pool_size = sum([self.comm.recv(source=rank, tag=1) for rank in queue])
-        for counter in range(pool_size):
-            percent = (counter * 100) // pool_size
-            print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * (percent // 2), percent), end='\0')
-            sys.stdout.flush()
-            self.comm.recv(source=MPI.ANY_SOURCE, tag=2)
-        print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * 50, 100))
-        sys.stdout.flush()
-        data_size = 0
-        for rank in queue:
-            chunk_size = self.comm.sendrecv(data_size, dest=rank, source=rank)
-            data_size += chunk_size
-        self.comm.bcast(obj=data_size, root=MPI.ROOT)
-        self.comm.Barrier()
-        print('Writing data...')
-        for counter in range(pool_size):
-            percent = (counter * 100) // pool_size
-            print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * (percent // 2), percent), end='\0')
-            sys.stdout.flush()
-            self.comm.recv(source=MPI.ANY_SOURCE, tag=3)
-        print('\rProgress: [{0:<50}] {1:3d}%'.format('=' * 50, 100))
-        sys.stdout.flush()
+            idle.append(status.Get_source())
+        sent, handled = 0, 0
+        while handled < len(tasks):
+            while idle and sent < min(len(tasks), handled + window):
+                self.comm.send(obj=(sent,) + tuple(tasks[sent]), dest=idle.pop(), tag=1)
+                sent += 1
+            index, result, record = self.comm.recv(source=MPI.ANY_SOURCE, status=status, tag=2)
+            idle.append(status.Get_source())
+            if self.metrics is not None:
+                self.metrics.add_task(record)
+            results[index] = result
+            while handled in results:
+                handle(tasks[handled], *results.pop(handled))
+                handled += 1
+                print_progress(handled, len(tasks))
+        print_progress(len(tasks), len(tasks), end='\n')
+        for rank in idle:
+            self.comm.send(obj=None, dest=rank, tag=1)
+        for rank in idle:
+            self.recv_metrics(tag=4)
         time.sleep(0.1)
         self.shutdown()
@@ -0,0 +1,228 @@
+"""
+precision.py - adaptive output dtype and quantization module
+"""
+import numpy as np
+
+INT_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.uint64, np.int64)
+FLOAT_DTYPES = (np.float16, np.float32)
+SCALE_ATTR = 'scale_factor'
+OFFSET_ATTR = 'add_offset'
+PACKED_ATTR = 'packed_shape'
+WIDEN_SUFFIX = '_widen'
+
+def int_dtype(vmin, vmax):
+    """
+    Return the smallest integer dtype holding all the values in [vmin, vmax]
+    """
+    for dtype in INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= vmin and vmax <= info.max:
+            return np.dtype(dtype)
+    raise ValueError('Wrong integer range: [{}, {}]'.format(vmin, vmax))
+
+def decode(array, attrs):
+    """
+    Restore the data written by Precision from the stored array and the
+    dataset attributes
+    """
+    if PACKED_ATTR in attrs:
+        shape = tuple(attrs[PACKED_ATTR])
+        shape = array.shape[:-1] + shape[-1:]
+        return np.unpackbits(array, axis=-1, count=shape[-1]).astype(bool)
+    if SCALE_ATTR in attrs:
+        return array * attrs[SCALE_ATTR] + attrs[OFFSET_ATTR]
+    return array
+
+def read_dataset(dataset, sel=()):
+    return decode(dataset[sel], dataset.attrs)
+
+class Precision(object):
+    """
+    Output precision policy: every array is stored in the smallest dtype that
+    represents it within tolerance, integer valued data as the smallest integer
+    dtype, floats as float16/float32 or linearly quantized integers, the masks
+    of mask_keys as packed bits, every encoded chunk is verified against the
+    tolerance
+
+    tolerance - maximum absolute error allowed, 0 for lossless
+    mask_keys - keys of the arrays stored as bit-packed boolean masks, none by default
+    """
+    def __init__(self, tolerance=0., mask_keys=()):
+        if tolerance < 0:
+            raise ValueError('Wrong precision tolerance: {}'.format(tolerance))
+        self.tolerance, self.mask_keys = tolerance, tuple(mask_keys)
+
+    def is_mask(self, key, data):
+        return key in self.mask_keys and data.dtype.kind in 'biu' and \
+               (not data.size or data.max() <= 1 and data.min() >= 0)
+
+    def candidates(self, data, vrange=None):
+        """
+        Return the (dtype, attributes) encodings to try, smallest first, the
+        dtype is picked from vrange = (vmin, vmax) instead of data if given
+        """
+        if data.dtype.kind == 'b' or data.dtype.kind == 'f' and not data.size:
+            # an empty float array has no values to try the smaller dtypes on
+            return [(data.dtype, {})]
+        if not data.size or data.dtype.kind in 'iu':
+            vmin, vmax = (data.min(), data.max()) if data.size else (0, 0)
+            if vrange is not None:
+                vmin, vmax = vrange
+            return [(int_dtype(vmin, vmax), {})]
+        if data.dtype.kind != 'f':
+            return [(data.dtype, {})]
+        finite = np.isfinite(data).all()
+        vmin, vmax = (data.min(), data.max()) if finite else (0, 0)
+        if vrange is not None:
+            vmin, vmax = vrange
+        if finite and np.array_equal(data, np.rint(data)):
+            return [(int_dtype(vmin, vmax), {})]
+        result = [(np.dtype(dtype), {}) for dtype in FLOAT_DTYPES
+                  if np.dtype(dtype).itemsize < data.dtype.itemsize]
+        if finite and self.tolerance > 0:
+            scale = 2. * self.tolerance
+            levels = np.ceil((vmax - vmin) / scale)
+            if levels < np.iinfo(np.uint32).max:
+                result.append((int_dtype(0, levels), {SCALE_ATTR: scale, OFFSET_ATTR: vmin}))
+        return sorted(result, key=lambda item: item[0].itemsize) + [(data.dtype, {})]
+
+    def error(self, data, array, attrs):
+        if not data.size:
+            return 0.
+        restored = decode(array, attrs)
+        with np.errstate(invalid='ignore', over='ignore'):
+            diff = np.abs(restored.astype(np.float64) - data.astype(np.float64))
+        diff[(restored == data) | (np.isnan(restored) & np.isnan(data))] = 0.
+        return float(np.nan_to_num(diff, nan=np.inf).max())
+
+    def encode_as(self, data, dtype, attrs):
+        """
+        Encode data into the given dtype and attributes, raise ValueError if the
+        error is above the tolerance
+        """
+        data = np.asarray(data)
+        if PACKED_ATTR in attrs:
+            if data.size and (data.max() > 1 or data.min() < 0):
+                raise ValueError('Wrong mask values: [{}, {}]'.format(data.min(), data.max()))
+            return np.packbits(data.astype(bool), axis=-1)
+        if SCALE_ATTR in attrs:
+            array = np.rint((data - attrs[OFFSET_ATTR]) / attrs[SCALE_ATTR])
+            if array.size and (array.min() < np.iinfo(dtype).min or array.max() > np.iinfo(dtype).max):
+                raise ValueError('Data out of the quantization range: {}'.format(dtype))
+            array = array.astype(dtype)
+        else:
+            with np.errstate(over='ignore', invalid='ignore'):
+                array = data.astype(dtype)
+        error = self.error(data, array, attrs)
+        # quantization steps are computed in float64, allow for its rounding
+        if error > self.tolerance * (1 + 1e-9):
+            raise ValueError('Precision loss above tolerance: {} > {}'.format(error, self.tolerance))
+        return array
+
+    def encode(self, data, key=None, vrange=None):
+        """
+        Return data encoded in the smallest dtype within tolerance and the
+        dataset attributes needed to decode it
+        """
+        data = np.asarray(data)
+        if self.is_mask(key, data) and data.ndim:
+            attrs = {PACKED_ATTR: data.shape}
+            return self.encode_as(data, np.uint8, attrs), attrs
+        for dtype, attrs in self.candidates(data, vrange):
+            try:
+                return self.encode_as(data, dtype, attrs), attrs
+            except ValueError:
+                continue
+        return data, {}
+
+    def create_dataset(self, group, key, data, axis=None, vrange=None, **kwargs):
+        """
+        Write data to a new dataset of group, resizable along axis if axis
+        is not None
+
+        vrange - (vmin, vmax) range of all the data to be appended, the dataset
+                 dtype is picked from it once
+        """
+        array, attrs = self.encode(data, key, vrange)
+        if axis is not None:
+            kwargs.setdefault('chunks', True)
+            kwargs.update(maxshape=array.shape[:axis] + (None,) + array.shape[axis + 1:])
+        dataset = group.create_dataset(key, data=array, **kwargs)
+        for name, value in attrs.items():
+            dataset.attrs[name] = value
+        return dataset
+
+    def widen(self, dtype, attrs, data):
+        """
+        Return the dtype holding both the values of the dtype exactly and data
+        within tolerance, encoded with the same attributes
+        """
+        if PACKED_ATTR in attrs:
+            raise ValueError('Wrong mask values: [{}, {}]'.format(np.min(data), np.max(data)))
+        if SCALE_ATTR in attrs:
+            # the quantization step and offset are kept, only the levels get wider
+            levels = np.rint((data - attrs[OFFSET_ATTR]) / attrs[SCALE_ATTR])
+            if not np.isfinite(levels).all():
+                raise ValueError('Data out of the quantization range: {}'.format(dtype))
+            info = np.iinfo(dtype)
+            wide = int_dtype(min(info.min, levels.min()), max(info.max, levels.max()))
+            self.encode_as(data, wide, attrs)
+            return wide
+        for candidate, cand_attrs in self.candidates(data) + [(data.dtype, {})]:
+            if cand_attrs:
+                continue
+            wide = np.promote_types(dtype, candidate)
+            try:
+                self.encode_as(data, wide, attrs)
+            except ValueError:
+                continue
+            return wide
+        raise ValueError('Wrong data type: {}'.format(data.dtype))
+
+    def rewrite(self, group, key, dtype, axis=0, **kwargs):
+        """
+        Replace a resizable dataset of group with a copy cast to dtype, the
+        copy is made chunk by chunk along axis and keeps the attributes and
+        the compression
+        """
+        dataset = group[key]
+        shape, step = dataset.shape, dataset.chunks[axis]
+        kwargs.setdefault('compression', dataset.compression)
+        kwargs.setdefault('compression_opts', dataset.compression_opts)
+        kwargs.update(chunks=dataset.chunks, maxshape=dataset.maxshape)
+        wide = group.create_dataset(key + WIDEN_SUFFIX, shape=shape, dtype=dtype, **kwargs)
+        for start in range(0, shape[axis], step):
+            sel = (slice(None),) * axis + (slice(start, start + step),)
+            wide[sel] = dataset[sel].astype(dtype)
+        for name, value in dataset.attrs.items():
+            wide.attrs[name] = value
+        del group[key]
+        group.move(key + WIDEN_SUFFIX, key)
+        return group[key]
+
+    def append(self, group, key, data, axis=0, vrange=None, **kwargs):
+        """
+        Append data along axis to a dataset of group created by create_dataset,
+        the stored values are cast to a wider dtype if data doesn't fit in it,
+        they are never decoded and quantized again
+        """
+        if key not in group:
+            return self.create_dataset(group, key, data, axis, vrange, **kwargs)
+        data = np.asarray(data)
+        dataset = group[key]
+        attrs = dict(dataset.attrs)
+        try:
+            array = self.encode_as(data, dataset.dtype, attrs)
+        except ValueError:
+            # the dtypes only get wider, a dataset is rewritten a few times at most
+            dtype = self.widen(dataset.dtype, attrs, data)
+            dataset = self.rewrite(group, key, dtype, axis, **kwargs)
+            array = self.encode_as(data, dtype, attrs)
+        if PACKED_ATTR in attrs:
+            shape = list(attrs[PACKED_ATTR])
+            shape[axis] += np.shape(data)[axis]
+            dataset.attrs[PACKED_ATTR] = shape
+        size = dataset.shape[axis]
+        dataset.resize(size + array.shape[axis], axis=axis)
+        dataset[(slice(None),) * axis + (slice(size, None),)] = array
+        return dataset
@@ -0,0 +1,64 @@
+"""
+prefetch.py - read-ahead prefetching module
+"""
+import concurrent.futures
+import itertools
+from collections import deque
+
+def chunk_nbytes(chunk):
+    if isinstance(chunk, dict):
+        return sum(chunk_nbytes(value) for value in chunk.values())
+    if isinstance(chunk, (list, tuple)):
+        return sum(chunk_nbytes(value) for value in chunk)
+    return getattr(chunk, 'nbytes', 0)
+
+class Prefetcher(object):
+    """
+    Iterate over func(*task, *args) results for every task in tasks, while the
+    current result is being consumed the next ones are fetched in the background
+
+    func - function reading a block of data
+    tasks - list of argument tuples, one per block
+    args - extra arguments passed to func after the task arguments
+    depth - maximum number of blocks fetched ahead
+    mem_cap - maximum number of bytes held by the blocks fetched ahead,
+              the depth is reduced accordingly after the first block
+    mode - 'thread' to fetch in a background thread, 'process' to fetch in
+           a background process (doesn't contend for the GIL with h5py reads)
+    """
+    MODES = {'thread': concurrent.futures.ThreadPoolExecutor,
+             'process': concurrent.futures.ProcessPoolExecutor}
+
+    def __init__(self, func, tasks, args=(), depth=2, mem_cap=None, mode='thread'):
+        if mode not in self.MODES:
+            raise ValueError('Wrong prefetch mode: {}'.format(mode))
+        if depth < 1:
+            raise ValueError('Prefetch depth must be positive: {}'.format(depth))
+        self.func, self.tasks, self.args = func, list(tasks), tuple(args)
+        self.depth, self.mem_cap, self.mode = depth, mem_cap, mode
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def max_depth(self, block_bytes):
+        if self.mem_cap is None or not block_bytes:
+            return self.depth
+        return max(min(self.depth, int(self.mem_cap // block_bytes)), 1)
+
+    def __iter__(self):
+        tasks, queue, depth = iter(self.tasks), deque(), self.depth
+        with self.MODES[self.mode](max_workers=1) as executor:
+            def fill():
+                for task in itertools.islice(tasks, max(depth - len(queue), 0)):
+                    queue.append(executor.submit(self.func, *(tuple(task) + self.args)))
+
+            try:
+                fill()
+                while queue:
+                    block = queue.popleft().result()
+                    depth = self.max_depth(chunk_nbytes(block))
+                    fill()
+                    yield block
+            finally:
+                for fut in queue:
+                    fut.cancel()
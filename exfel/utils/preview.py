@@ -0,0 +1,84 @@
+"""
+preview.py - multi-resolution preview products module
+
+Binned frame pyramids and per-train thumbnails for quick-look tools, written
+to a 'preview' group next to the processed frames
+"""
+import numpy as np
+
+PREVIEW_GROUP = 'preview'
+PREVIEW_FACTORS = (2, 4, 8)
+PREVIEW_KEY = 'data_{0:d}x{0:d}'
+THUMBNAIL_KEY = 'thumbnails'
+THUMBNAIL_TRAIN_KEY = 'trainId'
+
+def bin_frames(frames, factor):
+    """
+    Return the means of factor x factor pixel blocks of frames (..., ss, fs),
+    the trailing rows and columns that don't fill a block are dropped
+    """
+    n_ss, n_fs = frames.shape[-2] // factor, frames.shape[-1] // factor
+    blocks = frames[..., :n_ss * factor, :n_fs * factor]
+    blocks = blocks.reshape(frames.shape[:-2] + (n_ss, factor, n_fs, factor))
+    return blocks.mean(axis=(-3, -1), dtype=np.float64)
+
+def frame_pyramid(frames, factors=PREVIEW_FACTORS):
+    """
+    Return a dictionary of frames binned by every factor, every level is binned
+    from the previous one if the factors allow it
+    """
+    pyramid, level, level_factor = {}, frames, 1
+    for factor in sorted(factors):
+        if factor % level_factor:
+            level, level_factor = frames, 1
+        level = bin_frames(level, factor // level_factor)
+        pyramid[factor], level_factor = level, factor
+    return pyramid
+
+def train_sums(frames, train_ids):
+    """
+    Return the train IDs, the sums of frames of every train and the numbers of
+    frames of every train
+    """
+    order = np.argsort(train_ids, kind='stable')
+    trains, starts, counts = np.unique(train_ids[order], return_index=True, return_counts=True)
+    if not trains.size:
+        return trains, np.zeros((0,) + frames.shape[1:]), counts
+    return trains, np.add.reduceat(frames[order].astype(np.float64), starts, axis=0), counts
+
+def merge_train_sums(parts):
+    """
+    Merge a list of train_sums results of different frames
+    """
+    train_ids = np.concatenate([trains for trains, _, _ in parts])
+    trains, sums, _ = train_sums(np.concatenate([sums for _, sums, _ in parts]), train_ids)
+    _, counts, _ = train_sums(np.concatenate([counts for _, _, counts in parts]), train_ids)
+    return trains, sums, counts.astype(np.int64)
+
+def train_means(sums, counts):
+    return (sums.T / counts).T.astype(np.float32)
+
+def save_pyramid(group, pyramid, **kwargs):
+    preview_group = group.require_group(PREVIEW_GROUP)
+    for factor, frames in pyramid.items():
+        preview_group.create_dataset(PREVIEW_KEY.format(factor), data=frames.astype(np.float32),
+                                     **kwargs)
+    return preview_group
+
+def save_thumbnails(group, trains, sums, counts, **kwargs):
+    preview_group = group.require_group(PREVIEW_GROUP)
+    preview_group.create_dataset(THUMBNAIL_KEY, data=train_means(sums, counts), **kwargs)
+    preview_group.create_dataset(THUMBNAIL_TRAIN_KEY, data=trains)
+    return preview_group
+
+def save_preview(group, frames, train_ids=None, factors=PREVIEW_FACTORS, compression='gzip'):
+    """
+    Write the binned frame pyramid and, if train_ids are given, the per-train
+    means of the most binned frames to the preview subgroup of group
+    """
+    pyramid = frame_pyramid(frames, factors)
+    kwargs = {'compression': compression} if frames.shape[0] else {}
+    preview_group = save_pyramid(group, pyramid, **kwargs)
+    if train_ids is not None:
+        save_thumbnails(group, *train_sums(pyramid[max(factors)], np.asarray(train_ids)), **kwargs)
+    return preview_group
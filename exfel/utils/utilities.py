@@ -3,9 +3,11 @@ utilities.py - utility module with utility functions and constants
 """
 import os
 import errno
+import pickle
+import hashlib
+from functools import lru_cache
 from multiprocessing import cpu_count
-from cfelpyutils.crystfel_utils import load_crystfel_geometry
-from cfelpyutils.geometry_utils import apply_geometry_to_data
+import numpy as np
 
 HIGH_GAIN = 0
 MEDIUM_GAIN = 1
@@ -14,16 +16,119 @@ DATA_KEY = 'data'
 GAIN_KEY = 'gain'
 PULSE_KEY = 'pulseId'
 TRAIN_KEY = 'trainId'
+BG_KEY = 'bgIntensity'
+PUPIL_KEY = 'pupilIntensity'
 CHEETAH_PATH = "/gpfs/exfel/u/scratch/MID/201802/p002200/cheetah/hdf5/r{0:04d}-data/XFEL-r{0:04d}-c{1:02d}.h5"
+CHEETAH_RUN_PATH = "/gpfs/exfel/u/scratch/MID/201802/p002200/cheetah/hdf5/r{run:04d}-{tag}"
+CHEETAH_FILE_MASK = "XFEL-r{run:04d}-c*.h5"
 OUT_PATH = "hdf5"
 CORES_COUNT = cpu_count()
 BG_ROI = (slice(5000), slice(None))
 PUPIL_ROI = (slice(750, 1040), slice(780, 1090))
+AGIPD_GEOM_PATH = os.path.join(os.path.dirname(__file__), "agipd.geom")
+CACHE_PATH = os.environ.get('EXFEL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'exfel'))
 
-AGIPD_GEOM = load_crystfel_geometry(os.path.join(os.path.dirname(__file__), "agipd.geom"))
+def geom_cache_path(geom_path):
+    with open(geom_path, 'rb') as geom_file:
+        digest = hashlib.sha1(geom_file.read()).hexdigest()
+    return os.path.join(CACHE_PATH, '{:s}-{:s}.pickle'.format(os.path.basename(geom_path), digest))
+
+@lru_cache(maxsize=None)
+def load_geometry(geom_path=AGIPD_GEOM_PATH):
+    """
+    Load CrystFEL geometry file, parsed geometry is cached in CACHE_PATH
+    folder and reused as long as the geometry file content is unchanged
+    """
+    cache_path = geom_cache_path(geom_path)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    from cfelpyutils.crystfel_utils import load_crystfel_geometry
+    geometry = load_crystfel_geometry(geom_path)
+    try:
+        make_output_dir(CACHE_PATH)
+        tmp_path = '{:s}.{:d}'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(geometry, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return geometry
+
+def __getattr__(name):
+    if name == 'AGIPD_GEOM':
+        return load_geometry()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def slab_shape(geometry):
+    panels = geometry['panels'].values()
+    return (max(panel['max_ss'] for panel in panels) + 1,
+            max(panel['max_fs'] for panel in panels) + 1)
+
+def pixel_coordinates(geometry, subpixels=1, meters=True):
+    """
+    Return x and y coordinates of every pixel of the detector slab, in meters
+    or in pixel units, each pixel is split into subpixels x subpixels points
+
+    Returns x, y arrays of shape (subpixels**2,) + slab shape
+    """
+    shifts = (np.arange(subpixels) + 0.5) / subpixels - 0.5
+    ss_shift, fs_shift = [shift.ravel() for shift in np.meshgrid(shifts, shifts, indexing='ij')]
+    x = np.zeros((subpixels**2,) + slab_shape(geometry))
+    y = np.zeros((subpixels**2,) + slab_shape(geometry))
+    for panel in geometry['panels'].values():
+        ss_grid, fs_grid = np.meshgrid(np.arange(panel['max_ss'] - panel['min_ss'] + 1),
+                                       np.arange(panel['max_fs'] - panel['min_fs'] + 1),
+                                       indexing='ij')
+        ss_grid = ss_grid[None] + ss_shift[:, None, None]
+        fs_grid = fs_grid[None] + fs_shift[:, None, None]
+        index = (slice(None), slice(panel['min_ss'], panel['max_ss'] + 1),
+                 slice(panel['min_fs'], panel['max_fs'] + 1))
+        scale = panel['res'] if meters else 1.
+        x[index] = (ss_grid * panel['ssx'] + fs_grid * panel['fsx'] + panel['cnx']) / scale
+        y[index] = (ss_grid * panel['ssy'] + fs_grid * panel['fsy'] + panel['cny']) / scale
+    return x, y
+
+def pixel_maps(geometry=None):
+    """
+    Return the assembled image row and column of every detector slab pixel and
+    the assembled image shape, the image layout is the one of apply_agipd_geom
+    """
+    geometry = load_geometry() if geometry is None else geometry
+    x, y = pixel_coordinates(geometry, meters=False)
+    shape = (2 * int(max(abs(y.max()), abs(y.min()))) + 2,
+             2 * int(max(abs(x.max()), abs(x.min()))) + 2)
+    rows = np.array(y[0], dtype=int) + shape[0] // 2 - 1
+    cols = np.array(x[0], dtype=int) + shape[1] // 2 - 1
+    return rows, cols, shape
+
+def roi_index(roi, frame_shape, geometry=None):
+    """
+    Return flat pixel indices of a region of interest given in assembled image
+    coordinates, frames of the detector slab shape are mapped through geometry
+    """
+    geometry = load_geometry() if geometry is None else geometry
+    if tuple(frame_shape) == slab_shape(geometry):
+        rows, cols, shape = pixel_maps(geometry)
+        in_roi = np.zeros(shape, dtype=bool)
+        in_roi[roi] = True
+        return np.flatnonzero(in_roi[rows, cols])
+    return np.arange(np.prod(frame_shape)).reshape(frame_shape)[roi].ravel()
+
+def normalize_frames(frames, bg_index, pupil_index):
+    """
+    Return per-frame mean background and background subtracted pupil intensities
+    """
+    flat = frames.reshape(frames.shape[0], -1)
+    bg_intensity = flat[:, bg_index].mean(axis=1)
+    pupil_intensity = flat[:, pupil_index].sum(axis=1) - bg_intensity * pupil_index.size
+    return bg_intensity, pupil_intensity
 
 def apply_agipd_geom(frame):
-    return apply_geometry_to_data(frame, AGIPD_GEOM)
+    from cfelpyutils.geometry_utils import apply_geometry_to_data
+    return apply_geometry_to_data(frame, load_geometry())
 
 def make_output_dir(path):
     try:
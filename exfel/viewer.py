@@ -0,0 +1,272 @@
+"""
+viewer.py - photon calibration viewer module, imports Qt and pyqtgraph
+
+The viewer never blocks on the data: the histogram is accumulated by a
+HistWorker and the gaussian fits are done by a FitWorker, each in its own
+thread, the fits are debounced while the ROIs are dragged
+"""
+import sys
+import numpy as np
+import pyqtgraph as pg
+from .calib import gauss, fit_levels, ROI
+
+try:
+    from PyQt5 import QtCore, QtGui, QtWidgets
+except ImportError:
+    from PyQt4 import QtCore, QtGui
+    QtWidgets = QtGui
+
+FIT_DELAY = 200
+
+class HistWorker(QtCore.QObject):
+    """
+    Background worker iterating over the histogram updates of source, an
+    iterable of (histogram, bin centers, number of frames) tuples
+    """
+    updated = QtCore.pyqtSignal(object, object, int)
+    failed = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, source):
+        super(HistWorker, self).__init__()
+        self.source, self.stopped = source, False
+
+    def stop(self):
+        self.stopped = True
+
+    @QtCore.pyqtSlot()
+    def run(self):
+        try:
+            for hist, adus, frames in self.source:
+                if self.stopped:
+                    break
+                self.updated.emit(hist, adus, frames)
+        except Exception as err:
+            self.failed.emit(str(err))
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+            self.finished.emit()
+
+class FitWorker(QtCore.QObject):
+    """
+    Background worker fitting the zero and one photon peaks with calib.fit_levels
+    """
+    fitted = QtCore.pyqtSignal(object, object, object)
+    failed = QtCore.pyqtSignal(str)
+
+    @QtCore.pyqtSlot(object, object, object, object)
+    def fit(self, hist, adus, zero_roi, one_roi):
+        try:
+            zero_fit, one_fit, one_hist = fit_levels(hist, adus, zero_roi, one_roi)
+        except (ValueError, RuntimeError) as err:
+            self.failed.emit(str(err))
+        else:
+            self.fitted.emit(zero_fit, one_fit, one_hist)
+
+class CalibViewer(QtWidgets.QWidget):
+    """
+    Photon calibration window
+
+    hist - ADU histogram, None if it comes from source
+    adus - histogram bin centers
+    source - iterable of (histogram, bin centers, number of frames) updates
+             consumed in a background thread, no updates if None
+    """
+    fit_requested = QtCore.pyqtSignal(object, object, object, object)
+
+    def __init__(self, hist, adus, parent=None, source=None):
+        super(CalibViewer, self).__init__(parent=parent)
+        self.adus = np.asarray(adus)
+        self.hist = np.zeros(self.adus.shape) if hist is None else np.asarray(hist)
+        self.one_hist = np.zeros(self.adus.shape)
+        self.zero_fit, self.one_fit = None, None
+        self.fitting, self.fit_pending, self.frames = False, False, 0
+        self.full_roi = ROI(self.adus.min(), self.adus.max())
+        self.zero_roi = ROI(self.full_roi.lower_bound,
+                            self.full_roi.lower_bound + 0.4 * self.full_roi.length)
+        self.one_roi = ROI(self.full_roi.higher_bound - 0.55 * self.full_roi.length,
+                           self.full_roi.higher_bound - 0.05 * self.full_roi.length)
+        self.init_ui()
+        self.init_workers(source)
+        self.update_labels()
+        if hist is not None:
+            self.request_fit()
+
+    @property
+    def zero_adu(self):
+        return None if self.zero_fit is None else self.zero_fit[1]
+
+    @property
+    def one_adu(self):
+        return None if self.one_fit is None else self.one_fit[1]
+
+    @property
+    def busy(self):
+        return self.hist_thread is not None or self.fitting or self.fit_timer.isActive()
+
+    def init_ui(self):
+        self.vbox_layout = QtWidgets.QVBoxLayout()
+        label_widget = QtWidgets.QLabel("ADU Histogram")
+        label_widget.setFont(QtGui.QFont('SansSerif', 20))
+        self.vbox_layout.addWidget(label_widget)
+        plot_widget = pg.PlotWidget(name="Plot", background='w')
+        self.one_hist_plot = plot_widget.plot(self.adus, self.one_hist, antialias=True)
+        self.one_hist_plot.setPen(color=(255, 0, 0, 150), width=2, style=QtCore.Qt.DashDotLine)
+        self.hist_plot = plot_widget.plot(self.adus, self.hist, antialias=True)
+        self.hist_plot.setPen(color=(0, 0, 0, 255), width=3)
+        self.zero_plot = plot_widget.plot(antialias=True)
+        self.zero_plot.setPen(color='b', width=2, style=QtCore.Qt.DashLine)
+        self.zero_lr = pg.LinearRegionItem(values=list(self.zero_roi.bounds),
+                                           bounds=list(self.full_roi.bounds))
+        self.zero_lr.setBrush(QtGui.QBrush(QtGui.QColor(0, 0, 255, 50)))
+        self.zero_lr.sigRegionChanged.connect(self.update_zero_roi)
+        plot_widget.addItem(self.zero_lr)
+        self.one_plot = plot_widget.plot(antialias=True)
+        self.one_plot.setPen(color='r', width=2, style=QtCore.Qt.DashLine)
+        self.one_lr = pg.LinearRegionItem(values=list(self.one_roi.bounds),
+                                          bounds=list(self.full_roi.bounds))
+        self.one_lr.setBrush(QtGui.QBrush(QtGui.QColor(255, 0, 0, 50)))
+        self.one_lr.sigRegionChanged.connect(self.update_one_roi)
+        plot_widget.addItem(self.one_lr)
+        self.vbox_layout.addWidget(plot_widget)
+        hbox = QtWidgets.QHBoxLayout()
+        update_button = QtWidgets.QPushButton("Update Plot")
+        update_button.clicked.connect(self.update_plot)
+        hbox.addWidget(update_button)
+        exit_button = QtWidgets.QPushButton("Done")
+        exit_button.clicked.connect(self.close)
+        hbox.addWidget(exit_button)
+        hbox.addStretch(1)
+        self.status_label = QtWidgets.QLabel()
+        hbox.addWidget(self.status_label)
+        self.zero_label = QtWidgets.QLabel()
+        hbox.addWidget(self.zero_label)
+        self.one_label = QtWidgets.QLabel()
+        hbox.addWidget(self.one_label)
+        self.vbox_layout.addLayout(hbox)
+        self.setLayout(self.vbox_layout)
+        self.setGeometry(0, 0, 1280, 720)
+        self.setWindowTitle('Photon Calibration')
+        self.show()
+
+    def init_workers(self, source):
+        self.fit_timer = QtCore.QTimer(self)
+        self.fit_timer.setSingleShot(True)
+        self.fit_timer.setInterval(FIT_DELAY)
+        self.fit_timer.timeout.connect(self.request_fit)
+        self.fit_thread = QtCore.QThread(self)
+        self.fit_worker = FitWorker()
+        self.fit_worker.moveToThread(self.fit_thread)
+        self.fit_requested.connect(self.fit_worker.fit)
+        self.fit_worker.fitted.connect(self.on_fitted)
+        self.fit_worker.failed.connect(self.on_fit_failed)
+        self.fit_thread.start()
+        self.hist_thread, self.hist_worker = None, None
+        if source is not None:
+            self.hist_thread = QtCore.QThread(self)
+            self.hist_worker = HistWorker(source)
+            self.hist_worker.moveToThread(self.hist_thread)
+            self.hist_thread.started.connect(self.hist_worker.run)
+            self.hist_worker.updated.connect(self.on_hist_updated)
+            self.hist_worker.failed.connect(self.on_hist_failed)
+            self.hist_worker.finished.connect(self.on_hist_finished)
+            self.hist_thread.start()
+
+    def update_labels(self, status=None):
+        if status is None:
+            status = "Frames: {:d}{:s}".format(self.frames,
+                                               '...' if self.hist_thread is not None else '')
+        self.status_label.setText(status)
+        for label, name, value in ((self.zero_label, 'Zero', self.zero_adu),
+                                   (self.one_label, 'One', self.one_adu)):
+            if value is None:
+                label.setText("{:s} ADU: --".format(name))
+            else:
+                label.setText("{:s} ADU: {:5.1f}".format(name, value))
+
+    def update_zero_roi(self):
+        self.zero_roi = ROI(*self.zero_lr.getRegion())
+        self.fit_timer.start()
+
+    def update_one_roi(self):
+        self.one_roi = ROI(*self.one_lr.getRegion())
+        self.fit_timer.start()
+
+    def request_fit(self):
+        """
+        Send the current histogram and ROIs to the fit worker, only the latest
+        request is sent if a fit is running
+        """
+        if self.fitting:
+            self.fit_pending = True
+            return
+        self.fitting, self.fit_pending = True, False
+        self.fit_requested.emit(self.hist.copy(), self.adus, self.zero_roi.bounds,
+                                self.one_roi.bounds)
+
+    def on_fitted(self, zero_fit, one_fit, one_hist):
+        self.zero_fit, self.one_fit, self.one_hist = zero_fit, one_fit, one_hist
+        self.fitting = False
+        self.zero_plot.setData(self.adus, gauss(self.adus,
+                                                self.zero_fit[0],
+                                                self.zero_fit[1],
+                                                self.zero_fit[2]))
+        self.one_plot.setData(self.adus, gauss(self.adus,
+                                               self.one_fit[0],
+                                               self.one_fit[1],
+                                               self.one_fit[2]))
+        self.one_hist_plot.setData(self.adus, self.one_hist)
+        self.update_labels()
+        if self.fit_pending:
+            self.request_fit()
+
+    def on_fit_failed(self, message):
+        self.fitting = False
+        self.update_labels("Fit failed: {:s}".format(message))
+        if self.fit_pending:
+            self.request_fit()
+
+    def on_hist_updated(self, hist, adus, frames):
+        self.hist, self.adus, self.frames = hist, adus, frames
+        self.hist_plot.setData(self.adus, self.hist)
+        self.update_labels()
+        self.fit_timer.start()
+
+    def on_hist_failed(self, message):
+        self.update_labels("Histogram failed: {:s}".format(message))
+
+    def on_hist_finished(self):
+        if self.hist_thread is None:
+            return
+        self.hist_thread.quit()
+        self.hist_thread.wait()
+        self.hist_thread = None
+        self.update_labels()
+
+    def update_plot(self):
+        self.fit_timer.stop()
+        self.request_fit()
+
+    def closeEvent(self, event):
+        if self.hist_thread is not None:
+            self.hist_worker.stop()
+            self.hist_thread.quit()
+            self.hist_thread.wait()
+            self.hist_thread = None
+        self.fit_timer.stop()
+        self.fit_thread.quit()
+        self.fit_thread.wait()
+        super(CalibViewer, self).closeEvent(event)
+
+def run_app(hist, adus, source=None):
+    """
+    Show the calibration viewer and return the zero and one photon ADU levels
+    of the last fit, None if there was no successful fit
+    """
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtWidgets.QApplication(sys.argv)
+    main_win = CalibViewer(hist, adus, source=source)
+    app.exec_()
+    return main_win.zero_adu, main_win.one_adu
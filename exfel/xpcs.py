@@ -0,0 +1,268 @@
+"""
+xpcs.py - multi-tau intensity autocorrelation module
+"""
+import numpy as np
+from . import utils
+from .data import Pool
+from .utils.prefetch import Prefetcher
+
+CORR_MODES = ('intra', 'inter')
+
+def multi_tau_lags(m=8, n_levels=8):
+    """
+    Return multi-tau lags and their levels, level 0 holds lags 1..m-1, level k
+    holds lags m/2..m-1 in units of 2**k frames
+    """
+    lags, levels = [np.arange(1, m)], [np.zeros(m - 1, dtype=int)]
+    for level in range(1, n_levels):
+        lags.append(np.arange(m // 2, m) * 2**level)
+        levels.append(np.full(m - m // 2, level))
+    return np.concatenate(lags), np.concatenate(levels)
+
+class MultiTauCorrelator(object):
+    """
+    Streaming multi-tau correlator of pixel intensities
+
+    Frames are fed in batches to independent streams (e.g. one per train for
+    pulse delays or one per pulse ID for train delays), every stream keeps only
+    the last m frames at each level, products are accumulated over all streams.
+    Frames fed with their times are placed on a common time grid, the missing
+    times are masked out of the products
+
+    n_pixels - number of pixels in a frame
+    m - number of lags per level
+    n_levels - number of levels
+    count_from - time from which the products are accumulated, the products
+                 with an earlier right frame are left to another correlator
+    """
+    def __init__(self, n_pixels, m=8, n_levels=8, count_from=0):
+        if m % 2:
+            raise ValueError('Number of lags per level must be even: {:d}'.format(m))
+        self.n_pixels, self.m, self.n_levels = n_pixels, m, n_levels
+        self.count_from = count_from
+        self.lags, self.levels = multi_tau_lags(m, n_levels)
+        self.num = np.zeros((self.lags.size, n_pixels))
+        self.left = np.zeros((self.lags.size, n_pixels))
+        self.right = np.zeros((self.lags.size, n_pixels))
+        self.count = np.zeros(self.lags.size, dtype=np.int64)
+        self.streams = {}
+
+    @property
+    def align(self):
+        """
+        Time step of the top level, a stream starting at a multiple of it has
+        the same frame pairs at every level as a stream starting at time 0
+        """
+        return 2**(self.n_levels - 1)
+
+    @property
+    def span(self):
+        """
+        Longest gap in a stream across which products are still possible
+        """
+        return self.m * self.align
+
+    def _new_stream(self, time=0):
+        empty, no_weights = np.zeros((0, self.n_pixels)), np.zeros(0)
+        return {'tails': [empty] * self.n_levels, 'tail_weights': [no_weights] * self.n_levels,
+                'pending': [empty] * self.n_levels,
+                'pending_weights': [no_weights] * self.n_levels,
+                'positions': [time >> level for level in range(self.n_levels)]}
+
+    def reset(self, stream=0):
+        """
+        End a stream, products across its end are never accumulated
+        """
+        self.streams.pop(stream, None)
+
+    def update(self, frames, stream=0, times=None):
+        """
+        Feed a batch of frames of shape (n_frames, n_pixels) to a stream
+
+        times - increasing integer times of the frames, consecutive frames by default
+        """
+        batch = np.asarray(frames, dtype=np.float64).reshape(-1, self.n_pixels)
+        if times is None:
+            state = self.streams.setdefault(stream, self._new_stream())
+            self._feed(state, batch, np.ones(batch.shape[0]))
+            return
+        times = np.asarray(times, dtype=np.int64)
+        breaks = np.flatnonzero(np.diff(times) > self.span) + 1
+        for start, stop in zip(np.append(0, breaks), np.append(breaks, times.size)):
+            state = self.streams.get(stream)
+            if state is None or times[start] - state['positions'][0] > self.span:
+                # products across a longer gap are all masked, the stream starts over
+                state = self._new_stream(times[start] - times[start] % self.align)
+                self.streams[stream] = state
+            positions = times[start:stop] - state['positions'][0]
+            filled = np.zeros((positions[-1] + 1, self.n_pixels))
+            weights = np.zeros(positions[-1] + 1)
+            filled[positions], weights[positions] = batch[start:stop], 1.
+            self._feed(state, filled, weights)
+
+    def _feed(self, state, batch, weights):
+        for level in range(self.n_levels):
+            if not batch.shape[0]:
+                break
+            tail, tail_weights = state['tails'][level], state['tail_weights'][level]
+            joined = np.concatenate((tail, batch))
+            joined_weights = np.concatenate((tail_weights, weights))
+            # time index of the first joined frame at this level
+            base = state['positions'][level] - tail.shape[0]
+            first = -(-self.count_from >> level) - base
+            for idx in np.where(self.levels == level)[0]:
+                lag = self.lags[idx] >> level
+                start = max(tail.shape[0] - lag, first - lag, 0)
+                stop = joined.shape[0] - lag
+                if stop <= start:
+                    continue
+                left, right = joined[start:stop], joined[start + lag:stop + lag]
+                pair_weights = joined_weights[start:stop] * joined_weights[start + lag:stop + lag]
+                self.num[idx] += np.einsum('t,tp,tp->p', pair_weights, left, right)
+                self.left[idx] += pair_weights @ left
+                self.right[idx] += pair_weights @ right
+                self.count[idx] += int(pair_weights.sum())
+            state['tails'][level] = joined[-(self.m - 1):]
+            state['tail_weights'][level] = joined_weights[-(self.m - 1):]
+            state['positions'][level] += batch.shape[0]
+            pending = np.concatenate((state['pending'][level], batch))
+            pending_weights = np.concatenate((state['pending_weights'][level], weights))
+            n_pairs = pending.shape[0] // 2
+            state['pending'][level] = pending[2 * n_pairs:]
+            state['pending_weights'][level] = pending_weights[2 * n_pairs:]
+            batch = (pending[0:2 * n_pairs:2] + pending[1:2 * n_pairs:2]) / 2
+            weights = pending_weights[0:2 * n_pairs:2] * pending_weights[1:2 * n_pairs:2]
+
+    def merge(self, other):
+        """
+        Add up the accumulated products of another correlator of the same pixels
+        """
+        self.num += other.num
+        self.left += other.left
+        self.right += other.right
+        self.count += other.count
+        return self
+
+    def pixel_g2(self):
+        """
+        Return per-pixel g2 of shape (n_lags, n_pixels), NaN where undefined
+        """
+        count = np.maximum(self.count, 1)[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            g2 = (self.num / count) / ((self.left / count) * (self.right / count))
+        g2[self.count == 0] = np.nan
+        g2[~np.isfinite(g2)] = np.nan
+        return g2
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['streams'] = {}
+        return state
+
+def roi_g2(pixel_g2, labels):
+    """
+    Average per-pixel g2 of shape (n_lags, n_pixels) over ROIs, labels are
+    ROI numbers 1..n_rois of every pixel
+
+    Returns g2 of shape (n_rois, n_lags)
+    """
+    valid = np.isfinite(pixel_g2)
+    n_rois = labels.max()
+    sums = np.stack([np.bincount(labels - 1, weights=np.where(row_valid, row, 0.), minlength=n_rois)
+                     for row, row_valid in zip(pixel_g2, valid)], axis=1)
+    counts = np.stack([np.bincount(labels - 1, weights=row_valid, minlength=n_rois)
+                       for row_valid in valid], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def frame_runs(idxs, blocks):
+    """
+    Split increasing frame indices into (start, stop) runs of consecutive frames,
+    a run never crosses the boundary of the reader blocks
+    """
+    if not idxs.size:
+        return []
+    block_idxs = np.searchsorted([stop for _, stop in blocks], idxs, side='right')
+    breaks = np.flatnonzero((np.diff(idxs) != 1) | (np.diff(block_idxs) != 0)) + 1
+    return [(int(idxs[first]), int(idxs[last - 1]) + 1)
+            for first, last in zip(np.append(0, breaks), np.append(breaks, idxs.size))]
+
+def correlate_block(reader, pixels, mode, m, n_levels, runs, first_train, count_from=0):
+    """
+    Correlate the ROI pixels of the frames in runs, a list of (start, stop)
+    frame ranges read ahead in the background
+
+    first_train - train ID of time 0 in the 'inter' mode
+    count_from - time from which the products are accumulated in the 'inter' mode
+    """
+    corr = MultiTauCorrelator(pixels.size, m, n_levels, count_from)
+    last_train = None
+    for chunk in Prefetcher(reader.data_chunk, runs):
+        frames = chunk[reader.DATA_KEY].reshape(chunk[reader.DATA_KEY].shape[0], -1)[:, pixels]
+        train_ids, pulse_ids = chunk[reader.TRAIN_KEY], chunk[reader.PULSE_KEY]
+        order = np.lexsort((pulse_ids, train_ids) if mode == 'intra' else (train_ids, pulse_ids))
+        keys = train_ids[order] if mode == 'intra' else pulse_ids[order]
+        streams, starts = np.unique(keys, return_index=True)
+        for stream, start, stop in zip(streams, starts, np.append(starts[1:], keys.size)):
+            if mode == 'intra':
+                if last_train is not None and stream != last_train:
+                    corr.reset(last_train)
+                corr.update(frames[order[start:stop]], stream)
+                last_train = stream
+            else:
+                # the trains missing in a pulse ID stream leave gaps in its time grid
+                corr.update(frames[order[start:stop]], stream,
+                            train_ids[order[start:stop]].astype(np.int64) - first_train)
+    return corr
+
+def train_ranges(train_ids, mode, num_workers, m, n_levels):
+    """
+    Split the trains into num_workers (first, last, count_from) time ranges, the
+    trains of a range are correlated independently of the other ranges
+
+    Within trains the ranges split at train boundaries. Across trains the
+    ranges split at multiples of the top level time step and start m - 1 top
+    level steps earlier, the products are counted from the range start only
+    """
+    if mode == 'intra':
+        return [(int(trains[0]), int(trains[-1]) + 1, 0)
+                for trains in np.array_split(np.unique(train_ids), num_workers) if trains.size]
+    align = 2**(n_levels - 1)
+    first_train, n_steps = int(train_ids.min()), int(train_ids.max() - train_ids.min()) // align + 1
+    limits = np.unique(np.linspace(0, n_steps, num_workers + 1).astype(int)) * align
+    return [(first_train + max(start - (m - 1) * align, 0), first_train + stop, start)
+            for start, stop in zip(limits[:-1], limits[1:])]
+
+def correlate(reader, roi_labels, mode='intra', m=8, n_levels=6, block_size=None,
+              num_workers=utils.CORES_COUNT):
+    """
+    Compute multi-tau g2 of a CheetahData reader averaged over ROIs
+
+    reader - CheetahData family reader
+    roi_labels - frame shaped array of ROI numbers, 0 for the pixels outside of ROIs
+    mode - 'intra' for correlations over pulse delays within trains,
+           'inter' for correlations over train delays for every pulse ID, the
+           lags are in train IDs and the missing trains are masked
+    m, n_levels - multi-tau lags per level and number of levels
+    block_size - maximum number of frames read at once
+    num_workers - the trains are split into num_workers ranges, every worker
+                  reads only the frames of its range and the correlators are merged
+
+    Returns lags in frames (pulses or trains) and g2 of shape (n_rois, n_lags)
+    """
+    if mode not in CORR_MODES:
+        raise ValueError('Wrong correlation mode: {}'.format(mode))
+    labels = np.asarray(roi_labels).ravel()
+    pixels = np.flatnonzero(labels)
+    train_ids, _ = reader.frame_ids()
+    blocks = reader.blocks(block_size)
+    pool = Pool(num_workers)
+    with pool:
+        for first, last, count_from in train_ranges(train_ids, mode, num_workers, m, n_levels):
+            runs = frame_runs(np.flatnonzero((train_ids >= first) & (train_ids < last)), blocks)
+            pool.submit(correlate_block, reader, pixels, mode, m, n_levels, runs,
+                        int(train_ids.min()), count_from)
+    corr = MultiTauCorrelator(pixels.size, m, n_levels)
+    for fut in pool.futures:
+        corr.merge(pool.result(fut))
+    return multi_tau_lags(m, n_levels)[0], roi_g2(corr.pixel_g2(), labels[pixels])
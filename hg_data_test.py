@@ -0,0 +1,60 @@
+import numpy as np
+from exfel import calib
+from exfel.calib import HGData
+
+def synthetic_frames(size=300, shape=(48, 48), zero_adu=0., one_adu=60., seed=0):
+    rng = np.random.default_rng(seed)
+    photons = rng.poisson(0.3, (size,) + shape)
+    frames = rng.normal(zero_adu, 8., (size,) + shape) + one_adu * photons
+    # frame by frame baseline drift, removed by HGData optimization
+    return (frames.T + rng.normal(0, 5, size)).T
+
+def test_estimate(precision=0.5):
+    frames = synthetic_frames()
+    ref_zero_adu, ref_one_adu = HGData(frames).calibrate()
+    estimate = HGData(frames, optimize=False).estimate(precision=precision, seed=0)
+    # the interval is widened by the precision for the sampling noise of the interval itself
+    inside = all(lower - precision <= value <= upper + precision
+                 for value, (lower, upper) in ((ref_zero_adu, estimate.zero_interval),
+                                               (ref_one_adu, estimate.one_interval)))
+    assert inside and estimate.precision <= precision
+
+def test_estimate_fallback(monkeypatch):
+    frames = synthetic_frames(size=80, shape=(32, 32))
+    fit_sample = calib.fit_sample
+    sizes = []
+
+    def sparse_fit(frame_hists, *args):
+        # the fit fails on the samples of less than 20 frames
+        sizes.append(frame_hists.shape[0])
+        if frame_hists.shape[0] < 20:
+            raise RuntimeError('Optimal parameters not found')
+        return fit_sample(frame_hists, *args)
+
+    monkeypatch.setattr(calib, 'fit_sample', sparse_fit)
+    estimate = HGData(frames, optimize=False).estimate(precision=100., frames=5, seed=0)
+    assert sizes[:3] == [5, 10, 20] and estimate.frames == 20
+
+    def failed_fit(*args):
+        raise RuntimeError('Optimal parameters not found')
+
+    # the sample fit never succeeds, the levels are fitted to all the data
+    monkeypatch.setattr(calib, 'fit_sample', failed_fit)
+    estimate = HGData(frames, optimize=False).estimate(precision=100., frames=5, seed=0)
+    assert estimate.frames == 80 and estimate.precision == 0.
+    assert (estimate.zero_adu, estimate.one_adu) == HGData(frames).calibrate()
+
+def test_photonize_optimized():
+    frames = synthetic_frames(size=50, shape=(16, 16))
+    ref = HGData(frames).photonize(0., 60.)
+    photons = HGData(frames, optimize=False).photonize(0., 60.)
+    np.testing.assert_array_equal(photons.to_dense(), ref.to_dense())
+
+def test_iter_hist(roi=(-100, 200)):
+    frames = synthetic_frames(size=120, shape=(16, 16))
+    ref_hist, ref_adus = HGData(frames).histogram(roi)
+    updates = list(HGData(frames, optimize=False).iter_hist(roi, chunk_size=50))
+    assert [count for _, _, count in updates] == [50, 100, 120]
+    hist, adus, _ = updates[-1]
+    np.testing.assert_allclose(adus, ref_adus)
+    np.testing.assert_array_equal(hist, ref_hist)
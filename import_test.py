@@ -0,0 +1,38 @@
+import os
+import pickle
+import pytest
+import exfel
+from exfel.utils import utilities
+from bench_import import heavy_imports
+
+def test_no_heavy_imports():
+    assert heavy_imports() == []
+
+def test_lazy_attributes():
+    from exfel.sources import Source
+    assert exfel.Source is Source
+    assert 'Source' in vars(exfel)
+    with pytest.raises(AttributeError):
+        exfel.NoSuchName
+
+def test_geometry_cache(tmp_path, monkeypatch):
+    crystfel_utils = pytest.importorskip('cfelpyutils.crystfel_utils')
+    calls = []
+    def load_crystfel_geometry(path):
+        calls.append(path)
+        return {'path': path}
+    monkeypatch.setattr(crystfel_utils, 'load_crystfel_geometry', load_crystfel_geometry)
+    monkeypatch.setattr(utilities, 'CACHE_PATH', str(tmp_path / 'cache'))
+    geom_path = tmp_path / 'test.geom'
+    geom_path.write_text('clen = 0.1\n')
+    load_geometry = utilities.load_geometry.__wrapped__
+    assert load_geometry(str(geom_path)) == {'path': str(geom_path)}
+    assert load_geometry(str(geom_path)) == {'path': str(geom_path)}
+    assert len(calls) == 1
+    with open(utilities.geom_cache_path(str(geom_path)), 'rb') as cache_file:
+        assert pickle.load(cache_file) == {'path': str(geom_path)}
+    # an edited geometry file is parsed again
+    geom_path.write_text('clen = 0.2\n')
+    load_geometry(str(geom_path))
+    assert len(calls) == 2
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+from exfel import utils
+from exfel.integrate import AzimuthalIntegrator
+
+pytest.importorskip('scipy')
+
+def panel(min_ss, max_ss, cnx, cny):
+    return {'min_ss': min_ss, 'max_ss': max_ss, 'min_fs': 0, 'max_fs': 29, 'res': 5000.,
+            'ssx': 0., 'ssy': 1., 'fsx': 1., 'fsy': 0., 'cnx': cnx, 'cny': cny,
+            'clen': 0.1, 'coffset': 0.}
+
+GEOMETRY = {'panels': {'p0': panel(0, 19, -15., 2.), 'p1': panel(20, 39, -15., -22.)},
+            'beam': {'photon_energy': 9300.}}
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'CACHE_PATH', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+def test_radial():
+    integrator = AzimuthalIntegrator(GEOMETRY, q_bins=20, subpixels=1)
+    rng = np.random.default_rng(0)
+    frames = rng.random((3, 40, 30))
+    result = integrator.integrate(frames)
+    assert result.shape == (3, 20)
+    q, _ = integrator.q_phi(1)
+    idxs = np.clip(np.digitize(q[0], integrator.q_edges) - 1, 0, 19)
+    for frame, profile in zip(frames, result):
+        sums = np.bincount(idxs.ravel(), weights=frame.ravel(), minlength=20)
+        counts = np.bincount(idxs.ravel(), minlength=20)
+        with np.errstate(invalid='ignore'):
+            np.testing.assert_allclose(profile, sums / counts)
+    np.testing.assert_allclose(integrator.integrate(frames[0]), result[0])
+
+def test_azimuthal_mask():
+    mask = np.ones((40, 30), dtype=bool)
+    mask[:20] = False
+    integrator = AzimuthalIntegrator(GEOMETRY, q_bins=10, phi_bins=8, mask=mask)
+    frames = np.ones((2, 40, 30))
+    frames[:, :20] = 100.
+    result = integrator.integrate(frames)
+    assert result.shape == (2, 10, 8)
+    # masked pixels don't contribute, bins covering no pixels are NaN
+    assert np.all(result[np.isfinite(result)] == 1.)
+    assert np.isnan(result).any()
+
+def test_cache(cache_path):
+    integrator = AzimuthalIntegrator(GEOMETRY, q_bins=20)
+    assert os.listdir(str(cache_path)) == ['integrator-{:s}.npz'.format(integrator.digest)]
+    cached = AzimuthalIntegrator(GEOMETRY, q_bins=20)
+    assert (cached.matrix != integrator.matrix).nnz == 0
+    np.testing.assert_array_equal(cached.norm, integrator.norm)
+    other = AzimuthalIntegrator(GEOMETRY, q_bins=20, photon_energy=8000.)
+    assert other.digest != integrator.digest
+    assert len(os.listdir(str(cache_path))) == 2
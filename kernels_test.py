@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from exfel.utils import kernels
+
+KERNELS = ('frame_max', 'histogram', 'dark_bin_index', 'calibrate', 'assemble')
+
+def kernel_inputs(seed=0):
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 2**14, (20, 64, 32)).astype(np.uint16)
+    gain = rng.integers(0, 2**14, (20, 64, 32)).astype(np.uint16)
+    hg_offset, mg_offset = rng.normal(5000, 100, (2, 64, 32)).astype(np.float32)
+    gain_level = np.full((64, 32), 2**13, dtype=np.float32)
+    bad_mask = rng.integers(0, 2, (64, 32)).astype(np.uint8)
+    rows, cols = np.meshgrid(np.arange(64)[::-1], np.arange(32) + 3, indexing='ij')
+    data = rng.normal(0, 50, 10**5)
+    return {'frame_max': (raw,),
+            'histogram': (data, 300, (-200, 100)),
+            'dark_bin_index': (raw, hg_offset, bad_mask, 100, (0, 30)),
+            'calibrate': (raw, gain, hg_offset, mg_offset, gain_level, bad_mask, (0, 20),
+                          (1 / 68.8, 1 / 1.376)),
+            'assemble': (raw, rows, cols, (64, 40), np.int32)}
+
+def run_kernel(backend, name, args, monkeypatch):
+    monkeypatch.setenv(kernels.BACKEND_ENV, backend)
+    return getattr(kernels, name)(*args)
+
+@pytest.mark.parametrize('name', KERNELS)
+def test_backends(name, monkeypatch):
+    pytest.importorskip('numba')
+    args = kernel_inputs()[name]
+    ref = run_kernel('numpy', name, args, monkeypatch)
+    result = run_kernel('numba', name, args, monkeypatch)
+    if name == 'calibrate':
+        # flat correction means differ by the floating point summation order
+        for value, ref_value in zip(result, ref):
+            assert value.dtype == ref_value.dtype
+            np.testing.assert_allclose(value, ref_value, rtol=0, atol=1e-9)
+        np.testing.assert_array_equal(result[1], ref[1])
+    else:
+        assert result.dtype == ref.dtype
+        np.testing.assert_array_equal(result, ref)
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_frame_max_nan(backend, monkeypatch):
+    if backend == 'numba':
+        pytest.importorskip('numba')
+    frames = np.arange(24, dtype=np.float32).reshape(4, 6)
+    frames[0, 0], frames[1, 3], frames[2, 5] = np.nan, np.nan, np.nan
+    result = run_kernel(backend, 'frame_max', (frames,), monkeypatch)
+    np.testing.assert_array_equal(result, frames.max(axis=1))
+    assert np.isnan(result[:3]).all() and result[3] == 23
+
+def test_wrong_backend(monkeypatch):
+    with pytest.raises(ValueError):
+        kernels.set_backend('cuda')
+    monkeypatch.setenv(kernels.BACKEND_ENV, 'cuda')
+    with pytest.raises(ValueError):
+        kernels.get_backend()
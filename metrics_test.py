@@ -0,0 +1,34 @@
+import pstats
+import h5py
+import numpy as np
+import pytest
+from exfel.utils import metrics
+from exfel.utils.chunk_writer import inflate_frames, read_frames
+
+@pytest.fixture
+def deflated_file(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, (50, 13, 7)).astype(np.uint16)
+    with h5py.File(tmp_path / 'frames.h5', 'w') as out_file:
+        out_file.create_dataset('data', data=data, chunks=(4, 5, 7), compression='gzip')
+    with h5py.File(tmp_path / 'frames.h5', 'r') as data_file:
+        yield data_file['data'], data
+
+@pytest.mark.parametrize('start, stop', [(0, 50), (3, 17), (8, 12), (45, 60), (10, 10)])
+def test_inflate_frames(deflated_file, start, stop):
+    dataset, data = deflated_file
+    np.testing.assert_array_equal(inflate_frames(dataset, start, stop), data[start:stop])
+
+def test_decompress_stage(deflated_file, tmp_path):
+    dataset, data = deflated_file
+    frames, record = metrics.run_task(read_frames, 'read', None, dataset, 5, 40)
+    np.testing.assert_array_equal(frames, data[5:40])
+    assert record['stages']['decompress'] > 0.
+    assert record['stop'] >= record['start']
+
+def test_worker_profile(tmp_path):
+    metrics.run_task(sum, 'first', str(tmp_path), range(10))
+    metrics.run_task(sorted, 'second', str(tmp_path), range(10))
+    stats = pstats.Stats(metrics.profile_path(str(tmp_path)))
+    names = set(name for _, _, name in stats.stats)
+    assert {"<built-in method builtins.sum>", "<built-in method builtins.sorted>"} <= names
@@ -0,0 +1,51 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.photons import SparseFrames, photonize, read_sparse, read_dense, read_csr
+
+def photon_frames(size=12, shape=(6, 5), seed=0):
+    rng = np.random.default_rng(seed)
+    frames = rng.poisson(0.3, (size,) + shape)
+    frames[3] = 0
+    frames[5, 2, 1] = 300
+    return frames
+
+def test_photonize():
+    frames = np.array([[-10., 20., 29., 31., 95., 160.]])
+    photons = photonize(frames, zero_adu=0., one_adu=60.)
+    np.testing.assert_array_equal(photons, [[0, 0, 0, 1, 2, 3]])
+    assert photons.dtype == np.uint32
+
+def test_round_trip():
+    frames = photon_frames()
+    sparse = SparseFrames.from_dense(frames)
+    assert sparse.size == len(sparse) == frames.shape[0]
+    assert sparse.counts.dtype == np.uint16
+    assert sparse.offsets[4] == sparse.offsets[3]
+    np.testing.assert_array_equal(sparse.to_dense(), frames)
+    pytest.importorskip('scipy')
+    np.testing.assert_array_equal(sparse.to_csr().toarray(), frames.reshape(frames.shape[0], -1))
+
+def test_concatenate():
+    frames = photon_frames()
+    parts = [SparseFrames.from_dense(frames[start:start + 5]) for start in range(0, 12, 5)]
+    joined = SparseFrames.concatenate(parts)
+    np.testing.assert_array_equal(joined.to_dense(), frames)
+    np.testing.assert_array_equal(joined.offsets, SparseFrames.from_dense(frames).offsets)
+
+def test_save_append(tmp_path):
+    frames = photon_frames()
+    with h5py.File(str(tmp_path / 'photons.h5'), 'w') as out_file:
+        SparseFrames.from_dense(frames).save(out_file.create_group('saved'))
+        group = out_file.create_group('appended')
+        for start in range(0, 12, 5):
+            SparseFrames.from_dense(frames[start:start + 5]).append(group)
+    with h5py.File(str(tmp_path / 'photons.h5'), 'r') as out_file:
+        for name in ('saved', 'appended'):
+            np.testing.assert_array_equal(read_dense(out_file[name]), frames)
+            np.testing.assert_array_equal(read_dense(out_file[name], 4, 9), frames[4:9])
+            part = read_sparse(out_file[name], 5, 6)
+            assert part.offsets[0] == 0 and part.to_dense()[0, 2, 1] == 300
+        pytest.importorskip('scipy')
+        np.testing.assert_array_equal(read_csr(out_file['saved'], 2, 7).toarray(),
+                                      frames[2:7].reshape(5, -1))
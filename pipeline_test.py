@@ -0,0 +1,128 @@
+import h5py
+import numpy as np
+import pytest
+from exfel import utils
+from exfel.calib import DarkAGIPD, AGIPDCalib
+from exfel.data import (CheetahData, RawModuleJoined, RAW_DATA_PATH, RAW_TRAIN_PATH,
+                        RAW_PULSE_PATH)
+from exfel.pipeline import (Pipeline, ReadStage, TrimStage, CalibrateStage, GeometryStage,
+                            WriteStage)
+from exfel.utils.cache import BlockCache
+from exfel.utils.metrics import Metrics
+from data_test import cheetah_file
+
+def test_cache_stats(tmp_path):
+    data, _, pulse_ids = cheetah_file(str(tmp_path / 'data.h5'))
+    reader = CheetahData(str(tmp_path / 'data.h5'))
+    cache = BlockCache(str(tmp_path / 'blocks'))
+    stages = [ReadStage(reader, block_size=7), TrimStage(pid=1)]
+    first = list(Pipeline(stages, cache=cache))
+    assert cache.stats()['hits'] == 0 and cache.stats()['misses'] == 6
+    run_metrics = Metrics()
+    second = list(Pipeline(stages, metrics=run_metrics, cache=cache))
+    assert cache.hits == 6 and cache.misses == 6
+    # the cache totals include the first run, the run counts only its own lookups
+    counters = run_metrics.main.counters
+    assert counters['cache_hits'] == 6 and counters['cache_misses'] == 0
+    for chunks in (first, second):
+        frames = np.concatenate([chunk[utils.DATA_KEY] for chunk in chunks])
+        np.testing.assert_array_equal(frames, data[pulse_ids == 1])
+
+def test_evicted(tmp_path):
+    data, _, _ = cheetah_file(str(tmp_path / 'data.h5'))
+    reader = CheetahData(str(tmp_path / 'data.h5'))
+    # no block fits the budget, every lookup hit is evicted and recomputed
+    cache = BlockCache(str(tmp_path / 'blocks'), max_bytes=0)
+    pipeline = Pipeline([ReadStage(reader, block_size=10), TrimStage()], cache=cache)
+    frames = np.concatenate([chunk[utils.DATA_KEY] for chunk in pipeline])
+    np.testing.assert_array_equal(frames, data)
+    assert cache.hits == 0 and cache.misses == 4
+
+def test_geometry_key(tmp_path):
+    cheetah_file(str(tmp_path / 'data.h5'))
+    reader = CheetahData(str(tmp_path / 'data.h5'))
+    stages = [ReadStage(reader, block_size=10), GeometryStage()]
+    assert Pipeline(stages).block_keys(reader.blocks(10)) is None
+    cache = BlockCache(str(tmp_path / 'blocks'))
+    keys = Pipeline(stages, cache=cache).block_keys(reader.blocks(10))
+    assert len(set(keys)) == 4
+
+def raw_module_file(path, module_id, size=24, shape=(32, 16), pulses=4, seed=0,
+                    data_path=RAW_DATA_PATH, train_path=RAW_TRAIN_PATH, pulse_path=RAW_PULSE_PATH):
+    rng = np.random.default_rng(seed)
+    data = np.empty((size, 2) + shape, dtype=np.uint16)
+    data[:, 0] = rng.integers(4000, 6000, (size,) + shape)
+    data[:, 1] = rng.integers(4000, 6000, (size,) + shape)
+    pulse_ids = np.tile(np.arange(pulses), size // pulses + 1)[:size]
+    train_ids = 1000 + np.arange(size) // pulses
+    with h5py.File(path, 'w') as out_file:
+        out_file.create_dataset(data_path.format(module_id), data=data)
+        out_file.create_dataset(train_path.format(module_id), data=train_ids[:, None])
+        out_file.create_dataset(pulse_path.format(module_id), data=pulse_ids[:, None])
+    return data, train_ids, pulse_ids
+
+def dark_file(path, module_id, shape=(32, 16), seed=1):
+    rng = np.random.default_rng(seed)
+    dark_shape = (3, 2, module_id + 1) + shape
+    with h5py.File(path, 'w') as out_file:
+        out_file[DarkAGIPD.OFFSET_KEY] = rng.normal(5000., 20., dark_shape)
+        out_file[DarkAGIPD.GAIN_LEVEL_KEY] = rng.normal(5000., 20., dark_shape)
+        out_file[DarkAGIPD.BADMASK_KEY] = (rng.random(dark_shape) < 0.05).astype(np.uint8)
+    return DarkAGIPD(path)
+
+def read_output(path):
+    datasets = {}
+    with h5py.File(path, 'r') as out_file:
+        out_file.visititems(lambda name, item: datasets.update({name: item[()]})
+                            if isinstance(item, h5py.Dataset) else None)
+    return datasets
+
+@pytest.mark.parametrize('chain', ['calibrate', 'geometry'])
+def test_process_mode(tmp_path, monkeypatch, chain):
+    data, _, pulse_ids = raw_module_file(str(tmp_path / 'raw.h5'), 3)
+    reader = RawModuleJoined(3, str(tmp_path / 'raw.h5'))
+    rows, cols = np.indices((32, 16))
+    monkeypatch.setattr(utils, 'pixel_maps', lambda: (rows + 2, 16 - cols, (36, 20)))
+    dark = dark_file(str(tmp_path / 'dark.h5'), 3)
+    outputs = {}
+    for mode in ('serial', 'process'):
+        out_path = str(tmp_path / '{}.h5'.format(mode))
+        stages = [ReadStage(reader, block_size=5, num_workers=2), TrimStage(pid=1)]
+        if chain == 'calibrate':
+            stages += [CalibrateStage(dark, 3, num_workers=2, queue_size=3),
+                       WriteStage(out_path, 'MODULE03', axes=CalibrateStage.FRAME_AXES)]
+        else:
+            stages += [GeometryStage(num_workers=2), WriteStage(out_path)]
+        assert Pipeline(stages, mode=mode).run() == (pulse_ids == 1).sum()
+        outputs[mode] = read_output(out_path)
+    assert sorted(outputs['serial']) == sorted(outputs['process'])
+    for key, value in outputs['serial'].items():
+        np.testing.assert_array_equal(outputs['process'][key], value)
+    frames = data[pulse_ids == 1]
+    if chain == 'calibrate':
+        calib_data = AGIPDCalib(frames[:, 0], frames[:, 1], dark, 3)
+        np.testing.assert_array_equal(outputs['serial']['MODULE03/adu'], calib_data.adu)
+        np.testing.assert_array_equal(outputs['serial']['MODULE03/mask'], calib_data.mask)
+    else:
+        images = np.zeros((frames.shape[0], 36, 20), dtype=frames.dtype)
+        images[:, rows + 2, 16 - cols] = frames[:, 0]
+        np.testing.assert_array_equal(outputs['serial']['data/data'], images)
+
+class CountedRead(ReadStage):
+    def __init__(self, reader, block_size, counter, queue_size=None):
+        super(CountedRead, self).__init__(reader, block_size, queue_size=queue_size)
+        self.counter = counter
+
+    def tasks(self):
+        for task in super(CountedRead, self).tasks():
+            self.counter.append(task)
+            yield task
+
+@pytest.mark.parametrize('queue_size', [1, 3])
+def test_queue_size(tmp_path, queue_size):
+    cheetah_file(str(tmp_path / 'data.h5'))
+    reader, counter = CheetahData(str(tmp_path / 'data.h5')), []
+    stages = [CountedRead(reader, 2, counter, queue_size), TrimStage(queue_size=queue_size)]
+    lead = [len(counter) - idx for idx, _ in enumerate(Pipeline(stages))]
+    # the chunk being consumed and queue_size - 1 chunks queued by every stage
+    assert len(lead) == 20 and max(lead) == 2 * queue_size - 1
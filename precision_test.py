@@ -0,0 +1,71 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.utils.precision import Precision, decode, read_dataset, SCALE_ATTR, PACKED_ATTR
+
+@pytest.fixture
+def group(tmp_path):
+    with h5py.File(str(tmp_path / 'precision.h5'), 'w') as out_file:
+        yield out_file.create_group('data')
+
+def test_encode():
+    policy = Precision()
+    assert policy.encode(np.array([0., 3., 250.]))[0].dtype == np.uint8
+    assert policy.encode(np.array([-1, 40000]))[0].dtype == np.int32
+    values = np.array([0.1, 0.25, 1e6])
+    array, attrs = policy.encode(values)
+    np.testing.assert_array_equal(array, values)
+    values = np.linspace(0., 1000., 52)
+    array, attrs = Precision(0.01).encode(values)
+    assert SCALE_ATTR in attrs and array.dtype == np.uint16
+    assert np.abs(decode(array, attrs) - values).max() <= 0.01 * (1 + 1e-9)
+    with pytest.raises(ValueError):
+        Precision(-1.)
+
+def test_masks():
+    mask = np.random.default_rng(0).random((3, 11)) > 0.5
+    array, attrs = Precision().encode(mask, 'mask')
+    assert array.dtype == np.bool_ and not attrs
+    array, attrs = Precision(mask_keys=('mask',)).encode(mask, 'mask')
+    assert array.shape == (3, 2) and tuple(attrs[PACKED_ATTR]) == (3, 11)
+
+def test_append_widen(group):
+    policy = Precision()
+    for chunk in (np.arange(10), np.arange(300, 310), np.array([0.5]), -np.arange(5)):
+        policy.append(group, 'values', chunk)
+    assert group['values'].dtype == np.float32
+    np.testing.assert_array_equal(read_dataset(group['values']),
+                                  np.concatenate((np.arange(10), np.arange(300, 310), [0.5], -np.arange(5))))
+
+def test_append_quantized(group):
+    policy = Precision(0.05)
+    rng = np.random.default_rng(1)
+    chunks = [rng.uniform(0., 1., 20), rng.uniform(-3., 0., 20), rng.uniform(0., 200., 20)]
+    for chunk in chunks:
+        policy.append(group, 'values', chunk)
+    first = decode(*policy.encode(chunks[0]))
+    restored = read_dataset(group['values'])
+    assert group['values'].attrs[SCALE_ATTR] == 0.1
+    # the stored levels are only cast, the first chunk is not quantized twice
+    np.testing.assert_array_equal(restored[:20], first)
+    assert np.abs(restored - np.concatenate(chunks)).max() <= 0.05 * (1 + 1e-9)
+
+def test_declared_range(group):
+    policy = Precision()
+    policy.append(group, 'values', np.arange(5), vrange=(-10, 1000))
+    policy.append(group, 'values', np.array([999, -10]))
+    assert group['values'].dtype == np.int16
+    np.testing.assert_array_equal(group['values'][:], [0, 1, 2, 3, 4, 999, -10])
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_widen_chunked(group, axis):
+    policy = Precision()
+    values = np.arange(2 * 50 * 3).reshape((2, 50, 3)) % 200
+    chunks = (2, 4, 3) if axis else (1, 50, 3)
+    policy.append(group, 'values', values, axis=axis, chunks=chunks, compression='gzip')
+    assert group['values'].dtype == np.uint8
+    policy.append(group, 'values', values - 1000, axis=axis)
+    dataset = group['values']
+    assert dataset.dtype == np.int16 and dataset.chunks == chunks
+    assert dataset.compression == 'gzip' and list(group) == ['values']
+    np.testing.assert_array_equal(dataset[()], np.concatenate((values, values - 1000), axis=axis))
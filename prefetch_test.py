@@ -0,0 +1,37 @@
+import time
+import numpy as np
+import pytest
+from exfel.utils.prefetch import Prefetcher
+
+def read_block(start, stop, scale=1):
+    return {'data': scale * np.arange(start, stop)}
+
+@pytest.mark.parametrize('mode', ['thread', 'process'])
+def test_order(mode):
+    tasks = [(start, start + 5) for start in range(0, 50, 5)]
+    blocks = list(Prefetcher(read_block, tasks, args=(2,), depth=3, mode=mode))
+    assert len(blocks) == len(tasks)
+    np.testing.assert_array_equal(np.concatenate([block['data'] for block in blocks]),
+                                  2 * np.arange(50))
+
+@pytest.mark.parametrize('depth, mem_cap, ahead', [(3, None, 3), (3, 100, 1), (4, 250, 3)])
+def test_read_ahead(depth, mem_cap, ahead):
+    calls = []
+    def func(start, stop):
+        calls.append(start)
+        return {'data': np.zeros(stop - start, dtype=np.uint8)}
+    prefetcher = Prefetcher(func, [(start, start + 80) for start in range(20)],
+                            depth=depth, mem_cap=mem_cap)
+    blocks = iter(prefetcher)
+    # the blocks queued before the block size is known are drained first
+    for _ in range(depth + 1):
+        next(blocks)
+    time.sleep(0.2)
+    assert len(calls) <= depth + 1 + ahead
+    assert len(list(blocks)) == 19 - depth
+
+def test_wrong_arguments():
+    with pytest.raises(ValueError):
+        Prefetcher(read_block, [], mode='fork')
+    with pytest.raises(ValueError):
+        Prefetcher(read_block, [], depth=0)
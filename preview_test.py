@@ -0,0 +1,46 @@
+import h5py
+import numpy as np
+from exfel.utils.preview import (save_preview, frame_pyramid, train_sums, merge_train_sums,
+                                 bin_frames, PREVIEW_GROUP, THUMBNAIL_KEY, THUMBNAIL_TRAIN_KEY)
+
+def frames(size=10, shape=(19, 34), seed=0):
+    return np.random.default_rng(seed).random((size,) + shape).astype(np.float32)
+
+def test_pyramid():
+    data = frames()
+    pyramid = frame_pyramid(data, (2, 3, 4, 8))
+    assert sorted(pyramid) == [2, 3, 4, 8]
+    for factor, level in pyramid.items():
+        ref = data[:, :19 // factor * factor, :34 // factor * factor]
+        ref = ref.reshape(10, 19 // factor, factor, 34 // factor, factor).mean(axis=(2, 4))
+        np.testing.assert_allclose(level, ref, rtol=1e-6)
+    np.testing.assert_allclose(bin_frames(data[0], 2), pyramid[2][0])
+
+def test_train_sums():
+    data = frames()
+    train_ids = np.array([3, 3, 1, 1, 1, 7, 3, 7, 7, 1])
+    trains, sums, counts = train_sums(data, train_ids)
+    np.testing.assert_array_equal(trains, [1, 3, 7])
+    np.testing.assert_array_equal(counts, [4, 3, 3])
+    np.testing.assert_allclose(sums[1], data[train_ids == 3].sum(axis=0, dtype=np.float64))
+    merged = merge_train_sums([train_sums(data[:4], train_ids[:4]),
+                               train_sums(data[4:], train_ids[4:])])
+    for value, ref in zip(merged, (trains, sums, counts)):
+        np.testing.assert_allclose(value, ref)
+
+def test_save_preview(tmp_path):
+    data = frames()
+    train_ids = np.repeat([10, 11, 12, 13, 14], 2)
+    with h5py.File(str(tmp_path / 'preview.h5'), 'w') as out_file:
+        save_preview(out_file, data, train_ids)
+        save_preview(out_file.create_group('empty'), data[:0], train_ids[:0])
+    with h5py.File(str(tmp_path / 'preview.h5'), 'r') as out_file:
+        group = out_file[PREVIEW_GROUP]
+        assert sorted(group) == ['data_2x2', 'data_4x4', 'data_8x8', THUMBNAIL_KEY,
+                                 THUMBNAIL_TRAIN_KEY]
+        assert group['data_8x8'].shape == (10, 2, 4)
+        np.testing.assert_array_equal(group[THUMBNAIL_TRAIN_KEY][()], [10, 11, 12, 13, 14])
+        np.testing.assert_allclose(group[THUMBNAIL_KEY][()],
+                                   group['data_8x8'][()].reshape(5, 2, 2, 4).mean(axis=1),
+                                   rtol=1e-6)
+        assert out_file['empty'][PREVIEW_GROUP][THUMBNAIL_KEY].shape == (0, 2, 4)
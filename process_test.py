@@ -0,0 +1,60 @@
+import os
+import sys
+import h5py
+import numpy as np
+import pytest
+from exfel import process
+from exfel.calib import AGIPDCalib
+from pipeline_test import raw_module_file, dark_file
+
+CONFIG = """[raw_data]
+beam_line = MID
+raw_path = {raw_path:s}
+output_path = {out_path:s}
+
+[dark]
+dark_path = {dark_path:s}
+hg_run = 37
+mg_run = 38
+lg_run = 39
+
+[process]
+block_size = 5
+"""
+
+@pytest.fixture
+def run_config(tmp_path):
+    raw_path, out_path, dark_path = (str(tmp_path / name) for name in ('raw', 'out', 'dark'))
+    file_path = os.path.join(raw_path, 'raw/r0001/RAW-R0001-AGIPD03-S00000.h5')
+    os.makedirs(os.path.dirname(file_path))
+    data, _, pulse_ids = raw_module_file(file_path, 3)
+    dark_file_path = os.path.join(dark_path, 'r0037-r0038-r0039/Cheetah-AGIPD-calib.h5')
+    os.makedirs(os.path.dirname(dark_file_path))
+    dark = dark_file(dark_file_path, 3)
+    config_file = str(tmp_path / 'config.ini')
+    with open(config_file, 'w') as config:
+        config.write(CONFIG.format(raw_path=raw_path, out_path=out_path, dark_path=dark_path))
+    return config_file, out_path, data[pulse_ids == 1], dark
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['process'] + [str(arg) for arg in args])
+    process.main()
+
+def test_pid(monkeypatch, run_config):
+    config_file, out_path, frames, _ = run_config
+    run_main(monkeypatch, 1, 'pid', '--config_file', config_file, '--chunk_number', 0,
+             '--module_id', 3, '--pulse_id', 1)
+    with h5py.File(os.path.join(out_path, 'r0001/AGIPD03-PID001.h5'), 'r') as out_file:
+        np.testing.assert_array_equal(out_file['data/data'][()], frames[:, 0])
+        np.testing.assert_array_equal(out_file['data/gain'][()], frames[:, 1])
+        assert (out_file['data/pulseId'][()] == 1).all()
+
+def test_hg(monkeypatch, run_config):
+    config_file, out_path, frames, dark = run_config
+    run_main(monkeypatch, 1, 'hg', '--config_file', config_file, '--chunk_number', 0,
+             '--module_id', 3, '--pulse_id', 1)
+    calib_data = AGIPDCalib(frames[:, 0], frames[:, 1], dark, 3)
+    with h5py.File(os.path.join(out_path, 'r0001/AGIPD03-HG001.h5'), 'r') as out_file:
+        np.testing.assert_array_equal(out_file['MODULE03/adu'][()], calib_data.adu)
+        np.testing.assert_array_equal(out_file['MODULE03/mask'][()], calib_data.mask)
+        np.testing.assert_array_equal(out_file['MODULE03/data'][()], calib_data.data)
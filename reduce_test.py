@@ -0,0 +1,53 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.reduce import PulseReducer, SUM_KEY, MEAN_KEY, VAR_KEY, MAX_KEY, COUNT_KEY, HITS_KEY
+
+def pulse_frames(size=60, shape=(5, 4), seed=0):
+    rng = np.random.default_rng(seed)
+    frames = rng.integers(2**30, 2**31, (size,) + shape).astype(np.int64)
+    pulse_ids = rng.choice([0, 4, 8], size)
+    return frames, pulse_ids
+
+def check_products(products, frames, pulse_ids, limit):
+    for idx, pid in enumerate(np.unique(pulse_ids)):
+        selected = frames[pulse_ids == pid]
+        assert products[COUNT_KEY][idx] == selected.shape[0]
+        assert products[HITS_KEY][idx] == (selected.max(axis=(1, 2)) > limit).sum()
+        # the sum of large integers is exact, not mean * count
+        np.testing.assert_array_equal(products[SUM_KEY][idx], selected.sum(axis=0))
+        np.testing.assert_allclose(products[MEAN_KEY][idx], selected.mean(axis=0))
+        np.testing.assert_allclose(products[VAR_KEY][idx], selected.var(axis=0))
+        np.testing.assert_array_equal(products[MAX_KEY][idx], selected.max(axis=0))
+
+def test_blocks():
+    frames, pulse_ids = pulse_frames()
+    limit = int(np.median(frames))
+    reducer = PulseReducer(limit)
+    for start in range(0, 60, 7):
+        reducer.update(frames[start:start + 7], pulse_ids[start:start + 7])
+    assert reducer.products()[SUM_KEY].dtype == np.int64
+    check_products(reducer.products(), frames, pulse_ids, limit)
+
+def test_merge(tmp_path):
+    frames, pulse_ids = pulse_frames()
+    parts = [PulseReducer(2**31).update(frames[start:start + 25], pulse_ids[start:start + 25])
+             for start in (0, 25, 50)]
+    reducer = parts[0].merge(parts[1]).merge(parts[2])
+    check_products(reducer.products(), frames, pulse_ids, 2**31)
+    with h5py.File(str(tmp_path / 'reduced.h5'), 'w') as out_file:
+        reducer.save(out_file)
+    with h5py.File(str(tmp_path / 'reduced.h5'), 'r') as out_file:
+        np.testing.assert_array_equal(out_file['data/pulseId'][:], [0, 4, 8])
+        np.testing.assert_array_equal(out_file['data'][SUM_KEY][:], reducer.products()[SUM_KEY])
+        assert out_file['data'].attrs['limit'] == 2**31
+
+def test_float_frames():
+    frames = np.random.default_rng(1).normal(0, 1, (20, 3)).astype(np.float32)
+    products = PulseReducer().update(frames, np.zeros(20, dtype=int)).products()
+    assert products[SUM_KEY].dtype == np.float64
+    np.testing.assert_allclose(products[SUM_KEY][0], frames.sum(axis=0, dtype=np.float64))
+
+def test_empty():
+    with pytest.raises(ValueError):
+        PulseReducer().products()
@@ -0,0 +1,57 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.data import RawJoined
+from exfel.reorder import reorder_pulse_major, LAYOUT_ATTR, PULSE_MAJOR
+
+DATA_PATH, PULSE_PATH, TRAIN_PATH = '/I/data', '/I/pulseId', '/I/trainId'
+
+def raw_file(path, size=130, pulses=11, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 2**14, (size, 2, 6, 4)).astype(np.uint16)
+    train_ids = (1000 + np.arange(size) // pulses)[:, None]
+    pulse_ids = ((np.arange(size) % pulses) * 4)[:, None]
+    with h5py.File(path, 'w') as out_file:
+        out_file[DATA_PATH], out_file[TRAIN_PATH], out_file[PULSE_PATH] = \
+            data, train_ids, pulse_ids
+    return RawJoined(path, DATA_PATH, PULSE_PATH, TRAIN_PATH), data, pulse_ids[:, 0]
+
+@pytest.mark.parametrize('mem_cap', [1, 2**20])
+def test_reorder(tmp_path, mem_cap):
+    reader, data, pulse_ids = raw_file(str(tmp_path / 'raw.h5'))
+    out_path = str(tmp_path / 'pulse_major.h5')
+    assert reorder_pulse_major(reader, out_path, block_size=17, mem_cap=mem_cap) == 130
+    order = np.argsort(pulse_ids, kind='stable')
+    with h5py.File(out_path, 'r') as out_file:
+        assert out_file.attrs[LAYOUT_ATTR] == PULSE_MAJOR
+        np.testing.assert_array_equal(out_file[DATA_PATH][()], data[order])
+        np.testing.assert_array_equal(out_file[PULSE_PATH][()][:, 0], pulse_ids[order])
+    pulse_major = RawJoined(out_path, DATA_PATH, PULSE_PATH, TRAIN_PATH)
+    assert reader.pulse_index() is None
+    assert pulse_major.pulse_index()[8] == (24, 12)
+    for pid in (0, 8, 40):
+        ref = reader.get_ordered_data(pid)
+        result = pulse_major.get_ordered_data(pid)
+        for key in ref:
+            np.testing.assert_array_equal(result[key], ref[key])
+
+def test_reorder_sequence(tmp_path):
+    first, data, pulse_ids = raw_file(str(tmp_path / 'raw-0.h5'))
+    second, more_data, more_ids = raw_file(str(tmp_path / 'raw-1.h5'), size=50, seed=1)
+    out_path = str(tmp_path / 'pulse_major.h5')
+    assert reorder_pulse_major([first, second], out_path, block_size=40) == 180
+    order = np.argsort(np.concatenate((pulse_ids, more_ids)), kind='stable')
+    with h5py.File(out_path, 'r') as out_file:
+        np.testing.assert_array_equal(out_file[DATA_PATH][()],
+                                      np.concatenate((data, more_data))[order])
+
+def test_prefetch_pulse_blocks(tmp_path):
+    reader, _, _ = raw_file(str(tmp_path / 'raw.h5'))
+    reorder_pulse_major(reader, str(tmp_path / 'pulse_major.h5'))
+    pulse_major = RawJoined(str(tmp_path / 'pulse_major.h5'), DATA_PATH, PULSE_PATH, TRAIN_PATH)
+    # only the blocks of the pulse ID are read from a pulse-major file
+    blocks = pulse_major.prefetch(pulse_major.ordered_data_chunk, args=(8,), block_size=5, pid=8)
+    assert blocks.tasks == [(24, 29), (29, 34), (34, 36)]
+    frames = np.concatenate([block[pulse_major.DATA_KEY] for block in blocks])
+    np.testing.assert_array_equal(frames, reader.get_ordered_data(8)[reader.DATA_KEY])
+    assert len(reader.prefetch(block_size=5, pid=8)) == len(reader.blocks(5))
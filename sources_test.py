@@ -0,0 +1,47 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.sources import Source, source_mask
+
+def source_file(path, **datasets):
+    with h5py.File(path, 'w') as out_file:
+        for name, value in datasets.items():
+            out_file[name] = value
+    return path
+
+def test_pulse_resolved(tmp_path):
+    path = source_file(str(tmp_path / 'src.h5'), train=[5, 5, 6, 6, 7], pulse=[0, 2, 0, 2, 0],
+                       value=[1., 2., 3., 4., 5.])
+    source = Source('energy', path, 'value', 'train', pulse_path='pulse')
+    values = source.align([6, 5, 7, 8, 5], [2, 0, 0, 0, 4])
+    np.testing.assert_array_equal(values, [4., 1., 5., np.nan, np.nan])
+
+def test_pulse_columns(tmp_path):
+    # XGM style (trains, pulses) arrays split over sequence files
+    source_file(str(tmp_path / 'src-S00000.h5'), train=[10, 11],
+                value=[[1., 2., 3.], [4., 5., 6.]])
+    source_file(str(tmp_path / 'src-S00001.h5'), train=[13], value=[[7., 8., 9.]])
+    source = Source('xgm', str(tmp_path / 'src-S*.h5'), 'value', 'train', pulse_step=4)
+    values = source.align([10, 10, 11, 12, 13, 13], [0, 8, 4, 0, 4, 12])
+    np.testing.assert_array_equal(values, [1., 3., 5., np.nan, 8., np.nan])
+
+def test_per_train(tmp_path):
+    path = source_file(str(tmp_path / 'src.h5'), train=[20, 10, 30], value=[2., 1., 3.])
+    values = Source('motor', path, 'value', 'train').align([10, 20, 25], [0, 0, 0])
+    np.testing.assert_array_equal(values, [1., 2., np.nan])
+    values = Source('motor', path, 'value', 'train', interpolate=True).align([10, 25, 40], [0] * 3)
+    np.testing.assert_array_equal(values, [1., 2.5, np.nan])
+    with pytest.raises(ValueError):
+        Source('motor', path, 'value', 'train', pulse_step=1, interpolate=True)
+    with pytest.raises(ValueError):
+        Source('motor', str(tmp_path / 'missing*.h5'), 'value').read()
+
+def test_source_mask():
+    values = {'a': np.array([1., np.nan, 3., 4.]),
+              'b': np.array([[0., 1.], [0., 0.], [5., 0.], [0., 2.]])}
+    np.testing.assert_array_equal(source_mask(values, {'a': (None, 3.)}, 4),
+                                  [True, False, True, False])
+    np.testing.assert_array_equal(source_mask(values, {'b': (0., 1.)}, 4),
+                                  [True, True, False, False])
+    with pytest.raises(ValueError):
+        source_mask(values, {'c': (None, None)}, 4)
@@ -0,0 +1,48 @@
+import os
+import time
+import numpy as np
+import pytest
+from exfel.calib import HGData, log_scale
+
+pytest.importorskip('scipy')
+pytest.importorskip('PyQt5')
+pytest.importorskip('pyqtgraph')
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from exfel.viewer import CalibViewer, QtWidgets
+
+def synthetic_frames(size=300, shape=(64, 64), zero_adu=0., one_adu=60., seed=0):
+    rng = np.random.default_rng(seed)
+    photons = rng.poisson(0.3, (size,) + shape)
+    frames = rng.normal(zero_adu, 8., (size,) + shape) + one_adu * photons
+    # frame by frame baseline drift, removed by HGData optimization
+    return (frames.T + rng.normal(0, 5, size)).T
+
+def wait(viewer, app, timeout=60.):
+    start = time.time()
+    while viewer.busy and time.time() - start < timeout:
+        app.processEvents()
+        time.sleep(0.01)
+
+def test_viewer(roi=(-100, 200)):
+    from scipy.ndimage import median_filter
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    frames = synthetic_frames()
+    ref_zero_adu, ref_one_adu = HGData(frames).calibrate(roi, (-50, 50), (30, 100))
+    hg_data = HGData(frames, optimize=False)
+    source = ((median_filter(log_scale(hist), 3), adus, count)
+              for hist, adus, count in hg_data.iter_hist(roi, chunk_size=50))
+    adus = np.arange(roi[0], roi[1]) + 0.5
+    viewer = CalibViewer(None, adus, source=source)
+    try:
+        viewer.zero_lr.setRegion((-50, 50))
+        viewer.one_lr.setRegion((30, 100))
+        wait(viewer, app)
+        assert not viewer.busy
+        assert viewer.frames == frames.shape[0]
+        # the viewer and the headless calibration share calib.fit_levels
+        assert np.isclose(viewer.zero_adu, ref_zero_adu)
+        assert np.isclose(viewer.one_adu, ref_one_adu)
+    finally:
+        viewer.close()
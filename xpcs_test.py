@@ -0,0 +1,89 @@
+import h5py
+import numpy as np
+import pytest
+from exfel.data import CheetahData, DATA_PATH, PULSE_PATH, TRAIN_PATH
+from exfel.xpcs import MultiTauCorrelator, correlate, frame_runs, multi_tau_lags, train_ranges
+
+def xpcs_file(path, n_trains=40, n_pulses=5, shape=(4, 6), seed=0, missing=(7, 8, 21)):
+    rng = np.random.default_rng(seed)
+    train_ids = np.repeat(np.setdiff1d(np.arange(n_trains), missing) + 500, n_pulses)
+    pulse_ids = np.tile(np.arange(n_pulses) * 4, train_ids.size // n_pulses)
+    data = rng.gamma(2., 10., (train_ids.size,) + shape).astype(np.float32)
+    with h5py.File(path, 'w') as out_file:
+        out_file.create_dataset(DATA_PATH, data=data)
+        out_file.create_dataset(PULSE_PATH, data=pulse_ids)
+        out_file.create_dataset(TRAIN_PATH, data=train_ids)
+    return data.reshape(data.shape[0], -1), train_ids, pulse_ids
+
+def brute_g2(values, times, lag):
+    """
+    g2 of a single stream over the frame pairs lag apart in time
+    """
+    positions = dict((time, idx) for idx, time in enumerate(times))
+    pairs = [(positions[time], positions[time + lag]) for time in times if time + lag in positions]
+    left = values[[first for first, _ in pairs]]
+    right = values[[second for _, second in pairs]]
+    return (left * right).mean(axis=0) / (left.mean(axis=0) * right.mean(axis=0))
+
+def test_gaps():
+    rng = np.random.default_rng(1)
+    times = np.setdiff1d(np.arange(30), [4, 5, 11])
+    values = rng.gamma(2., 10., (times.size, 3))
+    corr = MultiTauCorrelator(3, m=4, n_levels=2)
+    for start in range(0, times.size, 7):
+        corr.update(values[start:start + 7], times=times[start:start + 7])
+    g2 = corr.pixel_g2()
+    for idx, lag in enumerate(corr.lags[:3]):
+        np.testing.assert_allclose(g2[idx], brute_g2(values, times, lag))
+
+def test_long_gap():
+    rng = np.random.default_rng(2)
+    times = np.concatenate((np.arange(10), np.arange(200, 215)))
+    values = rng.gamma(2., 10., (times.size, 2))
+    corr = MultiTauCorrelator(2, m=4, n_levels=3)
+    corr.update(values, times=times)
+    ref = MultiTauCorrelator(2, m=4, n_levels=3)
+    ref.update(values[:10], times=times[:10])
+    ref.update(values[10:], stream=1, times=times[10:])
+    np.testing.assert_array_equal(corr.count, ref.count)
+    np.testing.assert_allclose(corr.num, ref.num)
+
+@pytest.mark.parametrize('mode', ['intra', 'inter'])
+def test_split(tmp_path, mode):
+    xpcs_file(str(tmp_path / 'xpcs.h5'))
+    reader = CheetahData(str(tmp_path / 'xpcs.h5'))
+    labels = np.zeros((4, 6), dtype=int)
+    labels[:2], labels[3, 2:] = 1, 2
+    lags, serial = correlate(reader, labels, mode, m=4, n_levels=3, block_size=17, num_workers=1)
+    _, parallel = correlate(reader, labels, mode, m=4, n_levels=3, block_size=17, num_workers=3)
+    np.testing.assert_array_equal(lags, multi_tau_lags(4, 3)[0])
+    assert serial.shape == (2, lags.size)
+    np.testing.assert_allclose(parallel, serial)
+
+def test_inter_missing_trains(tmp_path):
+    data, train_ids, _ = xpcs_file(str(tmp_path / 'xpcs.h5'))
+    reader = CheetahData(str(tmp_path / 'xpcs.h5'))
+    labels = np.zeros((4, 6), dtype=int)
+    labels[0, 0] = 1
+    lags, g2 = correlate(reader, labels, 'inter', m=4, n_levels=2, num_workers=2)
+    values, times = data[:, 0].astype(np.float64), np.unique(train_ids)
+    for idx, lag in enumerate(lags[:3]):
+        # all the pulse ID streams miss the same trains, their pairs are pooled
+        left = values[np.isin(train_ids, times[np.isin(times + lag, times)])]
+        right = values[np.isin(train_ids, times[np.isin(times - lag, times)])]
+        np.testing.assert_allclose(g2[0, idx], np.mean(left * right) / (left.mean() * right.mean()))
+
+def test_ranges():
+    train_ids = np.repeat(np.arange(100, 150), 3)
+    blocks = [(start, min(start + 20, train_ids.size)) for start in range(0, train_ids.size, 20)]
+    ranges = train_ranges(train_ids, 'intra', 4, 8, 4)
+    runs = [frame_runs(np.flatnonzero((train_ids >= first) & (train_ids < last)), blocks)
+            for first, last, _ in ranges]
+    # every frame is read once
+    frames = np.concatenate([np.arange(start, stop) for worker in runs for start, stop in worker])
+    np.testing.assert_array_equal(np.sort(frames), np.arange(train_ids.size))
+    assert all(stop <= next(block_stop for _, block_stop in blocks if block_stop > start)
+               for worker in runs for start, stop in worker)
+    ranges = train_ranges(train_ids, 'inter', 4, 4, 3)
+    assert [count_from for _, _, count_from in ranges] == [0, 12, 24, 36]
+    assert [first for first, _, _ in ranges] == [100, 100, 112, 124]